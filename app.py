@@ -1,6 +1,8 @@
 import os
 import json
 import requests
+import urllib3
+import httpx
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 import time
@@ -10,10 +12,35 @@ import csv
 from io import StringIO
 import sys
 import select
+import signal
+import socket
+import sqlite3
+import uuid
+import functools
+import contextlib
+import tempfile
+import shutil
+import datetime
+import email.utils
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import math
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 # --- Cho Google Drive ---
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
+from pydrive2.files import ApiRequestError
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+import httplib2
 
 # --- Cho AI ---
 from google import genai
@@ -34,10 +61,30 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 PEXELS_API_KEY = os.getenv("PEXELS_API_KEY")
 UNSPLASH_ACCESS_KEY = os.getenv("UNSPLASH_ACCESS_KEY")
 
+# Địa chỉ gốc của các API bên ngoài (chỉ đổi khi chạy với server giả lập, xem loadtest.py)
+PEXELS_API_URL = os.getenv("PEXELS_API_URL", "https://api.pexels.com/v1").rstrip('/')
+UNSPLASH_API_URL = os.getenv("UNSPLASH_API_URL", "https://api.unsplash.com").rstrip('/')
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip('/')
+GSHEET_EXPORT_URL = os.getenv("GSHEET_EXPORT_URL", "https://docs.google.com/spreadsheets/d").rstrip('/')
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL") # Trống = endpoint mặc định của google-genai
+
 # 2. Cấu hình Ứng dụng
 # Lưu ý: os.getenv trả về chuỗi, nên cần chuyển đổi sang boolean và gán giá trị mặc định
 ENABLE_TELEGRAM_NOTIFICATIONS = os.getenv("ENABLE_TELEGRAM_NOTIFICATIONS", "False").lower() == "true"
 GSHEET_ID = os.getenv("GSHEET_ID")
+# App Câu Chuyện: True = đề xuất chủ đề + viết kịch bản trong MỘT lần gọi Gemini; False = 2 bước như cũ (để so sánh)
+STORY_SINGLE_CALL = os.getenv("STORY_SINGLE_CALL", "True").lower() == "true"
+# Số lần gọi lại Gemini khi kịch bản trả về không hợp lệ (JSON hỏng, thiếu slide)
+GEMINI_REPAIR_ATTEMPTS = int(os.getenv("GEMINI_REPAIR_ATTEMPTS", "1"))
+
+# Cấu hình chữ trên slide: FONT_SIZE là cỡ tối đa. Khi bật FONT_AUTO_FIT, cỡ chữ được tìm kiếm nhị phân
+# trong khoảng [FONT_MIN_SIZE, FONT_SIZE] để khối chữ vừa khung TEXT_BOX_WIDTH x TEXT_BOX_HEIGHT
+FONT_SIZE = int(os.getenv("FONT_SIZE", "72"))
+FONT_MIN_SIZE = int(os.getenv("FONT_MIN_SIZE", "40"))
+FONT_AUTO_FIT = os.getenv("FONT_AUTO_FIT", "True").lower() == "true"
+FONT_CACHE_SIZE = int(os.getenv("FONT_CACHE_SIZE", "32")) # Số cỡ font giữ trong LRU
+TEXT_BOX_WIDTH = int(os.getenv("TEXT_BOX_WIDTH", "840"))
+TEXT_BOX_HEIGHT = int(os.getenv("TEXT_BOX_HEIGHT", "1500"))
 
 # 3. ID Thư mục Google Drive
 BACKGROUND_IMAGES_FOLDER_ID = os.getenv("BACKGROUND_IMAGES_FOLDER_ID")
@@ -55,8 +102,137 @@ CREDENTIALS_FILE = os.path.join(FILE_DIR, 'auto_creds.txt')
 CLIENT_SECRETS_FILE = os.path.join(FILE_DIR, 'credentials.json')
 FONT_PATH = os.path.join(FILE_DIR, 'font.ttf')
 
+# 5. Cache ảnh nền đã cắt sẵn 1080x1920 (trên đĩa, LRU theo dung lượng)
+# BG_CACHE_REUSE_RATIO: xác suất (0-1) một slide dùng lại ảnh nền có sẵn trong cache thay vì gọi mạng,
+# chỉ áp dụng khi cache đã có ít nhất BG_CACHE_MIN_ENTRIES ảnh (để tránh lặp ảnh quá nhiều)
+BG_CACHE_DIR = os.getenv("BG_CACHE_DIR", os.path.join(FILE_DIR, 'bg_cache'))
+BG_CACHE_MAX_BYTES = int(float(os.getenv("BG_CACHE_MAX_MB", "500")) * 1024 * 1024)
+BG_CACHE_REUSE_RATIO = float(os.getenv("BG_CACHE_REUSE_RATIO", "0"))
+BG_CACHE_MIN_ENTRIES = int(os.getenv("BG_CACHE_MIN_ENTRIES", "30"))
+BG_CACHE_JPEG_QUALITY = 92
+
+# Chỉ mục cục bộ của thư mục ảnh nền trên Drive (giữ qua các lần khởi động, làm mới nền sau mỗi TTL)
+DRIVE_BG_INDEX_FILE = os.getenv("DRIVE_BG_INDEX_FILE", os.path.join(FILE_DIR, 'drive_bg_index.json'))
+DRIVE_BG_INDEX_TTL_SECONDS = int(os.getenv("DRIVE_BG_INDEX_TTL_SECONDS", str(6 * 3600)))
+
+# 6. Cache kết quả tìm kiếm Pexels theo từ khoá (TTL) + xoay vòng trang để kho ảnh lớn dần
+PEXELS_SEARCH_TTL_SECONDS = int(os.getenv("PEXELS_SEARCH_TTL_SECONDS", "3600"))
+PEXELS_PER_PAGE = int(os.getenv("PEXELS_PER_PAGE", "40"))
+PEXELS_POOL_MAX = int(os.getenv("PEXELS_POOL_MAX", "400")) # Số ảnh tối đa giữ cho mỗi từ khoá
+PEXELS_SEARCH_RETRY_SECONDS = int(os.getenv("PEXELS_SEARCH_RETRY_SECONDS", "300")) # Search lỗi: dùng kho cũ trong khoảng này
+
+# 7. Slide được mã hoá JPEG trong bộ nhớ và tải thẳng lên Drive. Bật SLIDE_SPILL_TO_DISK để ghi tạm ra đĩa
+# (thư mục riêng cho mỗi job trong SLIDE_SPILL_DIR, mặc định /dev/shm nếu có), tự dọn khi job kết thúc
+SLIDE_SPILL_TO_DISK = os.getenv("SLIDE_SPILL_TO_DISK", "False").lower() == "true"
+SLIDE_SPILL_DIR = os.getenv("SLIDE_SPILL_DIR")
+
+# Bộ đệm kịch bản tạo sẵn trên đĩa (producer chạy nền gọi Gemini trước, vòng lặp chính chỉ việc lấy ra).
+# Ngưỡng low/high mặc định áp dụng cho mọi app; ghi đè riêng từng app bằng
+# SCRIPT_BUFFER_WATERMARKS="story=2:5,joke=3:10". SCRIPT_BUFFER_OFFPEAK_HOURS="1-6": chỉ nạp đầy tới high trong khung giờ này.
+# Bộ đệm nằm trong file SQLite JOB_QUEUE_DB (dùng chung giữa scheduler và các worker).
+SCRIPT_BUFFER_ENABLED = os.getenv("SCRIPT_BUFFER_ENABLED", "False").lower() == "true"
+SCRIPT_BUFFER_LOW = int(os.getenv("SCRIPT_BUFFER_LOW", "1"))
+SCRIPT_BUFFER_HIGH = int(os.getenv("SCRIPT_BUFFER_HIGH", "3"))
+SCRIPT_BUFFER_WATERMARKS = {
+    kind.strip(): tuple(int(n) for n in marks.split(':'))
+    for kind, marks in (item.split('=') for item in os.getenv("SCRIPT_BUFFER_WATERMARKS", "").split(',') if item.strip())
+}
+SCRIPT_BUFFER_MAX_AGE_HOURS = float(os.getenv("SCRIPT_BUFFER_MAX_AGE_HOURS", "72"))
+SCRIPT_BUFFER_OFFPEAK_HOURS = tuple(int(h) for h in os.getenv("SCRIPT_BUFFER_OFFPEAK_HOURS", "").split('-') if h.strip())
+SCRIPT_BUFFER_POLL_SECONDS = float(os.getenv("SCRIPT_BUFFER_POLL_SECONDS", "60"))
+# Tạo hàng loạt: số kịch bản tối đa trong một request Gemini và số request chạy song song
+BULK_SCRIPTS_PER_REQUEST = int(os.getenv("BULK_SCRIPTS_PER_REQUEST", "10"))
+BULK_MAX_CONCURRENT_REQUESTS = int(os.getenv("BULK_MAX_CONCURRENT_REQUESTS", "4"))
+# Producer nạp truyện cười/cổ tích qua Gemini Batch API khi phần thiếu >= SCRIPT_BUFFER_BATCH_MIN kịch bản và bộ đệm
+# vẫn còn trên ngưỡng low (batch có thể mất nhiều giờ). 0 = luôn gọi đồng bộ.
+SCRIPT_BUFFER_BATCH_MIN = int(os.getenv("SCRIPT_BUFFER_BATCH_MIN", "20"))
+
+# Lịch sử nội dung đã tạo để loại kịch bản gần trùng (Jaccard ước lượng bằng MinHash >= ngưỡng).
+# Lưu trong JOB_QUEUE_DB (dùng chung giữa các tiến trình).
+CONTENT_HISTORY_MAX = int(os.getenv("CONTENT_HISTORY_MAX", "5000"))
+CONTENT_DUP_THRESHOLD = float(os.getenv("CONTENT_DUP_THRESHOLD", "0.6"))
+CONTENT_DUP_MAX_RETRIES = int(os.getenv("CONTENT_DUP_MAX_RETRIES", "2")) # Số lần tạo lại khi gặp kịch bản trùng
+CONTENT_EXCLUDE_RECENT = int(os.getenv("CONTENT_EXCLUDE_RECENT", "20")) # Số tiêu đề gần nhất đưa vào prompt để tránh
+
+# Cache cấu hình ứng dụng từ Google Sheet: kiểm tra lại sau mỗi TTL (ở thread nền). APP_CONFIG_LOCAL_FILE (.csv/.json)
+# nếu được đặt sẽ thay thế hoàn toàn Sheet và được nạp lại mỗi khi file thay đổi.
+APP_CONFIG_TTL_SECONDS = int(os.getenv("APP_CONFIG_TTL_SECONDS", "300"))
+APP_CONFIG_CACHE_FILE = os.getenv("APP_CONFIG_CACHE_FILE", os.path.join(FILE_DIR, 'app_config_cache.json'))
+APP_CONFIG_LOCAL_FILE = os.getenv("APP_CONFIG_LOCAL_FILE")
+
+# Chế độ chạy: "interactive" (vòng lặp cũ, hỏi y/n sau mỗi lần) hoặc "daemon" (bộ lập lịch, không cần TTY).
+# SCHEDULER_APP_RATES: số bài/giờ theo app; SCHEDULER_CRON: khung giờ cron theo app, ngăn cách bằng ";"
+# (ví dụ "CAUCHUYEN=0 8,12,20 * * *;TAROT=30 7 * * 1-5"); SCHEDULER_APP_WEIGHTS: trọng số cho app không có lịch.
+RUN_MODE = os.getenv("RUN_MODE", "interactive").lower()
+SCHEDULER_MAX_CONCURRENT_JOBS = int(os.getenv("SCHEDULER_MAX_CONCURRENT_JOBS", "2"))
+SCHEDULER_APP_RATES = os.getenv("SCHEDULER_APP_RATES", "")
+SCHEDULER_CRON = os.getenv("SCHEDULER_CRON", "")
+SCHEDULER_APP_WEIGHTS = os.getenv("SCHEDULER_APP_WEIGHTS", "")
+SCHEDULER_MIN_START_INTERVAL = float(os.getenv("SCHEDULER_MIN_START_INTERVAL", "0")) # Giây tối thiểu giữa 2 lần bắt đầu job
+SCHEDULER_FILL_MIN_INTERVAL = float(os.getenv("SCHEDULER_FILL_MIN_INTERVAL", "60")) # Giây tối thiểu giữa 2 job của app lấp chỗ
+# App có job thất bại bị tạm dừng SCHEDULER_FAILURE_BACKOFF giây, nhân đôi sau mỗi lần lỗi liên tiếp (tối đa ..._MAX)
+SCHEDULER_FAILURE_BACKOFF = float(os.getenv("SCHEDULER_FAILURE_BACKOFF", "60"))
+SCHEDULER_FAILURE_BACKOFF_MAX = float(os.getenv("SCHEDULER_FAILURE_BACKOFF_MAX", "3600"))
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "5"))
+
+# Hàng đợi job dùng chung (RUN_MODE=scheduler / worker): file SQLite, thời hạn lease, số lần thử tối đa
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", os.path.join(FILE_DIR, 'jobs.db'))
+JOB_QUEUE_MAX_PENDING = int(os.getenv("JOB_QUEUE_MAX_PENDING", "4")) # Số job chờ/đang chạy tối đa do app lấp chỗ tạo ra
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", "1"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+# Checkpoint tiến độ từng job (kịch bản, thư mục, ảnh nền, hash slide, file đã upload) để chạy tiếp sau crash/khởi động lại
+JOB_CHECKPOINT_ENABLED = os.getenv("JOB_CHECKPOINT_ENABLED", "True").lower() == "true"
+JOB_CHECKPOINT_DIR = os.getenv("JOB_CHECKPOINT_DIR", os.path.join(FILE_DIR, 'checkpoints'))
+JOB_CHECKPOINT_MAX_AGE_HOURS = float(os.getenv("JOB_CHECKPOINT_MAX_AGE_HOURS", "48")) # Checkpoint bỏ dở lâu hơn thì xoá
+
+# 8. Pipeline xử lý slide song song: tải nền/upload trên thread pool, vẽ trên process pool (mặc định = số nhân CPU)
+PIPELINE_ENABLED = os.getenv("PIPELINE_ENABLED", "True").lower() == "true"
+PIPELINE_IO_WORKERS = int(os.getenv("PIPELINE_IO_WORKERS", "8"))
+PIPELINE_RENDER_WORKERS = int(os.getenv("PIPELINE_RENDER_WORKERS", str(os.cpu_count() or 1)))
+PIPELINE_MAX_IN_FLIGHT = int(os.getenv("PIPELINE_MAX_IN_FLIGHT", "6")) # Số slide tối đa nằm trong pipeline cùng lúc
+
+# 9. Lớp mạng bất đồng bộ (asyncio + httpx): số request đồng thời tối đa trong một job.
+# Bật ASYNC_PREFETCH_BACKGROUNDS để mỗi job tải toàn bộ ảnh nền cùng lúc trước khi vẽ/upload
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", "10"))
+ASYNC_PREFETCH_BACKGROUNDS = os.getenv("ASYNC_PREFETCH_BACKGROUNDS", "False").lower() == "true"
+
+# 10. HTTP: số kết nối giữ sẵn cho mỗi host, timeout mặc định và chính sách thử lại (backoff luỹ thừa + jitter)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+HTTP_RETRY_AFTER_MAX = float(os.getenv("HTTP_RETRY_AFTER_MAX", "60")) # Retry-After lớn hơn mức này thì bỏ qua, không chờ
+
+# 11. Upload Google Drive: số file upload song song, ngưỡng chuyển sang resumable upload và kích thước mỗi chunk
+DRIVE_UPLOAD_WORKERS = int(os.getenv("DRIVE_UPLOAD_WORKERS", "4"))
+DRIVE_RESUMABLE_THRESHOLD = int(float(os.getenv("DRIVE_RESUMABLE_THRESHOLD_MB", "5")) * 1024 * 1024)
+DRIVE_UPLOAD_CHUNK_SIZE = int(os.getenv("DRIVE_UPLOAD_CHUNK_MB", "8")) * 1024 * 1024 # Phải là bội số của 256 KB
+
+# 12. Cách gửi kết quả lên Telegram: "links" (tin nhắn + danh sách link Drive) hoặc "album" (gửi thẳng ảnh slide
+# bằng sendMediaGroup). TELEGRAM_PREVIEW_MAX_SIDE > 0 thì gửi bản thu nhỏ thay vì slide gốc 1080x1920.
+TELEGRAM_DELIVERY_MODE = os.getenv("TELEGRAM_DELIVERY_MODE", "links").lower()
+TELEGRAM_PREVIEW_MAX_SIDE = int(os.getenv("TELEGRAM_PREVIEW_MAX_SIDE", "0"))
+TELEGRAM_PREVIEW_QUALITY = int(os.getenv("TELEGRAM_PREVIEW_QUALITY", "80"))
+TELEGRAM_UPLOAD_TIMEOUT = float(os.getenv("TELEGRAM_UPLOAD_TIMEOUT", "60"))
+
+# 13. Đo lường: thời gian từng tầng, bộ đếm theo nguồn, số byte. METRICS_PORT > 0 thì mở endpoint Prometheus
+# (http://METRICS_HOST:METRICS_PORT/metrics, bản JSON ở /metrics.json); tóm tắt JSON ghi ra file mỗi METRICS_SUMMARY_SECONDS.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_SUMMARY_SECONDS = float(os.getenv("METRICS_SUMMARY_SECONDS", "300")) # 0 = tắt
+METRICS_SUMMARY_FILE = os.getenv("METRICS_SUMMARY_FILE", os.path.join(FILE_DIR, 'metrics_summary.json'))
+
+# Kích thước khung hình slide (TikTok dọc)
+CANVAS_WIDTH, CANVAS_HEIGHT = 1080, 1920
+
 # Thiết lập Client Gemini
-client = genai.Client(api_key=GEMINI_API_KEY)
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+)
 
 TIMEOUT_SECONDS = 3
 
@@ -64,122 +240,790 @@ TIMEOUT_SECONDS = 3
 # --- KHỐI HÀM PHỤ VÀ TẢI ẢNH (GIỮ NGUYÊN) ---
 # ==========================================================
 
+# ==========================================================
+# --- ĐO LƯỜNG: THỜI GIAN TỪNG TẦNG, BỘ ĐẾM, SỐ BYTE (PROMETHEUS + JSON) ---
+# ==========================================================
+# Tầng (stage): gemini, pexels_search, unsplash_search, image_download, decode_resize, resize_crop, overlay, text_layout,
+# text_draw, jpeg_encode, render, drive_list, drive_download, drive_folder, drive_upload, telegram, sheet_config, job.
+# Bộ đếm: provider_requests_total{provider,outcome}, background_source_total{provider,outcome}
+# (outcome 'fallback' = nguồn dự phòng cứu được slide), bytes_total{provider,direction}, stage_errors_total{stage}...
+# Chỉ dùng thư viện chuẩn; số liệu nằm trong bộ nhớ của tiến trình (mỗi worker một endpoint riêng).
+METRICS_PREFIX = 'tktk_'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+_metrics_lock = threading.Lock()
+_stage_latency = {} # tầng -> {'buckets': số mẫu theo từng bucket (không cộng dồn, phần tử cuối là +Inf), 'count', 'sum'}
+_metric_counters = {} # (tên, ((nhãn, giá trị), ...)) -> giá trị
+_metrics_started_at = time.time()
+
+def observe_stage(stage, seconds):
+    with _metrics_lock:
+        entry = _stage_latency.get(stage)
+        if entry is None:
+            entry = _stage_latency[stage] = {'buckets': [0] * (len(METRICS_LATENCY_BUCKETS) + 1), 'count': 0, 'sum': 0.0}
+        entry['buckets'][bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)] += 1
+        entry['count'] += 1
+        entry['sum'] += seconds
+
+def observe_stages(timings):
+    """Ghi một dict {tầng: giây} (ví dụ thời gian đo trong process pool vẽ slide)."""
+    for stage, seconds in timings.items():
+        observe_stage(stage, seconds)
+
+def count_metric(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+def count_provider(provider, ok):
+    count_metric('provider_requests_total', provider=provider, outcome='success' if ok else 'failure')
+
+@contextlib.contextmanager
+def track_stage(stage, provider=None):
+    """
+    Đo thời gian khối lệnh vào histogram của tầng; khối ném lỗi thì đếm thêm stage_errors_total.
+    Có provider thì đếm luôn provider_requests_total (failure nếu khối ném lỗi).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        count_metric('stage_errors_total', stage=stage)
+        if provider:
+            count_provider(provider, False)
+        raise
+    else:
+        if provider:
+            count_provider(provider, True)
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+# Địa chỉ gốc API -> (tầng, nguồn) cho các request đi qua http_request / async_http_request.
+# Tải ảnh từ CDN truyền nhãn trực tiếp (metric_labels) vì host CDN thay đổi theo từng ảnh.
+HTTP_METRIC_ROUTES = [
+    (PEXELS_API_URL, 'pexels_search', 'pexels'),
+    (UNSPLASH_API_URL, 'unsplash_search', 'unsplash'),
+    (TELEGRAM_API_URL, 'telegram', 'telegram'),
+    (GSHEET_EXPORT_URL, 'sheet_config', 'sheets'),
+]
+
+def http_metric_labels(url):
+    for prefix, stage, provider in HTTP_METRIC_ROUTES:
+        if url.startswith(prefix):
+            return stage, provider
+    return 'http', urlsplit(url).netloc
+
+def record_http_response(provider, response):
+    """Đếm kết quả và số byte của một response (requests hoặc httpx) đã đọc xong body."""
+    count_provider(provider, response.status_code < 400)
+    count_metric('bytes_total', len(response.content), provider=provider, direction='download')
+    sent = int(response.request.headers.get('Content-Length') or 0)
+    if sent:
+        count_metric('bytes_total', sent, provider=provider, direction='upload')
+
+def _histogram_quantile(buckets, count, q):
+    """Ước lượng phân vị từ histogram (nội suy tuyến tính trong bucket, như histogram_quantile của Prometheus)."""
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for index, samples in enumerate(buckets):
+        if seen + samples >= rank and samples:
+            lower = METRICS_LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+            if index >= len(METRICS_LATENCY_BUCKETS):
+                return lower # Rơi vào bucket +Inf: trả về cận trên hữu hạn lớn nhất
+            return lower + (METRICS_LATENCY_BUCKETS[index] - lower) * (rank - seen) / samples
+        seen += samples
+    return METRICS_LATENCY_BUCKETS[-1]
+
+def metrics_snapshot():
+    with _metrics_lock:
+        stages = {stage: {'buckets': list(entry['buckets']), 'count': entry['count'], 'sum': entry['sum']} for stage, entry in _stage_latency.items()}
+        counters = dict(_metric_counters)
+    return stages, counters
+
+def metrics_summary():
+    """Tóm tắt dạng JSON: mỗi tầng count/avg/p50/p95 (giây), và mọi bộ đếm kèm nhãn."""
+    stages, counters = metrics_snapshot()
+    summary = {'generated_at': time.time(), 'uptime_seconds': round(time.time() - _metrics_started_at, 1), 'stages': {}, 'counters': {}}
+    for stage, entry in sorted(stages.items()):
+        p50 = _histogram_quantile(entry['buckets'], entry['count'], 0.5)
+        p95 = _histogram_quantile(entry['buckets'], entry['count'], 0.95)
+        summary['stages'][stage] = {
+            'count': entry['count'],
+            'avg': round(entry['sum'] / entry['count'], 4) if entry['count'] else None,
+            'p50': round(p50, 4) if p50 is not None else None,
+            'p95': round(p95, 4) if p95 is not None else None,
+        }
+    for (name, labels), value in sorted(counters.items()):
+        summary['counters'].setdefault(name, []).append({**dict(labels), 'value': value})
+    return summary
+
+def _prometheus_labels(labels):
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def render_prometheus_metrics():
+    """Toàn bộ số liệu theo định dạng text exposition của Prometheus."""
+    stages, counters = metrics_snapshot()
+    lines = [
+        f"# HELP {METRICS_PREFIX}stage_seconds Thời gian xử lý của từng tầng.",
+        f"# TYPE {METRICS_PREFIX}stage_seconds histogram",
+    ]
+    for stage, entry in sorted(stages.items()):
+        cumulative = 0
+        for bound, samples in zip(METRICS_LATENCY_BUCKETS + (float('inf'),), entry['buckets']):
+            cumulative += samples
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{METRICS_PREFIX}stage_seconds_bucket{_prometheus_labels((('stage', stage), ('le', le)))} {cumulative}")
+        lines.append(f"{METRICS_PREFIX}stage_seconds_sum{_prometheus_labels((('stage', stage),))} {entry['sum']}")
+        lines.append(f"{METRICS_PREFIX}stage_seconds_count{_prometheus_labels((('stage', stage),))} {entry['count']}")
+    declared = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+        lines.append(f"{METRICS_PREFIX}{name}{_prometheus_labels(labels)} {value}")
+    lines.append(f"# TYPE {METRICS_PREFIX}uptime_seconds gauge")
+    lines.append(f"{METRICS_PREFIX}uptime_seconds {time.time() - _metrics_started_at:.1f}")
+    return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            body, content_type = render_prometheus_metrics().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body, content_type = json.dumps(metrics_summary(), ensure_ascii=False).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Không in log truy cập của Prometheus
+
+def write_metrics_summary():
+    summary = metrics_summary()
+    tmp_path = f"{METRICS_SUMMARY_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, METRICS_SUMMARY_FILE)
+    except OSError as e:
+        print(f"  - Cảnh báo: Không thể ghi tóm tắt số liệu: {e}")
+    return summary
+
+def _metrics_summary_loop():
+    while True:
+        time.sleep(METRICS_SUMMARY_SECONDS)
+        summary = write_metrics_summary()
+        stage_text = ', '.join(
+            f"{stage} n={entry['count']} p50={entry['p50']}s p95={entry['p95']}s"
+            for stage, entry in summary['stages'].items()
+        )
+        print(f"📊 Số liệu: {stage_text or 'chưa có'}")
+
+def start_metrics():
+    """Mở endpoint Prometheus (nếu METRICS_PORT > 0) và thread ghi tóm tắt JSON định kỳ."""
+    if METRICS_PORT > 0:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+        except OSError as e:
+            print(f"⚠️ Không mở được endpoint số liệu {METRICS_HOST}:{METRICS_PORT}: {e}")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics_http', daemon=True).start()
+            print(f"📊 Endpoint số liệu: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if METRICS_SUMMARY_SECONDS > 0:
+        threading.Thread(target=_metrics_summary_loop, name='metrics_summary', daemon=True).start()
+
+# --- PHIÊN HTTP DÙNG CHUNG THEO HOST (KEEP-ALIVE) + CHÍNH SÁCH THỬ LẠI ---
+# Mỗi host một requests.Session với pool kết nối riêng, tránh bắt tay TCP+TLS lại cho mỗi request.
+# Lỗi kết nối/timeout và các status trong HTTP_RETRY_STATUSES được thử lại với backoff luỹ thừa + jitter;
+# với 429/503 ưu tiên thời gian chờ trong header Retry-After.
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Method không idempotent (POST: gửi tin Telegram...) chỉ được thử lại khi chắc chắn server chưa xử lý:
+# lỗi lúc kết nối (request chưa được gửi đi) hoặc 429 (server từ chối vì giới hạn tốc độ)
+HTTP_IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+HTTP_UNSENT_RETRY_STATUSES = {429}
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(url):
+    host = urlsplit(url).netloc
+    with _http_sessions_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_sessions[host] = session
+        return session
+
+def _parse_retry_after(value):
+    """Retry-After có thể là số giây hoặc một HTTP-date. Trả về số giây hoặc None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def retry_delay(attempt, status_code=None, retry_after=None):
+    """
+    Thời gian chờ trước lần thử lại thứ attempt (bắt đầu từ 0). Trả về None nếu KHÔNG nên thử lại
+    (server yêu cầu chờ lâu hơn HTTP_RETRY_AFTER_MAX, ví dụ hết quota theo giờ).
+    """
+    if status_code in (429, 503):
+        wait_seconds = _parse_retry_after(retry_after)
+        if wait_seconds is not None:
+            return wait_seconds if wait_seconds <= HTTP_RETRY_AFTER_MAX else None
+    # Full jitter: ngẫu nhiên trong [0, min(max, base * 2^attempt)]
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+def _request_not_sent(exc):
+    """True nếu lỗi requests chắc chắn xảy ra trước khi request tới server (không mở được kết nối)."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def http_request(method, url, timeout=None, metric_labels=None, idempotent=None, **kwargs):
+    """
+    requests qua phiên dùng chung của host, có timeout mặc định và thử lại theo chính sách ở trên.
+    metric_labels = (tầng, nguồn) ghi đè nhãn số liệu suy ra từ URL. idempotent=None thì suy ra từ method.
+    """
+    stage, provider = metric_labels or http_metric_labels(url)
+    if idempotent is None:
+        idempotent = method.upper() in HTTP_IDEMPOTENT_METHODS
+    with track_stage(stage):
+        try:
+            response = _http_request_with_retry(method, url, timeout, idempotent, **kwargs)
+        except requests.exceptions.RequestException:
+            count_provider(provider, False)
+            raise
+        record_http_response(provider, response)
+    return response
+
+def _http_request_with_retry(method, url, timeout=None, idempotent=True, **kwargs):
+    session = get_http_session(url)
+    retry_statuses = HTTP_RETRY_STATUSES if idempotent else HTTP_UNSENT_RETRY_STATUSES
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        is_last = attempt == HTTP_MAX_RETRIES
+        try:
+            response = session.request(method, url, timeout=timeout or HTTP_TIMEOUT, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # Request có thể đã tới server (đọc timeout, mất kết nối giữa chừng): không gửi lại method không idempotent
+            if is_last or not (idempotent or _request_not_sent(e)):
+                raise
+            delay = retry_delay(attempt)
+            print(f"  - HTTP {method} {urlsplit(url).netloc}: lỗi kết nối ({e}). Thử lại sau {delay:.1f}s.")
+            time.sleep(delay)
+            continue
+
+        if response.status_code not in retry_statuses or is_last:
+            return response
+        delay = retry_delay(attempt, response.status_code, response.headers.get('Retry-After'))
+        if delay is None:
+            return response
+        print(f"  - HTTP {method} {urlsplit(url).netloc}: status {response.status_code}. Thử lại sau {delay:.1f}s.")
+        response.close()
+        time.sleep(delay)
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http_request('POST', url, **kwargs)
+
+# --- DÀN TRANG VĂN BẢN (ĐO 1 LẦN / TỪ, CÓ CACHE) ---
+# Cache kết quả đo theo (font, size, token). Giới hạn số phần tử để tránh phình bộ nhớ khi chạy lâu dài.
+TEXT_MEASURE_CACHE_MAX = 20000
+_text_measure_cache = {}
+
+def _font_cache_key(font):
+    # FreeTypeFont nhận diện bằng (family, style) + size, ổn định giữa các instance cùng face;
+    # font không hỗ trợ getname() thì dùng id() của đối tượng
+    try:
+        return (font.getname(), getattr(font, 'size', None))
+    except AttributeError:
+        return (id(font), getattr(font, 'size', None))
+
+def measure_token(font, token):
+    """
+    Đo một token (từ hoặc dấu cách) đúng MỘT lần cho mỗi (font, size, token).
+    Trả về tuple (advance, left, top, right, bottom) theo toạ độ anchor 'la' của Pillow.
+    """
+    key = _font_cache_key(font) + (token,)
+    metrics = _text_measure_cache.get(key)
+    if metrics is not None:
+        return metrics
+
+    try:
+        advance = font.getlength(token)
+        left, top, right, bottom = font.getbbox(token)
+    except AttributeError:
+        # Fallback cho font không hỗ trợ getlength/getbbox
+        advance = len(token) * 20
+        left, top, right, bottom = 0, 0, advance, getattr(font, 'size', 20)
+
+    if len(_text_measure_cache) >= TEXT_MEASURE_CACHE_MAX:
+        _text_measure_cache.clear()
+    metrics = (advance, left, top, right, bottom)
+    _text_measure_cache[key] = metrics
+    return metrics
+
+def _wrap_paragraph(words, font, max_width):
+    """Ngắt một đoạn thành các dòng (danh sách từ) bằng cách cộng dồn độ rộng đã đo sẵn."""
+    space_advance = measure_token(font, ' ')[0]
+    lines = []
+    current_words = []
+    current_width = 0
+    for word in words:
+        word_advance = measure_token(font, word)[0]
+        test_width = current_width + space_advance + word_advance if current_words else word_advance
+        if not current_words or test_width <= max_width:
+            current_words.append(word)
+            current_width = test_width
+        else:
+            lines.append(current_words)
+            current_words = [word]
+            current_width = word_advance
+    lines.append(current_words)
+    return lines
+
 # HÀM Xử lý ngắt dòng tự động
 def text_wrap(text, font, max_width):
     lines = []
     paragraphs = text.split('\n')
-    # ... (giữ nguyên logic text_wrap) ...
     for paragraph in paragraphs:
         if not paragraph:
             lines.append("")
             continue
-        words = paragraph.split()
-        current_line = ""
-        for word in words:
-            test_line = current_line + " " + word if current_line else word
-            try:
-                width = font.getlength(test_line)
-            except AttributeError:
-                width = len(test_line) * 20
-            if width <= max_width:
-                current_line = test_line
-            else:
-                lines.append(current_line)
-                current_line = word
-        lines.append(current_line)
+        for line_words in _wrap_paragraph(paragraph.split(), font, max_width):
+            lines.append(" ".join(line_words))
     return lines
 
-# --- HÀM TẠO ẢNH NỀN VÀ CHÈN CHỮ (PILLOW) ---
-def create_image_with_text(text_to_overlay, drive_service, slide_index, theme):
-    # ... (Giữ nguyên logic của bạn) ...
-    filename_out = f"slide_{slide_index}_final.jpg"
-    W, H = 1080, 1920
-    temp_bg_path = None
+class TextLayout:
+    """
+    Kết quả dàn trang có thể tái sử dụng: mỗi dòng là dict gồm
+    'text', 'width', 'height', 'y_offset' (tính từ đỉnh khối chữ).
+    Vòng vẽ chỉ cần đọc các giá trị này, không đo lại lần nào.
+    """
+    def __init__(self, lines, total_height, font, max_width):
+        self.lines = lines
+        self.total_height = total_height
+        self.font = font
+        self.max_width = max_width
 
-    # CHUỖI ƯU TIÊN TẢI ẢNH: PEXELS -> UNSPLASH -> GOOGLE DRIVE
-    temp_bg_path = get_random_pexels_image(theme, slide_index)
-    if not temp_bg_path:
-        temp_bg_path = get_random_unsplash_image(theme, slide_index)
-        if not temp_bg_path:
-            temp_bg_path = get_random_background_image(
-                drive_service,
-                BACKGROUND_IMAGES_FOLDER_ID,
-                slide_index
-            )
+    @property
+    def max_line_width(self):
+        return max((line['width'] for line in self.lines), default=0)
 
-    if temp_bg_path:
-        # ... (logic mở, crop ảnh) ...
-        try:
-            img = Image.open(temp_bg_path).convert('RGB')
-        except Exception as e:
-            img = Image.new('RGB', (W, H), color = (0, 0, 0))
+def layout_text(text, font, max_width, line_spacing=15):
+    """
+    Dàn trang toàn bộ văn bản. Bỏ qua dòng trống (giống logic vẽ cũ).
+    Chiều rộng/cao mỗi dòng được ghép từ bbox của từng từ thay vì gọi textbbox cho cả dòng.
+    """
+    space_advance = measure_token(font, ' ')[0]
+    lines = []
+    y_offset = 0
+
+    for paragraph in text.split('\n'):
+        words = paragraph.split()
+        if not words:
+            continue
+        for line_words in _wrap_paragraph(words, font, max_width):
+            pen_x = 0
+            line_left = line_right = 0
+            line_top = line_bottom = None
+            for index, word in enumerate(line_words):
+                advance, left, top, right, bottom = measure_token(font, word)
+                if index == 0:
+                    line_left = left
+                else:
+                    pen_x += space_advance
+                line_right = pen_x + right
+                line_top = top if line_top is None else min(line_top, top)
+                line_bottom = bottom if line_bottom is None else max(line_bottom, bottom)
+                pen_x += advance
+
+            line_height = line_bottom - line_top
+            lines.append({
+                'text': " ".join(line_words),
+                'width': line_right - line_left,
+                'height': line_height,
+                'y_offset': y_offset,
+            })
+            y_offset += line_height + line_spacing
+
+    # Bỏ đi khoảng cách dòng thừa cuối cùng
+    total_height = y_offset - line_spacing if lines else 0
+    return TextLayout(lines, total_height, font, max_width)
+
+# --- KHO FONT DÙNG CHUNG (ĐỌC FILE 1 LẦN, LRU THEO CỠ CHỮ) ---
+_font_file_bytes = {}
+
+def _load_font_bytes(font_path):
+    # Đọc file .ttf vào bộ nhớ đúng một lần cho cả tiến trình
+    data = _font_file_bytes.get(font_path)
+    if data is None:
+        with open(font_path, 'rb') as f:
+            data = f.read()
+        _font_file_bytes[font_path] = data
+    return data
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(size, font_path=FONT_PATH):
+    """Trả về FreeTypeFont đã nạp sẵn cho cỡ chữ `size` (không parse lại file mỗi slide)."""
+    try:
+        return ImageFont.truetype(BytesIO(_load_font_bytes(font_path)), size)
+    except (IOError, OSError):
+        return ImageFont.load_default()
 
+def fit_text_layout(text, max_width=TEXT_BOX_WIDTH, max_height=TEXT_BOX_HEIGHT,
+                    min_size=FONT_MIN_SIZE, max_size=FONT_SIZE, line_spacing=15):
+    """
+    Tìm kiếm nhị phân cỡ chữ LỚN NHẤT trong [min_size, max_size] mà khối chữ đã ngắt dòng
+    vừa khung max_width x max_height. Trả về TextLayout của cỡ đó (hoặc của min_size nếu không cỡ nào vừa).
+    """
+    def fits(layout):
+        return layout.total_height <= max_height and layout.max_line_width <= max_width
+
+    best = layout_text(text, get_font(max_size), max_width, line_spacing)
+    if fits(best) or max_size <= min_size:
+        return best
+
+    low, high = min_size, max_size - 1
+    best = None
+    while low <= high:
+        mid = (low + high) // 2
+        layout = layout_text(text, get_font(mid), max_width, line_spacing)
+        if fits(layout):
+            best = layout
+            low = mid + 1
+        else:
+            high = mid - 1
+
+    if best is None:
+        best = layout_text(text, get_font(min_size), max_width, line_spacing)
+    return best
+
+# --- CẮT ẢNH THEO KIỂU "COVER" VỀ KÍCH THƯỚC KHUNG HÌNH ---
+# reduce() số nguyên trước khi LANCZOS khi ảnh lớn hơn đích ít nhất ~2 lần (xem reducing_gap của Pillow)
+RESIZE_REDUCING_GAP = 2.0
+
+def fit_cover(img, target_w=CANVAS_WIDTH, target_h=CANVAS_HEIGHT):
+    """
+    Phóng/thu ảnh để phủ kín target rồi cắt giữa. Chỉ vùng được giữ lại (box) mới được lấy mẫu,
+    và ảnh rất lớn được reduce() theo hệ số nguyên trước một lượt LANCZOS nhỏ cuối cùng.
+    """
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img_w, img_h = img.size
+    scale_ratio = max(target_w / img_w, target_h / img_h)
+    # Kích thước vùng nguồn (cùng tỉ lệ với target) được giữ lại sau khi cắt; kẹp lại vì sai số làm tròn
+    # có thể làm box vượt ảnh một chút (Pillow từ chối box có toạ độ âm)
+    box_w = min(img_w, target_w / scale_ratio)
+    box_h = min(img_h, target_h / scale_ratio)
+    left = (img_w - box_w) / 2
+    top = (img_h - box_h) / 2
+    img = img.resize(
+        (target_w, target_h),
+        Image.Resampling.LANCZOS,
+        box=(left, top, left + box_w, top + box_h),
+        reducing_gap=RESIZE_REDUCING_GAP if scale_ratio < 1 else None
+    )
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+def decode_background(image_bytes, target_w=CANVAS_WIDTH, target_h=CANVAS_HEIGHT):
+    """
+    Giải mã ảnh nền ở độ phân giải gần với đích: với JPEG dùng draft() để libjpeg giải mã
+    thẳng ở tỉ lệ 1/2, 1/4 hoặc 1/8 (vẫn đủ phủ target), sau đó mới cắt và thu nhỏ.
+    """
+    with track_stage('decode_resize'):
+        img = Image.open(BytesIO(image_bytes))
         img_w, img_h = img.size
-        target_w, target_h = W, H
         scale_ratio = max(target_w / img_w, target_h / img_h)
-        new_w = int(img_w * scale_ratio)
-        new_h = int(img_h * scale_ratio)
-        img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        left = (new_w - target_w) // 2
-        right = left + target_w
-        top = (new_h - target_h) // 2
-        bottom = top + target_h
-        img = img.crop((left, top, right, bottom))
-    else:
-        img = Image.new('RGB', (W, H), color = (0, 0, 0))
-
-    draw = ImageDraw.Draw(img)
-    overlay = Image.new('RGBA', (W, H), (0, 0, 0, 128))
-    img.paste(overlay, (0, 0), overlay)
+        if img.format == 'JPEG' and scale_ratio < 1:
+            img.draft('RGB', (math.ceil(img_w * scale_ratio), math.ceil(img_h * scale_ratio)))
+        return fit_cover(img, target_w, target_h)
+
+# --- CACHE ẢNH NỀN ĐÃ CẮT SẴN (TRÊN ĐĨA, KHÓA THEO NGUỒN + ID ẢNH, LRU THEO DUNG LƯỢNG) ---
+_bg_cache_lock = threading.Lock()
+_bg_cache_index = None # OrderedDict: tên file -> số byte, phần tử cũ nhất (ít dùng nhất) ở đầu
+_bg_cache_bytes = 0
+
+def _bg_cache_filename(provider, photo_id):
+    digest = hashlib.sha1(f"{provider}:{photo_id}:{CANVAS_WIDTH}x{CANVAS_HEIGHT}".encode('utf-8')).hexdigest()
+    return f"{provider}_{digest[:24]}.jpg"
+
+def _bg_cache_load_index():
+    # Quét thư mục cache MỘT lần, sắp xếp theo mtime để khôi phục thứ tự LRU sau khi khởi động lại
+    global _bg_cache_index, _bg_cache_bytes
+    if _bg_cache_index is None:
+        os.makedirs(BG_CACHE_DIR, exist_ok=True)
+        entries = []
+        for name in os.listdir(BG_CACHE_DIR):
+            if not name.endswith('.jpg'):
+                continue
+            try:
+                stat = os.stat(os.path.join(BG_CACHE_DIR, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        entries.sort()
+        _bg_cache_index = OrderedDict((name, size) for _, name, size in entries)
+        _bg_cache_bytes = sum(_bg_cache_index.values())
+    return _bg_cache_index
+
+def _bg_cache_open(name):
+    path = os.path.join(BG_CACHE_DIR, name)
+    try:
+        img = Image.open(path)
+        img.load()
+        os.utime(path, None) # Cập nhật mtime để giữ thứ tự LRU qua các lần khởi động
+        return img.convert('RGB')
+    except (OSError, ValueError) as e:
+        print(f"  - Cảnh báo: File cache ảnh nền hỏng ({name}): {e}. Loại bỏ khỏi cache.")
+        _bg_cache_discard(name)
+        return None
 
-    # 3B: CHÈN CHỮ
+def _bg_cache_discard(name):
+    global _bg_cache_bytes
+    with _bg_cache_lock:
+        size = _bg_cache_load_index().pop(name, None)
+        if size is not None:
+            _bg_cache_bytes -= size
     try:
-        font_size = 72
-        font = ImageFont.truetype(FONT_PATH, font_size)
-    except IOError:
-        font = ImageFont.load_default()
+        os.remove(os.path.join(BG_CACHE_DIR, name))
+    except OSError:
+        pass
 
-    MAX_TEXT_WIDTH = W - 240
-    wrapped_lines = text_wrap(text_to_overlay, font, MAX_TEXT_WIDTH)
+def bg_cache_get(provider, photo_id):
+    """Trả về ảnh nền 1080x1920 đã cắt sẵn nếu (provider, photo_id) có trong cache, ngược lại None."""
+    if BG_CACHE_MAX_BYTES <= 0:
+        return None
+    name = _bg_cache_filename(provider, photo_id)
+    with _bg_cache_lock:
+        index = _bg_cache_load_index()
+        if name not in index:
+            return None
+        index.move_to_end(name)
+    img = _bg_cache_open(name)
+    if img is not None:
+        img.info['bg_cache'] = [provider, str(photo_id)]
+    return img
 
-    # =======================================================
-    # *** KHỐI SỬA CHỮA CĂN GIỮA DỌC ***
-    # =======================================================
-    # 1. Tính toán tổng chiều cao của khối văn bản
-    total_text_height = 0
-    line_spacing = 15
+def bg_cache_load(provider, photo_id):
+    """
+    Mở lại ảnh nền theo nguồn đã ghi trong img.info['bg_cache'] (checkpoint của job dùng để không phải lưu bản sao).
+    provider 'cache' là ảnh lấy ngẫu nhiên từ cache (bg_cache_random), photo_id khi đó là tên file. None nếu đã bị loại.
+    """
+    if provider != 'cache':
+        return bg_cache_get(provider, photo_id)
+    with _bg_cache_lock:
+        index = _bg_cache_load_index()
+        if photo_id not in index:
+            return None
+        index.move_to_end(photo_id)
+    img = _bg_cache_open(photo_id)
+    if img is not None:
+        img.info['bg_cache'] = ['cache', photo_id]
+    return img
 
-    # Phải tính toán chiều cao từng dòng một cách chính xác
-    for line in wrapped_lines:
-        if not line: continue
+def bg_cache_put(provider, photo_id, img):
+    """
+    Lưu ảnh nền đã cắt vào cache rồi loại bỏ các ảnh ít dùng nhất cho tới khi dưới ngân sách byte.
+    Ảnh được đánh dấu nguồn (img.info['bg_cache']) khi lưu thành công.
+    """
+    global _bg_cache_bytes
+    if BG_CACHE_MAX_BYTES <= 0:
+        return
+    name = _bg_cache_filename(provider, photo_id)
+    path = os.path.join(BG_CACHE_DIR, name)
+    try:
+        with _bg_cache_lock:
+            _bg_cache_load_index()
+        # Ghi ra file tạm rồi đổi tên để không bao giờ để lại file cache ghi dở
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
         try:
-            text_bbox = draw.textbbox((0, 0), line, font=font)
-            line_height = text_bbox[3] - text_bbox[1]
-            total_text_height += line_height + line_spacing
-        except Exception:
-            # Fallback nếu lỗi tính toán BB
-            total_text_height += font_size + 20
+            img.save(tmp_path, format='JPEG', quality=BG_CACHE_JPEG_QUALITY)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path): # Ghi/đổi tên lỗi (đĩa đầy...): không để lại file tạm
+                os.remove(tmp_path)
+        size = os.path.getsize(path)
+    except OSError as e:
+        print(f"  - Cảnh báo: Không thể ghi cache ảnh nền: {e}")
+        return
 
-    # Bỏ đi khoảng cách dòng thừa cuối cùng
-    if total_text_height > 0:
-        total_text_height -= line_spacing
+    evicted = []
+    with _bg_cache_lock:
+        index = _bg_cache_load_index()
+        _bg_cache_bytes -= index.pop(name, 0)
+        index[name] = size
+        _bg_cache_bytes += size
+        while _bg_cache_bytes > BG_CACHE_MAX_BYTES and len(index) > 1:
+            old_name, old_size = index.popitem(last=False)
+            _bg_cache_bytes -= old_size
+            evicted.append(old_name)
+    if name not in evicted:
+        img.info['bg_cache'] = [provider, str(photo_id)]
+
+    for old_name in evicted:
+        try:
+            os.remove(os.path.join(BG_CACHE_DIR, old_name))
+        except OSError:
+            pass
+
+def bg_cache_random():
+    """Chọn ngẫu nhiên một ảnh nền trong cache (chính sách dùng lại, không gọi mạng). None nếu cache quá nhỏ."""
+    if BG_CACHE_MAX_BYTES <= 0:
+        return None
+    with _bg_cache_lock:
+        index = _bg_cache_load_index()
+        if len(index) < max(1, BG_CACHE_MIN_ENTRIES):
+            return None
+        name = random.choice(list(index))
+        index.move_to_end(name)
+    img = _bg_cache_open(name)
+    if img is not None:
+        img.info['bg_cache'] = ['cache', name]
+    return img
+
+def prepare_downloaded_background(image_bytes, provider, photo_id):
+    """Giải mã ảnh vừa tải thẳng từ bộ nhớ (không file tạm), cắt về 1080x1920 và lưu vào cache."""
+    try:
+        img = decode_background(image_bytes)
+    except Exception as e:
+        print(f"  - Lỗi giải mã ảnh nền từ {provider}: {e}")
+        return None
+    bg_cache_put(provider, photo_id, img)
+    return img
+
+# --- BƯỚC 1 (I/O): LẤY ẢNH NỀN CHO SLIDE ---
+def count_background_source(provider, img, fallback=False):
+    """Đếm kết quả của một nguồn ảnh nền: success, failure, hoặc fallback (nguồn dự phòng lấy được ảnh)."""
+    outcome = 'failure' if img is None else ('fallback' if fallback else 'success')
+    count_metric('background_source_total', provider=provider, outcome=outcome)
+
+def fetch_background(drive_service, slide_index, theme):
+    """Trả về ảnh nền 1080x1920 (PIL Image) hoặc None nếu mọi nguồn đều thất bại."""
+    img = None
+
+    # CHÍNH SÁCH DÙNG LẠI: lấy ngẫu nhiên ảnh nền đã cắt sẵn trong cache (không gọi mạng)
+    if BG_CACHE_REUSE_RATIO > 0 and random.random() < BG_CACHE_REUSE_RATIO:
+        img = bg_cache_random()
+        if img is not None:
+            print("  - ♻️ Dùng lại ảnh nền có sẵn trong cache.")
+            count_background_source('cache', img)
+
+    # CHUỖI ƯU TIÊN TẢI ẢNH: PEXELS -> UNSPLASH -> GOOGLE DRIVE
+    # Các hàm tải trả về ảnh đã cắt sẵn 1080x1920 (lấy từ cache nếu ảnh đó đã từng được tải)
+    if img is None:
+        img = get_random_pexels_image(theme, slide_index)
+        count_background_source('pexels', img)
+    if img is None:
+        img = get_random_unsplash_image(theme, slide_index)
+        count_background_source('unsplash', img, fallback=True)
+    if img is None:
+        img = get_random_background_image(
+            drive_service,
+            BACKGROUND_IMAGES_FOLDER_ID,
+            slide_index
+        )
+        count_background_source('drive', img, fallback=True)
+    return img
+
+# --- BƯỚC 2 (CPU): VẼ CHỮ LÊN ẢNH NỀN VÀ MÃ HOÁ JPEG ---
+def render_slide(text_to_overlay, background=None):
+    """Trả về bytes JPEG của slide (thời gian các tầng vẽ được ghi vào số liệu của tiến trình này)."""
+    jpeg_bytes, timings = render_slide_timed(text_to_overlay, background)
+    observe_stages(timings)
+    return jpeg_bytes
+
+def render_slide_timed(text_to_overlay, background=None):
+    """
+    Hàm thuần CPU (không gọi mạng, không ghi file) nên chạy được trong process pool.
+    Trả về (bytes JPEG của slide, {tầng: giây}); số liệu đo trong process con được trả về để tiến trình chính ghi lại.
+    """
+    render_start = time.perf_counter()
+    img = prepare_canvas(background)
+    overlay_start = time.perf_counter()
+    apply_dark_overlay(img)
 
-    # 2. Đặt điểm bắt đầu Y tại trung tâm khung hình
+    # 3B: CHÈN CHỮ
+    layout_start = time.perf_counter()
+    layout = compute_text_layout(text_to_overlay)
+    draw_start = time.perf_counter()
+    draw_text_layout(img, layout)
+
+    encode_start = time.perf_counter()
+    jpeg_bytes = encode_jpeg(img)
+    finished = time.perf_counter()
+    timings = {
+        'resize_crop': overlay_start - render_start,
+        'overlay': layout_start - overlay_start,
+        'text_layout': draw_start - layout_start,
+        'text_draw': encode_start - draw_start,
+        'jpeg_encode': finished - encode_start,
+        'render': finished - render_start,
+    }
+    return jpeg_bytes, timings
+
+# Các bước của render_slide_timed (tách riêng để đo và benchmark từng bước, xem bench_render.py)
+def prepare_canvas(background=None):
+    """Khung hình 1080x1920 từ ảnh nền (cắt cover nếu khác kích thước), hoặc nền đen nếu không có ảnh."""
+    W, H = CANVAS_WIDTH, CANVAS_HEIGHT
+    if background is None:
+        return Image.new('RGB', (W, H), color = (0, 0, 0))
+    if background.size != (W, H):
+        return fit_cover(background, W, H)
+    return background
+
+def apply_dark_overlay(img):
+    overlay = Image.new('RGBA', img.size, (0, 0, 0, 128))
+    img.paste(overlay, (0, 0), overlay)
+
+def compute_text_layout(text_to_overlay, line_spacing=15):
+    # Dàn trang MỘT lần (đo từng từ có cache), vòng vẽ không đo lại
+    if FONT_AUTO_FIT:
+        return fit_text_layout(text_to_overlay, TEXT_BOX_WIDTH, TEXT_BOX_HEIGHT, line_spacing=line_spacing)
+    return layout_text(text_to_overlay, get_font(FONT_SIZE), TEXT_BOX_WIDTH, line_spacing)
+
+def draw_text_layout(img, layout):
+    W, H = img.size
+    draw = ImageDraw.Draw(img)
+    font = layout.font
+
+    # =======================================================
+    # *** KHỐI SỬA CHỮA CĂN GIỮA DỌC ***
+    # =======================================================
+    # Đặt điểm bắt đầu Y sao cho khối văn bản nằm giữa khung hình
     y_start_center = (H // 2)
-    y_current = y_start_center - (total_text_height // 2)
+    y_block_top = y_start_center - (layout.total_height // 2)
     # =======================================================
 
-    for line in wrapped_lines:
-        if not line: continue
-
-        # Tính toán Bounding Box cho căn giữa ngang và nền
-        try:
-            text_bbox = draw.textbbox((0, 0), line, font=font)
-            textwidth = text_bbox[2] - text_bbox[0]
-            textheight = text_bbox[3] - text_bbox[1] # Chiều cao dòng
-        except Exception:
-            textwidth = font.getlength(line) if hasattr(font, 'getlength') else 500
-            textheight = font_size + 5 # Chiều cao dòng (Fallback)
+    for line in layout.lines:
+        textwidth = line['width']
+        textheight = line['height']
+        y_current = y_block_top + line['y_offset']
 
         # Căn giữa theo chiều ngang
         x = (W - textwidth) // 2
@@ -188,18 +1032,162 @@ def create_image_with_text(text_to_overlay, drive_service, slide_index, theme):
         draw.rectangle([(x - 20, y_current - 10), (x + textwidth + 20, y_current + textheight + 10)], fill=(0, 0, 0, 128))
 
         # Vẽ chữ
-        draw.text((x, y_current), line, fill=(255, 255, 255), font=font)
+        draw.text((x, y_current), line['text'], fill=(255, 255, 255), font=font)
 
-        # Cập nhật vị trí Y cho dòng tiếp theo
-        y_current += textheight + 15 # Dùng chiều cao dòng thực tế + 15px
+def encode_jpeg(img, quality=85):
+    jpeg_buffer = BytesIO()
+    img.save(jpeg_buffer, format='JPEG', quality=quality)
+    return jpeg_buffer.getvalue()
 
+def package_slide(jpeg_bytes, slide_index, spill_dir=None):
+    """
+    Trả về BytesIO chứa JPEG của slide (thuộc tính .name là tên file). Nếu truyền spill_dir
+    (thư mục tạm của job) thì ghi ra file trong thư mục đó và trả về đường dẫn.
+    """
     filename_out = f"slide_{slide_index}_final.jpg"
-    img.save(filename_out, format='JPEG', quality=85)
+    if spill_dir:
+        file_path = os.path.join(spill_dir, filename_out)
+        with open(file_path, 'wb') as f:
+            f.write(jpeg_bytes)
+        return file_path
 
-    if temp_bg_path and os.path.exists(temp_bg_path):
-        os.remove(temp_bg_path)
+    jpeg_buffer = BytesIO(jpeg_bytes)
+    jpeg_buffer.name = filename_out
+    return jpeg_buffer
+
+# --- HÀM TẠO ẢNH NỀN VÀ CHÈN CHỮ (PILLOW) ---
+def create_image_with_text(text_to_overlay, drive_service, slide_index, theme, spill_dir=None):
+    """Tải nền + vẽ chữ cho một slide (tuần tự). Xem package_slide() cho kiểu trả về."""
+    background = fetch_background(drive_service, slide_index, theme)
+    return package_slide(render_slide(text_to_overlay, background), slide_index, spill_dir)
+
+# --- UPLOAD GOOGLE DRIVE: THỬ LẠI KHI LỖI TẠM THỜI, MULTIPART/RESUMABLE THEO DUNG LƯỢNG ---
+# 5xx/429 và 403 do vượt rate limit được thử lại theo cùng chính sách backoff + jitter của HTTP.
+# Response của Drive chỉ lấy id + alternateLink thay vì toàn bộ metadata của file.
+# Thao tác TẠO (thư mục, file) không idempotent: file được tạo với id cấp trước (files.generateIds, lấy theo lô)
+# để sau một lỗi không rõ kết quả có thể kiểm tra file đã tồn tại chưa trước khi tạo lại.
+DRIVE_RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+DRIVE_UPLOAD_FIELDS = 'id,alternateLink'
+DRIVE_ID_BATCH = 100
+DRIVE_ID_RETRY_SECONDS = 300 # generateIds lỗi thì tạm tạo file không có id định trước trong khoảng này
+_drive_id_pool = []
+_drive_id_lock = threading.Lock()
+_drive_id_unavailable_until = 0.0
+
+def _drive_media_body(content, mimetype):
+    """
+    Upload() của pydrive2 luôn đi kiểu resumable (1 request khởi tạo + 1 request gửi dữ liệu).
+    Slide nhỏ hơn DRIVE_RESUMABLE_THRESHOLD đi multipart một request; file lớn hơn mới dùng resumable theo chunk.
+    """
+    content.seek(0, os.SEEK_END)
+    size = content.tell()
+    content.seek(0)
+    return MediaIoBaseUpload(
+        content,
+        mimetype or 'application/octet-stream',
+        chunksize=DRIVE_UPLOAD_CHUNK_SIZE,
+        resumable=size >= DRIVE_RESUMABLE_THRESHOLD
+    )
+
+def _drive_retry_delay(error, attempt):
+    """Thời gian chờ trước khi thử lại một lời gọi Drive, hoặc None nếu lỗi không nên thử lại."""
+    if isinstance(error, ApiRequestError):
+        status_code = error.error.get('code')
+        if status_code == 403 and error.GetField('reason') in DRIVE_RATE_LIMIT_REASONS:
+            return retry_delay(attempt)
+        if status_code not in HTTP_RETRY_STATUSES:
+            return None
+        return retry_delay(attempt, status_code)
+    if isinstance(error, (OSError, httplib2.HttpLib2Error)):
+        # Lỗi kết nối/timeout (socket, SSL, httplib2)
+        return retry_delay(attempt)
+    return None
+
+def drive_call_with_retry(action, description):
+    """Gọi action() (một thao tác Drive), thử lại tối đa HTTP_MAX_RETRIES lần khi gặp lỗi tạm thời."""
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            return action()
+        except Exception as e:
+            delay = None if attempt == HTTP_MAX_RETRIES else _drive_retry_delay(e, attempt)
+            if delay is None:
+                raise
+            print(f"  - Drive: {description} lỗi tạm thời ({e}). Thử lại sau {delay:.1f}s.")
+            time.sleep(delay)
+
+def allocate_drive_id(drive_service):
+    """Một file id cấp trước cho thao tác tạo file/thư mục, hoặc None nếu Drive không cấp được."""
+    global _drive_id_unavailable_until
+    with _drive_id_lock:
+        if not _drive_id_pool and time.time() >= _drive_id_unavailable_until:
+            try:
+                request = drive_service.auth.service.files().generateIds(maxResults=DRIVE_ID_BATCH, space='drive')
+                _drive_id_pool.extend(request.execute(http=drive_service.auth.Get_Http_Object()).get('ids', []))
+            except Exception as e:
+                print(f"  - Drive: không lấy được id cấp trước ({e}). Lỗi không rõ kết quả khi tạo file sẽ không được thử lại.")
+                _drive_id_unavailable_until = time.time() + DRIVE_ID_RETRY_SECONDS
+        return _drive_id_pool.pop() if _drive_id_pool else None
+
+def drive_insert(drive_service, metadata, content=None, fields='id'):
+    """
+    files.insert cho file mới qua Drive API (như allocate_drive_id), trả về metadata `fields` của file đã tạo.
+    Upload() của pydrive2 coi file đã có 'id' (id cấp trước) là file cũ và gọi update.
+    Lỗi HTTP được gói thành ApiRequestError như các thao tác pydrive2 khác (cùng chính sách thử lại).
+    """
+    request = drive_service.auth.service.files().insert(
+        body=metadata,
+        media_body=_drive_media_body(content, metadata.get('mimeType')) if content is not None else None,
+        fields=fields,
+        supportsAllDrives=True
+    )
+    try:
+        return request.execute(http=drive_service.auth.Get_Http_Object())
+    except HttpError as error:
+        raise ApiRequestError(error)
+
+def _drive_request_not_sent(error):
+    """True nếu chắc chắn Drive chưa tạo gì: không kết nối được, hoặc bị từ chối vì rate limit (429/403)."""
+    if isinstance(error, ApiRequestError):
+        status_code = error.error.get('code')
+        return status_code == 429 or (status_code == 403 and error.GetField('reason') in DRIVE_RATE_LIMIT_REASONS)
+    return isinstance(error, (ConnectionRefusedError, socket.gaierror, httplib2.ServerNotFoundError))
+
+def drive_find_file(drive_service, file_id, fields='id'):
+    """GoogleDriveFile đã có metadata `fields`, hoặc None nếu file id chưa tồn tại."""
+    drive_file = drive_service.CreateFile({'id': file_id})
+    try:
+        drive_file.FetchMetadata(fields=fields)
+    except ApiRequestError as e:
+        if e.error.get('code') == 404:
+            return None
+        raise
+    return drive_file
 
-    return filename_out
+def drive_create_with_retry(drive_service, file_id, action, description, fields='id'):
+    """
+    Như drive_call_with_retry() cho thao tác tạo file/thư mục id `file_id`: lỗi chắc chắn chưa tới Drive thì tạo lại
+    ngay; lỗi không rõ kết quả (timeout, mất kết nối, 5xx) thì tra file_id trước, đã có thì dùng luôn thay vì tạo
+    bản thứ hai. file_id None (không có id cấp trước) thì lỗi không rõ kết quả được ném ra, không thử lại.
+    """
+    check_existing = False
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            if check_existing:
+                existing = drive_find_file(drive_service, file_id, fields)
+                if existing is not None:
+                    print(f"  - Drive: {description} đã thành công ở lần gửi trước, không tạo lại.")
+                    return existing
+            return action()
+        except Exception as e:
+            delay = None if attempt == HTTP_MAX_RETRIES else _drive_retry_delay(e, attempt)
+            if delay is None:
+                raise
+            if not _drive_request_not_sent(e):
+                if file_id is None:
+                    raise
+                check_existing = True
+            print(f"  - Drive: {description} lỗi tạm thời ({e}). Thử lại sau {delay:.1f}s.")
+            time.sleep(delay)
 
 # Hàm Tạo thư mục và tải lên Drive (ví dụ)
 def create_drive_folder(folder_name, parent_folder_id, drive_service):
@@ -208,6 +1196,26 @@ def create_drive_folder(folder_name, parent_folder_id, drive_service):
     để đảm bảo tính duy nhất và tạo thư mục ngay lập tức.
     """
     try:
+        # 0. Job đang chạy tiếp từ checkpoint: dùng lại thư mục đã tạo ở lần chạy trước
+        checkpoint = current_checkpoint()
+        if checkpoint is not None and checkpoint.get('folder_id'):
+            print(f"  - Dùng lại thư mục đã lưu trong checkpoint. ID: {checkpoint.get('folder_id')}")
+            return checkpoint.get('folder_id')
+
+        # Đang chạy trong một job của hàng đợi: dùng lại thư mục đã tạo ở lần chạy trước của chính job đó
+        job = current_job()
+        if job:
+            folder_id = job.get('folder_id')
+            if not folder_id and job['attempts'] > 1:
+                folder_id = find_job_folder(drive_service, parent_folder_id, job['idempotency_key'])
+            if folder_id:
+                print(f"  - Dùng lại thư mục của job #{job['id']}. ID: {folder_id}")
+                job['folder_id'] = folder_id
+                set_job_folder(job['id'], folder_id)
+                if checkpoint is not None:
+                    checkpoint.set('folder_id', folder_id)
+                return folder_id
+
         # 1. Lấy timestamp chính xác (dạng số, bao gồm mili giây)
         # Ví dụ: 1733215914519
         timestamp_ms = int(time.time() * 1000)
@@ -224,9 +1232,25 @@ def create_drive_folder(folder_name, parent_folder_id, drive_service):
             'mimeType': 'application/vnd.google-apps.folder',
             'parents': [{'id': parent_folder_id}]
         }
-        folder = drive_service.CreateFile(folder_metadata)
-        folder.Upload()
-        print(f"  - Đã tạo thư mục mới duy nhất: '{unique_folder_name}'. ID: {folder['id']}")
+        if job:
+            folder_metadata['properties'] = [
+                {'key': JOB_FOLDER_PROPERTY, 'value': job['idempotency_key'], 'visibility': 'PRIVATE'}
+            ]
+        folder_id = allocate_drive_id(drive_service)
+        if folder_id:
+            folder_metadata['id'] = folder_id
+
+        def create_once():
+            return drive_insert(drive_service, folder_metadata)
+
+        with track_stage('drive_folder', provider='drive'):
+            folder = drive_create_with_retry(drive_service, folder_id, create_once, f"tạo thư mục '{unique_folder_name}'")
+        print(f"  - Đã tạo thư mục mới duy nhất: '{unique_folder_name}'. ID: {folder['id']}")
+        if job:
+            job['folder_id'] = folder['id']
+            set_job_folder(job['id'], folder['id'])
+        if checkpoint is not None:
+            checkpoint.set('folder_id', folder['id'])
         return folder['id']
 
     except Exception as e:
@@ -234,69 +1258,224 @@ def create_drive_folder(folder_name, parent_folder_id, drive_service):
         return None
 
 # --- HÀM TẢI ẢNH LÊN GOOGLE DRIVE ---
-# (Giữ nguyên như kịch bản trước)
-def upload_to_drive(file_path, drive_service, folder_id):
+# file_or_buffer: đường dẫn file hoặc BytesIO (slide trong bộ nhớ, tên lấy từ thuộc tính .name)
+def upload_file_to_drive(file_or_buffer, drive_service, folder_id):
+    """Như upload_to_drive() nhưng trả về {'id', 'link'} của file đã tải lên (None nếu lỗi)."""
+    if isinstance(file_or_buffer, str):
+        title = os.path.basename(file_or_buffer)
+    else:
+        title = getattr(file_or_buffer, 'name', 'slide.jpg')
+
+    file_metadata = {'title': title, 'mimeType': 'image/jpeg', 'parents': [{'id': folder_id}]}
+
+    def upload_once():
+        with contextlib.ExitStack() as stack:
+            if isinstance(file_or_buffer, str):
+                content = stack.enter_context(open(file_or_buffer, 'rb'))
+            else:
+                content = file_or_buffer
+            return drive_insert(drive_service, file_metadata, content, DRIVE_UPLOAD_FIELDS)
+
     try:
-        file_metadata = {'title': os.path.basename(file_path), 'parents': [{'id': folder_id}]}
-        uploaded_file = drive_service.CreateFile(file_metadata)
-        uploaded_file.SetContentFile(file_path)
-        uploaded_file.Upload()
-        print(f"  - Đã tải '{os.path.basename(file_path)}' lên Google Drive.")
-        return uploaded_file['alternateLink']
+        file_id = allocate_drive_id(drive_service)
+        if file_id:
+            file_metadata['id'] = file_id
+        with track_stage('drive_upload', provider='drive'):
+            uploaded_file = drive_create_with_retry(drive_service, file_id, upload_once, f"tải '{title}'", DRIVE_UPLOAD_FIELDS)
+        uploaded = {'id': uploaded_file['id'], 'link': uploaded_file['alternateLink']}
+        size = os.path.getsize(file_or_buffer) if isinstance(file_or_buffer, str) else file_or_buffer.getbuffer().nbytes
+        count_metric('bytes_total', size, provider='drive', direction='upload')
+        print(f"  - Đã tải '{title}' lên Google Drive.")
+        return uploaded
     except Exception as e:
         print(f"Lỗi khi tải lên Google Drive: {e}")
         return None
 
-# --- HÀM GỬI THÔNG BÁO KẾT QUẢ ĐẾN TELEGRAM ---
-def send_telegram_notification(text_message, image_urls=None):
-    # Kiểm tra cờ bật/tắt
-    if not ENABLE_TELEGRAM_NOTIFICATIONS:
-        print("⚠️ Thông báo Telegram đã bị tắt (ENABLE_TELEGRAM_NOTIFICATIONS = False). Bỏ qua.")
-        return
+def upload_to_drive(file_or_buffer, drive_service, folder_id):
+    uploaded = upload_file_to_drive(file_or_buffer, drive_service, folder_id)
+    return uploaded['link'] if uploaded else None
 
-    print("\n--- Đang gửi thông báo kết quả đến Telegram ---")
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+def upload_slide_to_drive(final_image, drive_service, folder_id, slide_index, checkpoint=None):
+    """Upload một slide (slide_index tính từ 0); file đã upload được ghi vào checkpoint của job nếu có."""
+    uploaded = upload_file_to_drive(final_image, drive_service, folder_id)
+    if uploaded is None:
+        return None
+    if checkpoint is not None:
+        checkpoint.record_upload(slide_index, uploaded['id'], uploaded['link'])
+    return uploaded['link']
 
+# --- HÀM GỬI THÔNG BÁO KẾT QUẢ ĐẾN TELEGRAM ---
+def _telegram_text_payloads(text_message, image_urls=None):
+    """Payload tin nhắn chính và (nếu có) tin nhắn thứ hai chứa link ảnh."""
     # Payload cho tin nhắn chính
     payload = {
         'chat_id': TELEGRAM_CHAT_ID,
         'text': text_message,
         'parse_mode': 'HTML'
     }
-
-    try:
-        # Gửi tin nhắn chính
-        response = requests.post(url, data=payload)
-
-        if response.status_code == 200:
-            print("Đã gửi tin nhắn thông báo thành công!")
-        else:
-            print(f"Lỗi Telegram (gửi tin nhắn): {response.status_code} - {response.text}") # IN CHI TIẾT LỖI
-
-        # Gửi link ảnh nếu có
-        if image_urls:
-            img_message = "<b>Ảnh đã lưu trên Drive (tải xuống để đăng):</b>\n" + "\n".join(image_urls)
-            payload_img = {
-                'chat_id': TELEGRAM_CHAT_ID,
-                'text': img_message,
-                'parse_mode': 'HTML'
-            }
-            # Gửi tin nhắn thứ hai chứa link ảnh
-            requests.post(url, data=payload_img)
-
-    except Exception as e:
-        print(f"Lỗi kết nối Telegram (notification): {e}")
+    payload_img = None
+    if image_urls:
+        img_message = "<b>Ảnh đã lưu trên Drive (tải xuống để đăng):</b>\n" + "\n".join(image_urls)
+        payload_img = {
+            'chat_id': TELEGRAM_CHAT_ID,
+            'text': img_message,
+            'parse_mode': 'HTML'
+        }
+    return payload, payload_img
+
+# --- GỬI SLIDE ĐÃ VẼ THÀNH ALBUM TELEGRAM (sendMediaGroup) ---
+# Slide được gửi thẳng từ JPEG trong bộ nhớ: mỗi album tối đa 10 ảnh, caption gắn vào ảnh đầu tiên.
+TELEGRAM_MEDIA_GROUP_MAX = 10
+TELEGRAM_CAPTION_MAX = 1024 # Giới hạn caption của ảnh (tin nhắn thường là 4096)
+
+def telegram_preview_jpeg(jpeg_bytes):
+    """Bản thu nhỏ của slide (cạnh dài TELEGRAM_PREVIEW_MAX_SIDE) cho album; giữ nguyên nếu không cấu hình."""
+    if TELEGRAM_PREVIEW_MAX_SIDE <= 0:
+        return jpeg_bytes
+    img = Image.open(BytesIO(jpeg_bytes))
+    if max(img.size) <= TELEGRAM_PREVIEW_MAX_SIDE:
+        return jpeg_bytes
+    img.draft('RGB', (TELEGRAM_PREVIEW_MAX_SIDE, TELEGRAM_PREVIEW_MAX_SIDE))
+    img.thumbnail((TELEGRAM_PREVIEW_MAX_SIDE, TELEGRAM_PREVIEW_MAX_SIDE), Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=TELEGRAM_PREVIEW_QUALITY)
+    return buffer.getvalue()
+
+def _telegram_album_requests(text_message, slide_images):
+    """
+    Danh sách (method, data, files) cần gửi cho một album.
+    Caption quá dài cho ảnh thì gửi riêng bằng sendMessage trước album.
+    """
+    requests_to_send = []
+    caption = text_message
+    if len(text_message) > TELEGRAM_CAPTION_MAX:
+        payload, _ = _telegram_text_payloads(text_message)
+        requests_to_send.append(('sendMessage', payload, None))
+        caption = None
+
+    for start in range(0, len(slide_images), TELEGRAM_MEDIA_GROUP_MAX):
+        chunk = slide_images[start:start + TELEGRAM_MEDIA_GROUP_MAX]
+        files = {
+            f"slide{start + i + 1}": (f"slide_{start + i + 1}.jpg", telegram_preview_jpeg(jpeg_bytes), 'image/jpeg')
+            for i, jpeg_bytes in enumerate(chunk)
+        }
+        if len(chunk) == 1:
+            # sendMediaGroup cần từ 2 ảnh trở lên
+            (name, photo), = files.items()
+            data = {'chat_id': TELEGRAM_CHAT_ID}
+            if caption and start == 0:
+                data.update({'caption': caption, 'parse_mode': 'HTML'})
+            requests_to_send.append(('sendPhoto', data, {'photo': photo}))
+            continue
+        media = [{'type': 'photo', 'media': f"attach://{name}"} for name in files]
+        if caption and start == 0:
+            media[0].update({'caption': caption, 'parse_mode': 'HTML'})
+        data = {'chat_id': TELEGRAM_CHAT_ID, 'media': json.dumps(media, ensure_ascii=False)}
+        requests_to_send.append(('sendMediaGroup', data, files))
+    return requests_to_send
+
+def send_telegram_notification(text_message, image_urls=None, slide_images=None, album_start=0, on_album_progress=None):
+    """Mặt tiền đồng bộ của async_send_telegram_notification (khối mạng bất đồng bộ) cho các call site hiện có."""
+    return run_async(async_send_telegram_notification(
+        text_message, image_urls, slide_images=slide_images, album_start=album_start, on_album_progress=on_album_progress
+    ))
 
 # ==========================================================
 # --- KHỐI HÀM AI ĐIỀU PHỐI ---
 # ==========================================================
 
+# --- CHỈ MỤC CỤC BỘ CỦA THƯ MỤC ẢNH NỀN TRÊN DRIVE ---
+# Lưu (id, title, size, md5, mime) của mọi ảnh trong thư mục ra file JSON, dùng lại qua các lần khởi động.
+# Khi quá TTL, chỉ mục được làm mới ở thread nền (listing chỉ lấy đúng các trường cần) trong khi
+# các slide vẫn chọn ảnh từ chỉ mục cũ -> chọn ảnh nền không tốn lời gọi API nào.
+DRIVE_INDEX_FIELDS = "items(id,title,fileSize,md5Checksum,mimeType),nextPageToken"
+_drive_index = None
+_drive_index_lock = threading.Lock()
+_drive_index_refreshing = False
+
+def _load_drive_index_file():
+    try:
+        with open(DRIVE_BG_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_drive_index_file(index):
+    tmp_path = f"{DRIVE_BG_INDEX_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, DRIVE_BG_INDEX_FILE)
+    except OSError as e:
+        print(f"  - Cảnh báo: Không thể lưu chỉ mục ảnh nền Drive: {e}")
+
+def refresh_drive_background_index(drive_service, folder_id):
+    """Liệt kê lại thư mục ảnh nền (chỉ lấy các trường cần thiết, 1000 file/trang) và lưu chỉ mục."""
+    query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false"
+    with track_stage('drive_list', provider='drive'):
+        file_list = drive_service.ListFile({'q': query, 'fields': DRIVE_INDEX_FIELDS, 'maxResults': 1000}).GetList()
+    files = [
+        {
+            'id': f['id'],
+            'title': f.get('title'),
+            'size': int(f['fileSize']) if f.get('fileSize') else None,
+            'md5': f.get('md5Checksum'),
+            'mime': f.get('mimeType')
+        }
+        for f in file_list
+    ]
+    index = {'folder_id': folder_id, 'refreshed_at': time.time(), 'files': files}
+    global _drive_index
+    with _drive_index_lock:
+        _drive_index = index
+    _save_drive_index_file(index)
+    print(f"  - Đã làm mới chỉ mục ảnh nền Drive: {len(files)} ảnh.")
+    return index
+
+def _refresh_drive_index_in_background(drive_service, folder_id):
+    global _drive_index_refreshing
+    try:
+        refresh_drive_background_index(drive_service, folder_id)
+    except Exception as e:
+        print(f"  - Cảnh báo: Làm mới chỉ mục ảnh nền Drive thất bại: {e}. Tiếp tục dùng chỉ mục cũ.")
+    finally:
+        with _drive_index_lock:
+            _drive_index_refreshing = False
+
+def get_drive_background_index(drive_service, folder_id):
+    """Danh sách ảnh nền trong thư mục. Chỉ liệt kê đồng bộ khi chưa từng có chỉ mục cho thư mục này."""
+    global _drive_index, _drive_index_refreshing
+    with _drive_index_lock:
+        if _drive_index is None:
+            _drive_index = _load_drive_index_file()
+        index = _drive_index if _drive_index and _drive_index.get('folder_id') == folder_id else None
+        start_refresh = (
+            index is not None
+            and time.time() - index.get('refreshed_at', 0) >= DRIVE_BG_INDEX_TTL_SECONDS
+            and not _drive_index_refreshing
+        )
+        if start_refresh:
+            _drive_index_refreshing = True
+
+    if index is None:
+        index = refresh_drive_background_index(drive_service, folder_id)
+    elif start_refresh:
+        threading.Thread(
+            target=_refresh_drive_index_in_background, args=(drive_service, folder_id), daemon=True
+        ).start()
+    return index['files']
+
+def _drop_from_drive_index(file_id):
+    # File đã bị xoá (404): bỏ khỏi chỉ mục trong bộ nhớ (lần làm mới sau sẽ ghi lại file)
+    with _drive_index_lock:
+        if _drive_index:
+            _drive_index['files'] = [f for f in _drive_index['files'] if f['id'] != file_id]
+
 # --- HÀM TẢI ẢNH NỀN NGẪU NHIÊN TỪ DRIVE ---
 def get_random_background_image(drive_service, folder_id, slide_index):
     try:
-        # Lấy danh sách tất cả các file trong thư mục ảnh nền
-        query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false"
-        file_list = drive_service.ListFile({'q': query}).GetList()
+        # Lấy danh sách ảnh từ chỉ mục cục bộ (không gọi API khi chỉ mục còn dùng được)
+        file_list = get_drive_background_index(drive_service, folder_id)
 
         if not file_list:
             print("  - Cảnh báo: Thư mục ảnh nền trống hoặc không có ảnh. Sử dụng nền đen.")
@@ -305,69 +1484,265 @@ def get_random_background_image(drive_service, folder_id, slide_index):
         # Chọn ngẫu nhiên một file
         random_file = random.choice(file_list)
 
-        # Tải file xuống
-        temp_filename = f"temp_bg_{slide_index}.jpg"
-        random_file.GetContentFile(temp_filename)
+        cached_img = bg_cache_get('drive', random_file['id'])
+        if cached_img is not None:
+            print(f"  - ♻️ Ảnh nền Drive '{random_file['title']}' đã có trong cache, bỏ qua tải xuống.")
+            return cached_img
 
-        print(f"  - Đã tải ảnh nền ngẫu nhiên: {random_file['title']}")
-        return temp_filename
+        # Tải file xuống thẳng vào bộ nhớ theo id (files.get_media, không cần lấy lại metadata).
+        # Lỗi tạm thời được thử lại; chỉ file không còn tồn tại (404) mới bị bỏ khỏi chỉ mục.
+        def download_once():
+            drive_file = drive_service.CreateFile({'id': random_file['id']})
+            return b"".join(drive_file.GetContentIOBuffer())
+
+        try:
+            with track_stage('drive_download', provider='drive'):
+                image_bytes = drive_call_with_retry(download_once, f"tải ảnh nền '{random_file['title']}'")
+            count_metric('bytes_total', len(image_bytes), provider='drive', direction='download')
+        except ApiRequestError as e:
+            if e.error.get('code') == 404:
+                _drop_from_drive_index(random_file['id'])
+            raise
+
+        print(f"  - Đã tải ảnh nền ngẫu nhiên: {random_file['title']}")
+        return prepare_downloaded_background(image_bytes, 'drive', random_file['id'])
 
     except Exception as e:
         print(f"Lỗi khi tải ảnh nền từ Drive: {e}")
         return None
 
-# --- HÀM TẢI ẢNH NGẪU NHIÊN TỪ PEXELS (Ưu tiên 1) ---
-def get_random_pexels_image(query, slide_index):
-    if not PEXELS_API_KEY or PEXELS_API_KEY == "YOUR_PEXELS_API_KEY":
-        print("  - Cảnh báo: PEXELS_API_KEY chưa được cấu hình. Bỏ qua Pexels.")
-        return None
-
-    # DANH SÁCH CHỦ ĐỀ CỐ ĐỊNH (theo yêu cầu của người dùng)
-    THEME_KEYWORDS = [
-        "rain", "snow", "forest", "mountain", "sea beach",
-        "sunset", "sunrise", "old books", "potted plant indoor"
-    ]
-
-    # CHỌN CHỦ ĐỀ NGẪU NHIÊN TỪ DANH SÁCH
-    random_theme = random.choice(THEME_KEYWORDS)
-    print(f"  - Đang thử lấy ảnh nền từ Pexels theo chủ đề ngẫu nhiên: '{random_theme}'")
+# DANH SÁCH CHỦ ĐỀ ẢNH NỀN CỐ ĐỊNH (theo yêu cầu của người dùng), dùng chung cho Pexels/Unsplash
+BACKGROUND_THEME_KEYWORDS = [
+    "rain", "snow", "forest", "mountain", "sea beach",
+    "sunset", "sunrise", "old books", "potted plant indoor"
+]
+
+# --- CHỌN RENDITION NHỎ NHẤT VẪN PHỦ KÍN KHUNG HÌNH SAU KHI CẮT COVER ---
+# Các rendition cố định của Pexels dạng "vừa trong khung" (w, h tối đa); rendition dạng crop không dùng vì đổi bố cục
+PEXELS_FIT_RENDITIONS = [('large', 940, 650), ('large2x', 1880, 1300)]
+# Unsplash 'regular' luôn rộng 1080px
+UNSPLASH_FIXED_WIDTH_RENDITIONS = [('regular', 1080)]
+
+def _with_query(url, **params):
+    """Thêm/ghi đè tham số query vào URL (Pexels và Unsplash đều hỗ trợ w/h/fit kiểu imgix)."""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.update({k: str(v) for k, v in params.items()})
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+def _cover_source_size(src_w, src_h, target_w=CANVAS_WIDTH, target_h=CANVAS_HEIGHT):
+    """Kích thước (w, h) tối thiểu của ảnh nguồn (giữ tỉ lệ) để cắt cover ra đúng target_w x target_h."""
+    scale = max(target_w / src_w, target_h / src_h)
+    return math.ceil(src_w * scale), math.ceil(src_h * scale)
+
+def pexels_rendition_candidates(photo):
+    """
+    Danh sách URL theo thứ tự từ nhỏ đến lớn: rendition cố định đủ phủ khung (nếu có),
+    rồi URL co giãn theo đúng cạnh cần thiết, cuối cùng là 'original'.
+    """
+    src = photo.get('src', {})
+    original = src.get('original')
+    src_w, src_h = photo.get('width'), photo.get('height')
+    if not original:
+        return []
+    if not src_w or not src_h:
+        # Thiếu kích thước gốc: xin ảnh đã cắt sẵn đúng khung từ CDN, dự phòng bằng ảnh gốc
+        return [_with_query(original, auto='compress', cs='tinysrgb', fit='crop', w=CANVAS_WIDTH, h=CANVAS_HEIGHT), original]
+
+    need_w, need_h = _cover_source_size(src_w, src_h)
+    if need_w >= src_w:
+        # Ảnh gốc đã nhỏ hơn (hoặc bằng) mức cần thiết, không có gì nhỏ hơn để tải
+        return [original]
+
+    candidates = []
+    for name, box_w, box_h in PEXELS_FIT_RENDITIONS:
+        scale = min(1, box_w / src_w, box_h / src_h)
+        if name in src and src_w * scale >= need_w and src_h * scale >= need_h:
+            candidates.append(src[name])
+            break
+    # Chỉ ràng buộc cạnh quyết định tỉ lệ cover; cạnh còn lại sẽ được cắt ở fit_cover
+    if need_w * CANVAS_HEIGHT >= need_h * CANVAS_WIDTH:
+        candidates.append(_with_query(original, auto='compress', cs='tinysrgb', h=need_h))
+    else:
+        candidates.append(_with_query(original, auto='compress', cs='tinysrgb', w=need_w))
+    candidates.append(original)
+    return candidates
+
+def unsplash_rendition_candidates(photo):
+    """Tương tự Pexels: 'regular' nếu đủ phủ, rồi 'raw' co giãn theo cạnh cần thiết, cuối cùng 'full'."""
+    urls = photo.get('urls', {})
+    src_w, src_h = photo.get('width'), photo.get('height')
+    candidates = []
+    if src_w and src_h:
+        need_w, need_h = _cover_source_size(src_w, src_h)
+        if need_w < src_w:
+            for name, fixed_w in UNSPLASH_FIXED_WIDTH_RENDITIONS:
+                if name in urls and fixed_w >= need_w:
+                    candidates.append(urls[name])
+                    break
+            if 'raw' in urls:
+                candidates.append(_with_query(urls['raw'], w=need_w, fit='max', q=85, fm='jpg'))
+    if 'full' in urls:
+        candidates.append(urls['full'])
+    return candidates
+
+def download_rendition(candidates, provider_name):
+    """
+    Tải lần lượt các URL ứng viên (nhỏ trước), chỉ chuyển sang rendition lớn hơn khi rendition nhỏ lỗi.
+    Trả về response cuối cùng (có thể khác 200) hoặc None nếu không có ứng viên.
+    """
+    response = None
+    for position, image_url in enumerate(candidates):
+        is_last = position == len(candidates) - 1
+        try:
+            response = http_get(
+                image_url, allow_redirects=True, timeout=15, metric_labels=('image_download', provider_name.lower())
+            )
+        except requests.exceptions.RequestException as e:
+            if is_last:
+                raise
+            print(f"  - {provider_name}: Lỗi tải rendition ({e}), thử kích thước lớn hơn.")
+            continue
+        if response.status_code == 200 or is_last:
+            return response
+        print(f"  - {provider_name}: Rendition trả về status {response.status_code}, thử kích thước lớn hơn.")
+    return response
+
+# --- CACHE KẾT QUẢ TÌM KIẾM PEXELS (TTL + XOAY VÒNG TRANG) ---
+# Mỗi từ khoá giữ: 'photos' (kho ảnh đã gộp qua nhiều trang), 'fetched_at', 'next_page', 'total_results',
+# và 'failed_at' khi lần làm mới gần nhất lỗi (không gọi lại Search trước PEXELS_SEARCH_RETRY_SECONDS)
+_pexels_search_cache = {}
+_pexels_search_lock = threading.Lock()
+# Khoá làm mới theo từ khoá: nhiều slide cùng lúc hết hạn TTL chỉ gọi Search một lần
+_pexels_refresh_locks = {}
+
+def _pexels_refresh_lock(random_theme):
+    with _pexels_search_lock:
+        return _pexels_refresh_locks.setdefault(random_theme, threading.Lock())
+
+def _pexels_pool_lookup(random_theme):
+    """Trả về (kho còn hạn hoặc None, trang cần tải tiếp, kho cũ để dùng khi tải lỗi)."""
+    with _pexels_search_lock:
+        entry = _pexels_search_cache.get(random_theme)
+        if entry and entry['photos'] and time.time() - entry['fetched_at'] < PEXELS_SEARCH_TTL_SECONDS:
+            return entry['photos'], None, entry['photos']
+        if entry and time.time() - entry.get('failed_at', 0) < PEXELS_SEARCH_RETRY_SECONDS:
+            return entry['photos'], None, entry['photos'] # Vừa làm mới lỗi: dùng kho cũ (có thể rỗng)
+        page = entry['next_page'] if entry else 1
+        stale_photos = entry['photos'] if entry else []
+    return None, page, stale_photos
+
+def _pexels_search_request(random_theme, page):
     modified_query = f"{random_theme} natural aesthetic no people"
-
-    pexels_url = "https://api.pexels.com/v1/search"
+    pexels_url = f"{PEXELS_API_URL}/search"
     headers = { "Authorization": PEXELS_API_KEY }
     params = {
         'query': modified_query,
         'orientation': 'portrait',
         'size': 'large',
-        'per_page': 15,
-        'page': 1
+        'per_page': PEXELS_PER_PAGE,
+        'page': page
     }
+    return pexels_url, headers, params
 
+def _pexels_record_failure(random_theme, page, stale_photos):
+    """Ghi lại lần làm mới lỗi để các lời gọi sau dùng kho cũ thay vì gọi lại Search ngay."""
+    with _pexels_search_lock:
+        entry = _pexels_search_cache.setdefault(
+            random_theme, {'photos': stale_photos, 'fetched_at': 0, 'next_page': page, 'total_results': 0}
+        )
+        entry['failed_at'] = time.time()
+    return stale_photos
+
+def _pexels_merge_page(random_theme, page, data):
+    """Gộp một trang kết quả vào kho của từ khoá và tính trang kế tiếp. Trả về kho sau khi gộp."""
+    new_photos = [
+        {'id': p['id'], 'width': p.get('width'), 'height': p.get('height'), 'src': p.get('src', {})}
+        for p in data.get('photos', []) if 'id' in p
+    ]
+    total_results = data.get('total_results', 0)
+    print(f"  - Pexels: Đã làm mới kho ảnh '{random_theme}' (trang {page}, +{len(new_photos)} ảnh).")
+
+    with _pexels_search_lock:
+        entry = _pexels_search_cache.get(random_theme) or {'photos': [], 'next_page': 1}
+        known_ids = {p['id'] for p in entry['photos']}
+        photos = entry['photos'] + [p for p in new_photos if p['id'] not in known_ids]
+        # Giữ các ảnh mới nhất khi kho vượt giới hạn
+        photos = photos[-PEXELS_POOL_MAX:]
+        next_page = page + 1
+        if not new_photos or page * PEXELS_PER_PAGE >= total_results:
+            next_page = 1
+        _pexels_search_cache[random_theme] = {
+            'photos': photos,
+            'fetched_at': time.time(),
+            'next_page': next_page,
+            'total_results': total_results
+        }
+    return photos
+
+def search_pexels_photos(random_theme):
+    """
+    Trả về kho ảnh (list) cho từ khoá. Chỉ gọi /v1/search khi kho trống hoặc đã quá TTL;
+    mỗi lần làm mới sẽ lấy TRANG TIẾP THEO và gộp vào kho, quay lại trang 1 khi hết kết quả.
+    Nếu gọi API lỗi nhưng vẫn còn kho cũ thì tiếp tục dùng kho cũ (không gọi lại trước PEXELS_SEARCH_RETRY_SECONDS).
+    """
+    fresh_photos, page, stale_photos = _pexels_pool_lookup(random_theme)
+    if fresh_photos is not None:
+        return fresh_photos
+
+    with _pexels_refresh_lock(random_theme):
+        # Thread khác có thể vừa làm mới xong trong lúc chờ khoá
+        fresh_photos, page, stale_photos = _pexels_pool_lookup(random_theme)
+        if fresh_photos is not None:
+            return fresh_photos
+        return _refresh_pexels_pool(random_theme, page, stale_photos)
+
+def _refresh_pexels_pool(random_theme, page, stale_photos):
+    pexels_url, headers, params = _pexels_search_request(random_theme, page)
     try:
-        response = requests.get(pexels_url, headers=headers, params=params, timeout=10)
+        response = http_get(pexels_url, headers=headers, params=params)
         if response.status_code != 200:
-            print(f"  - Lỗi Pexels (Search): Status code {response.status_code}. Vui lòng kiểm tra API Key hoặc Limit.")
-            return None
-
+            print(f"  - Lỗi Pexels (Search): Status code {response.status_code}. Vui lòng kiểm tra API Key hoặc Limit.")
+            return _pexels_record_failure(random_theme, page, stale_photos)
         data = response.json()
-        photos = data.get('photos', [])
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"  - Lỗi kết nối Pexels (Search): {e}.")
+        return _pexels_record_failure(random_theme, page, stale_photos)
+
+    return _pexels_merge_page(random_theme, page, data)
+
+# --- HÀM TẢI ẢNH NGẪU NHIÊN TỪ PEXELS (Ưu tiên 1) ---
+def get_random_pexels_image(query, slide_index):
+    if not PEXELS_API_KEY or PEXELS_API_KEY == "YOUR_PEXELS_API_KEY":
+        print("  - Cảnh báo: PEXELS_API_KEY chưa được cấu hình. Bỏ qua Pexels.")
+        return None
+
+
+    # CHỌN CHỦ ĐỀ NGẪU NHIÊN TỪ DANH SÁCH
+    random_theme = random.choice(BACKGROUND_THEME_KEYWORDS)
+    print(f"  - Đang thử lấy ảnh nền từ Pexels theo chủ đề ngẫu nhiên: '{random_theme}'")
+
+    try:
+        # Lấy từ kho ảnh đã cache theo từ khoá (chỉ gọi Search khi hết hạn TTL)
+        photos = search_pexels_photos(random_theme)
 
         if not photos:
-            print(f"  - Pexels: Không tìm thấy ảnh nào cho chủ đề '{random_theme}'.")
+            print(f"  - Pexels: Không tìm thấy ảnh nào cho chủ đề '{random_theme}'.")
             return None
 
         random_photo = random.choice(photos)
-        image_url = random_photo['src']['original']
-
-        image_response = requests.get(image_url, allow_redirects=True, timeout=15)
-        if image_response.status_code == 200:
-            temp_filename = f"temp_pexels_bg_{slide_index}.jpg"
-            with open(temp_filename, 'wb') as f:
-                f.write(image_response.content)
+        cached_img = bg_cache_get('pexels', random_photo['id'])
+        if cached_img is not None:
+            print(f"  - ♻️ Ảnh nền Pexels đã có trong cache, bỏ qua tải xuống.")
+            return cached_img
+
+        # Tải rendition nhỏ nhất vẫn đủ phủ 1080x1920 thay vì ảnh gốc nhiều MB
+        image_response = download_rendition(pexels_rendition_candidates(random_photo), 'Pexels')
+        if image_response is not None and image_response.status_code == 200:
             print(f"  - ✅ Đã tải ảnh nền từ Pexels thành công.")
-            return temp_filename
+            return prepare_downloaded_background(image_response.content, 'pexels', random_photo['id'])
         else:
-            print(f"  - Lỗi Pexels (Download): Status code {image_response.status_code}.")
+            print(f"  - Lỗi Pexels (Download): Status code {getattr(image_response, 'status_code', None)}.")
             return None
 
     except requests.exceptions.RequestException as e:
@@ -375,23 +1750,11 @@ def get_random_pexels_image(query, slide_index):
         return None
 
 # --- HÀM TẢI ẢNH NGẪU NHIÊN TỪ UNSPLASH (Ưu tiên 2, Dùng API Chính thức) ---
-def get_random_unsplash_image(query, slide_index):
-    if not UNSPLASH_ACCESS_KEY or UNSPLASH_ACCESS_KEY == "YOUR_UNSPLASH_ACCESS_KEY":
-        print("  - Cảnh báo: UNSPLASH_ACCESS_KEY chưa được cấu hình. Bỏ qua Unsplash.")
-        return None
-
-    # DANH SÁCH CHỦ ĐỀ CỐ ĐỊNH (theo yêu cầu của người dùng)
-    THEME_KEYWORDS = [
-        "rain", "snow", "forest", "mountain", "sea beach",
-        "sunset", "sunrise", "old books", "potted plant indoor"
-    ]
-    random_theme = random.choice(THEME_KEYWORDS)
-    print(f"  - Đang thử lấy ảnh nền từ Unsplash API theo chủ đề ngẫu nhiên: '{random_theme}'")
-
+def _unsplash_random_request(random_theme):
     negative_keywords = "-person -people -face -human -portrait"
     modified_query = f"{random_theme} backgrounds cover {negative_keywords}"
 
-    unsplash_url = "https://api.unsplash.com/photos/random"
+    unsplash_url = f"{UNSPLASH_API_URL}/photos/random"
 
     headers = { "Authorization": f"Client-ID {UNSPLASH_ACCESS_KEY}" }
 
@@ -400,41 +1763,193 @@ def get_random_unsplash_image(query, slide_index):
         'orientation': 'portrait',
         'count': 1
     }
+    return unsplash_url, headers, params
+
+def _unsplash_pick_photo(data):
+    # /photos/random trả về list khi có 'count', dict khi không
+    if isinstance(data, list) and len(data) > 0:
+        return data[0]
+    if isinstance(data, dict):
+        return data
+    return None
+
+def get_random_unsplash_image(query, slide_index):
+    if not UNSPLASH_ACCESS_KEY or UNSPLASH_ACCESS_KEY == "YOUR_UNSPLASH_ACCESS_KEY":
+        print("  - Cảnh báo: UNSPLASH_ACCESS_KEY chưa được cấu hình. Bỏ qua Unsplash.")
+        return None
+
+    random_theme = random.choice(BACKGROUND_THEME_KEYWORDS)
+    print(f"  - Đang thử lấy ảnh nền từ Unsplash API theo chủ đề ngẫu nhiên: '{random_theme}'")
+
+    unsplash_url, headers, params = _unsplash_random_request(random_theme)
 
     try:
-        response = requests.get(unsplash_url, headers=headers, params=params, timeout=10)
+        response = http_get(unsplash_url, headers=headers, params=params)
         if response.status_code != 200:
             print(f"  - Lỗi Unsplash (Search): Status code {response.status_code}. Chi tiết: {response.text}")
             return None
 
-        data = response.json()
-
-        if isinstance(data, list) and len(data) > 0:
-            photo = data[0]
-        elif isinstance(data, dict):
-            photo = data
-        else:
-            print(f"  - Unsplash: Không tìm thấy ảnh nào cho chủ đề '{random_theme}'.")
+        photo = _unsplash_pick_photo(response.json())
+        if photo is None:
+            print(f"  - Unsplash: Không tìm thấy ảnh nào cho chủ đề '{random_theme}'.")
             return None
 
-        image_url = photo['urls']['full']
+        cached_img = bg_cache_get('unsplash', photo['id'])
+        if cached_img is not None:
+            print(f"  - ♻️ Ảnh nền Unsplash đã có trong cache, bỏ qua tải xuống.")
+            return cached_img
 
-        image_response = requests.get(image_url, allow_redirects=True, timeout=15)
+        # Tải rendition nhỏ nhất vẫn đủ phủ 1080x1920 thay vì ảnh 'full'
+        image_response = download_rendition(unsplash_rendition_candidates(photo), 'Unsplash')
 
-        if image_response.status_code == 200:
-            temp_filename = f"temp_unsplash_bg_{slide_index}.jpg"
-            with open(temp_filename, 'wb') as f:
-                f.write(image_response.content)
+        if image_response is not None and image_response.status_code == 200:
             print(f"  - ✅ Đã tải ảnh nền từ Unsplash thành công.")
-            return temp_filename
+            return prepare_downloaded_background(image_response.content, 'unsplash', photo['id'])
         else:
-            print(f"  - Lỗi Unsplash (Download): Status code {image_response.status_code}.")
+            print(f"  - Lỗi Unsplash (Download): Status code {getattr(image_response, 'status_code', None)}.")
             return None
 
     except requests.exceptions.RequestException as e:
         print(f"  - Lỗi kết nối Unsplash: {e}. Chuyển sang nguồn dự phòng.")
         return None
 
+# --- ĐẦU RA CÓ CẤU TRÚC CỦA GEMINI: SCHEMA + KIỂM TRA + SỬA CỤC BỘ ---
+# Mọi kịch bản slide đều dùng chung một schema: {'slides': [{'text', 'image_query'?}], 'caption'?, 'theme'?}.
+# Kết quả được kiểm tra số slide và số từ mỗi slide; phần sai được sửa tại chỗ hoặc chỉ gửi lại đúng phần đó.
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+def slides_response_schema(min_slides, max_slides, with_image_query=False, with_caption=True, with_theme=False):
+    slide_properties = {'text': types.Schema(type=types.Type.STRING)}
+    if with_image_query:
+        slide_properties['image_query'] = types.Schema(type=types.Type.STRING)
+    slide_schema = types.Schema(
+        type=types.Type.OBJECT,
+        properties=slide_properties,
+        required=list(slide_properties),
+        property_ordering=list(slide_properties)
+    )
+
+    properties = {}
+    if with_theme:
+        properties['theme'] = types.Schema(type=types.Type.STRING)
+    properties['slides'] = types.Schema(
+        type=types.Type.ARRAY, items=slide_schema, min_items=min_slides, max_items=max_slides
+    )
+    if with_caption:
+        properties['caption'] = types.Schema(type=types.Type.STRING)
+    return types.Schema(
+        type=types.Type.OBJECT,
+        properties=properties,
+        required=list(properties),
+        property_ordering=list(properties)
+    )
+
+def gemini_generate(contents, config=None):
+    """client.models.generate_content có đo thời gian, đếm kết quả và số token đã dùng."""
+    with track_stage('gemini', provider='gemini'):
+        response = client.models.generate_content(model=GEMINI_MODEL, contents=contents, config=config)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        count_metric('gemini_tokens_total', usage.prompt_token_count or 0, kind='prompt')
+        count_metric('gemini_tokens_total', usage.candidates_token_count or 0, kind='output')
+    return response
+
+def gemini_json(contents, schema):
+    """Một lần gọi Gemini với response_schema, trả về JSON đã parse. Các phần prompt rỗng được bỏ qua."""
+    response = gemini_generate(
+        [part for part in contents if part],
+        types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=schema
+        )
+    )
+    return json.loads(response.text)
+
+def _word_count(text):
+    return len(text.split())
+
+def validate_slides(data, min_slides, max_slides, max_words):
+    """
+    Chuẩn hoá và kiểm tra kịch bản. Trả về (data, lỗi, chỉ số các slide quá dài):
+    - bỏ slide rỗng; quá nhiều slide thì cắt bớt ở giữa, luôn giữ slide cuối (nút thắt/punchline);
+    - lỗi (chuỗi) khi không đủ min_slides -> cần gọi lại cả kịch bản.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('slides'), list):
+        return None, "không có mảng 'slides'", []
+
+    slides = []
+    for slide in data['slides']:
+        if not isinstance(slide, dict):
+            continue
+        text = str(slide.get('text') or '').strip()
+        if not text:
+            continue
+        slide = dict(slide, text=text)
+        if not str(slide.get('image_query') or '').strip():
+            slide.pop('image_query', None) # render_and_upload_slides dùng query mặc định của app
+        slides.append(slide)
+
+    if len(slides) < min_slides:
+        return None, f"chỉ có {len(slides)} slide (cần ít nhất {min_slides})", []
+    if len(slides) > max_slides:
+        print(f"  - Cảnh báo: Kịch bản có {len(slides)} slide, cắt còn {max_slides}.")
+        slides = slides[:max_slides - 1] + slides[-1:]
+
+    data = dict(data, slides=slides)
+    too_long = [i for i, slide in enumerate(slides) if _word_count(slide['text']) > max_words]
+    return data, None, too_long
+
+def shorten_slide_texts(texts, max_words):
+    """Chỉ gửi lại các đoạn quá dài để Gemini rút gọn. Trả về danh sách đoạn mới (cùng độ dài) hoặc None."""
+    prompt = (
+        f"Rút gọn từng đoạn văn sau xuống TỐI ĐA {max_words} từ, giữ nguyên ý chính, giọng văn và ngôn ngữ. "
+        f"Trả về mảng JSON gồm đúng {len(texts)} chuỗi theo đúng thứ tự.\n\n"
+        + "\n".join(f"{i + 1}. {text}" for i, text in enumerate(texts))
+    )
+    schema = types.Schema(
+        type=types.Type.ARRAY,
+        items=types.Schema(type=types.Type.STRING),
+        min_items=len(texts),
+        max_items=len(texts)
+    )
+    try:
+        shortened = gemini_json([prompt], schema)
+    except Exception as e:
+        print(f"  - Lỗi khi yêu cầu Gemini rút gọn slide: {e}")
+        return None
+    if not isinstance(shortened, list) or len(shortened) != len(texts):
+        return None
+    return [str(text).strip() for text in shortened]
+
+def generate_slides_with_repair(label, contents, schema, min_slides, max_slides, max_words):
+    """
+    Tạo kịch bản theo schema rồi kiểm tra. JSON hỏng/thiếu slide thì gọi lại cả kịch bản (tối đa
+    GEMINI_REPAIR_ATTEMPTS lần); slide vượt số từ thì chỉ gửi lại các slide đó. Trả về dict đã chuẩn hoá hoặc None.
+    """
+    data = None
+    for attempt in range(GEMINI_REPAIR_ATTEMPTS + 1):
+        try:
+            data, error, too_long = validate_slides(gemini_json(contents, schema), min_slides, max_slides, max_words)
+        except Exception as e:
+            data, error = None, str(e)
+        if data is not None:
+            break
+        print(f"  - Kịch bản {label} không hợp lệ ({error}).{' Gọi lại Gemini...' if attempt < GEMINI_REPAIR_ATTEMPTS else ''}")
+    if data is None:
+        return None
+
+    if too_long:
+        print(f"  - {len(too_long)} slide vượt {max_words} từ, yêu cầu Gemini rút gọn riêng các slide này...")
+        shortened = shorten_slide_texts([data['slides'][i]['text'] for i in too_long], max_words)
+        for i, text in zip(too_long, shortened or []):
+            if text and _word_count(text) <= max_words:
+                data['slides'][i]['text'] = text
+        still_long = [i + 1 for i in too_long if _word_count(data['slides'][i]['text']) > max_words]
+        if still_long:
+            # Vẫn dùng được: khối chữ tự co cỡ font (FONT_AUTO_FIT)
+            print(f"  - Cảnh báo: Slide {still_long} vẫn dài hơn {max_words} từ, giữ nguyên.")
+    return data
+
 # --- HÀM ĐỀ XUẤT CHỦ ĐỀ HẤP DẪN (GEMINI) ---
 def propose_random_theme(domains_list):
     print("Bắt đầu: Yêu cầu Gemini đề xuất một chủ đề hấp dẫn ngẫu nhiên, độc đáo...")
@@ -449,13 +1964,12 @@ def propose_random_theme(domains_list):
     LĨNH VỰC: Chủ đề nên xoay quanh {domains_list}.
 
     ĐỊNH DẠNG: Chỉ trả về **Tên Chủ Đề**, không có bất kỳ giải thích nào khác.
+
+    {exclusion_prompt('story')}
     """
 
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[system_prompt]
-        )
+        response = gemini_generate([system_prompt])
         theme = response.text.strip()
         print(f"✅ Đã đề xuất chủ đề: {theme}")
         return theme
@@ -472,45 +1986,62 @@ def generate_story_and_prompts(theme):
     QUY TẮC:
     1. Kịch bản phải dài từ **4 đến 10 slides**. Mỗi slide phải là một đoạn văn ngắn (tối đa 30 từ).
     2. Slide cuối cùng phải là **nút thắt/kết luận** gây sốc.
-    3. Output BẮT BUỘC phải là một đối tượng JSON (array of objects) với các khóa sau:
-       - 'text': Nội dung ngắn gọn cho slide.
+    3. Output BẮT BUỘC phải là một đối tượng JSON với các khóa sau:
+       - 'slides': Mảng các đối tượng, mỗi đối tượng có khóa 'text' là nội dung ngắn gọn cho slide.
        - 'caption': Phần caption cuối cùng cho toàn bộ video TikTok (chứa cả hashtag).
     """
     user_prompt = f"Viết một câu chuyện 4 đến 10 slides về chủ đề: {theme}."
 
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[system_prompt, user_prompt],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-            )
-        )
+    data = generate_slides_with_repair(
+        'Câu Chuyện', [system_prompt, user_prompt], slides_response_schema(4, 10),
+        min_slides=4, max_slides=10, max_words=30
+    )
+    if not data:
+        print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ.")
+        return None, None
 
-        data = json.loads(response.text)
-        caption = "Câu chuyện đời thường." # Caption mặc định
-
-        # XỬ LÝ LINH HOẠT TỪ ĐIỂN HOẶC DANH SÁCH
-        if isinstance(data, dict):
-            story_slides = data.get('slides', [])
-            caption = data.get('caption', caption)
-        elif isinstance(data, list):
-            story_slides = data
-            if story_slides and 'caption' in story_slides[0]:
-                caption = story_slides[0]['caption']
-        else:
-            story_slides = []
+    print("✅ Đã tạo kịch bản thành công.")
+    return data['slides'], data.get('caption') or "Câu chuyện đời thường." # Caption mặc định
 
-        if not story_slides or not isinstance(story_slides, list):
-            print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ.")
-            return None, None
+# --- HÀM ĐỀ XUẤT CHỦ ĐỀ + TẠO KỊCH BẢN TRONG MỘT LẦN GỌI (GEMINI) ---
+def generate_theme_and_story(domains_list):
+    """
+    Gộp propose_random_theme + generate_story_and_prompts thành một request JSON duy nhất.
+    Trả về (theme, story_slides, caption) hoặc (None, None, None) nếu lỗi.
+    """
+    print("Bắt đầu: Yêu cầu Gemini đề xuất chủ đề và viết kịch bản trong một lần gọi...")
 
-        print("✅ Đã tạo kịch bản thành công.")
-        return story_slides, caption
+    system_prompt = f"""
+    Bạn là một chuyên gia sáng tạo nội dung kiêm biên kịch TikTok chuyên nghiệp cho người xem Việt Nam.
 
-    except Exception as e:
-        print(f"Lỗi khi gọi Gemini tạo kịch bản: {e}")
-        return None, None
+    BƯỚC 1 - CHỦ ĐỀ: Đề xuất MỘT chủ đề câu chuyện ngắn (duy nhất) cực kỳ hấp dẫn, gây tò mò, hoặc chạm đến cảm xúc sâu sắc.
+    1. Chủ đề phải **CỰC KỲ ngẫu nhiên** và **chưa từng được thấy** trong các đề xuất gần đây. Tránh các chủ đề chung chung.
+    2. Tập trung vào một **tình huống gần gũi với mọi người, tính chất éo le, khó xử, nút thắt bất ngờ, hoặc một góc khuất** cụ thể.
+    LĨNH VỰC: Chủ đề nên xoay quanh {domains_list}.
+
+    BƯỚC 2 - KỊCH BẢN: Chuyển chủ đề vừa chọn thành một kịch bản hấp dẫn, gây tò mò, có nút thắt bất ngờ ở cuối.
+    1. Kịch bản phải dài từ **4 đến 10 slides**. Mỗi slide phải là một đoạn văn ngắn (tối đa 30 từ).
+    2. Slide cuối cùng phải là **nút thắt/kết luận** gây sốc.
+
+    Output BẮT BUỘC phải là một đối tượng JSON với các khóa sau:
+       - 'theme': Tên chủ đề (ngắn gọn, không giải thích).
+       - 'slides': Mảng các đối tượng, mỗi đối tượng có khóa 'text' là nội dung ngắn gọn cho slide.
+       - 'caption': Phần caption cuối cùng cho toàn bộ video TikTok (chứa cả hashtag).
+
+    {exclusion_prompt('story')}
+    """
+
+    data = generate_slides_with_repair(
+        'Câu Chuyện', [system_prompt], slides_response_schema(4, 10, with_theme=True),
+        min_slides=4, max_slides=10, max_words=30
+    )
+    theme = str(data.get('theme') or '').strip() if data else ''
+    if not theme:
+        print("Lỗi: Gemini không trả về chủ đề/slides hợp lệ.")
+        return None, None, None
+
+    print(f"✅ Đã đề xuất chủ đề và tạo kịch bản: {theme}")
+    return theme, data['slides'], data.get('caption') or "Câu chuyện đời thường." # Caption mặc định
 
 # HÀM PHỤ: TẠO NỘI DUNG VÀ PROMPT TÌM ẢNH CHUNG (Cho các App tâm linh)
 def propose_content_and_image_query(app_name, user_input, num_slides=4):
@@ -519,22 +2050,22 @@ def propose_content_and_image_query(app_name, user_input, num_slides=4):
     # Định nghĩa các System Prompt và Image Query dựa trên App
     prompts_map = {
         'phong_thuy': {
-            'system': f"Bạn là chuyên gia Phong Thủy, hãy viết {num_slides} đoạn văn ngắn (mỗi đoạn 30-50 từ) để tạo thành một lời khuyên chuyên sâu về chủ đề '{user_input}'. Trả về JSON array: [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...].",
+            'system': f"Bạn là chuyên gia Phong Thủy, hãy viết {num_slides} đoạn văn ngắn (mỗi đoạn 30-50 từ) để tạo thành một lời khuyên chuyên sâu về chủ đề '{user_input}'. Trả về JSON: {{'slides': [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...]}}.",
             'image_query': f"minimalist feng shui background {user_input}",
             'caption': f"#phongthuy #{user_input.replace(' ', '')}"
         },
         'tu_vi': {
-            'system': f"Bạn là chuyên gia Tử Vi. Hãy viết {num_slides} đoạn luận giải ngắn (mỗi đoạn 30-50 từ) về '{user_input}' theo phong cách cổ điển, bí ẩn. Trả về JSON array: [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...].",
+            'system': f"Bạn là chuyên gia Tử Vi. Hãy viết {num_slides} đoạn luận giải ngắn (mỗi đoạn 30-50 từ) về '{user_input}' theo phong cách cổ điển, bí ẩn. Trả về JSON: {{'slides': [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...]}}.",
             'image_query': "ancient chinese astrology chart dark background",
             'caption': f"#lasotuvi #luangiaituvi"
         },
         'tarot': {
-            'system': f"Bạn là một Reader Tarot chuyên nghiệp. Hãy viết {num_slides} đoạn giải mã lá bài (mỗi đoạn 30-50 từ) về tình huống '{user_input}' (ví dụ: 'What is blocking my success?'). Trả về JSON array: [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...].",
+            'system': f"Bạn là một Reader Tarot chuyên nghiệp. Hãy viết {num_slides} đoạn giải mã lá bài (mỗi đoạn 30-50 từ) về tình huống '{user_input}' (ví dụ: 'What is blocking my success?'). Trả về JSON: {{'slides': [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...]}}.",
             'image_query': "tarot card mystical background golden light",
             'caption': f"#tarotdaily #readingtarot"
         },
         'cung_hoang_dao': {
-            'system': f"Bạn là chuyên gia Chiêm Tinh. Hãy viết {num_slides} dự đoán ngắn (mỗi đoạn 30-50 từ) cho cung '{user_input}' (ví dụ: 'Song Tử') về tình yêu, sự nghiệp, sức khỏe. Trả về JSON array: [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...].",
+            'system': f"Bạn là chuyên gia Chiêm Tinh. Hãy viết {num_slides} dự đoán ngắn (mỗi đoạn 30-50 từ) cho cung '{user_input}' (ví dụ: 'Song Tử') về tình yêu, sự nghiệp, sức khỏe. Trả về JSON: {{'slides': [{{'text': 'Đoạn 1'}}, {{'text': 'Đoạn 2'}}, ...]}}.",
             'image_query': "zodiac sign galaxy background minimal",
             'caption': f"#{user_input.replace(' ', '')} #cung_hoang_dao"
         }
@@ -544,151 +2075,888 @@ def propose_content_and_image_query(app_name, user_input, num_slides=4):
     if not config:
         return None, None, None
 
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[config['system']],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-            )
-        )
-
-        # Thử tải JSON
-        slides_data = json.loads(response.text)
-        if not isinstance(slides_data, list) or not slides_data:
-            print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ (JSON Array).")
-            return None, None, None
-
-        return slides_data, config['image_query'], config['caption']
-
-    except Exception as e:
-        print(f"Lỗi khi gọi Gemini tạo nội dung {app_name}: {e}")
+    # Mỗi đoạn 30-50 từ theo prompt; dư 10 từ trước khi yêu cầu rút gọn
+    data = generate_slides_with_repair(
+        app_name, [config['system']], slides_response_schema(num_slides, num_slides, with_caption=False),
+        min_slides=num_slides, max_slides=num_slides, max_words=60
+    )
+    if not data:
+        print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ.")
         return None, None, None
 
+    return data['slides'], config['image_query'], config['caption']
 
-# --- HÀM TẠO TRUYỆN CỔ TÍCH (GEMINI) ---
-def generate_fairy_tale():
-    print("Bắt đầu: Yêu cầu Gemini tạo một câu chuyện cổ tích ngẫu nhiên...")
 
-    # System Prompt cho Truyện Cổ Tích
-    system_prompt = """
+# --- HÀM TẠO TRUYỆN CỔ TÍCH (GEMINI) ---
+# System Prompt cho Truyện Cổ Tích (dùng chung cho bản tạo đơn lẻ và tạo hàng loạt)
+FAIRY_TALE_SYSTEM_PROMPT = """
     Bạn là một nhà kể chuyện cổ tích chuyên nghiệp. Nhiệm vụ của bạn là chọn MỘT câu chuyện cổ tích kinh điển/phổ biến từ bất kỳ nền văn hóa nào trên thế giới (ví dụ: Grimms, Andersen, Việt Nam, Trung Quốc, v.v.), sau đó tóm tắt nó thành một kịch bản hấp dẫn.
     QUY TẮC:
     1. Câu chuyện phải là một truyện cổ tích có tính giáo dục hoặc truyền cảm hứng.
     2. Kịch bản phải dài từ **4 đến 10 slides**. Mỗi slide phải là một đoạn văn ngắn (tối đa 40 từ).
-    3. Output BẮT BUỘC phải là một đối tượng JSON (array of objects) với các khóa sau:
-       - 'text': Nội dung ngắn gọn cho slide.
-       - 'image_query': Một từ khóa tiếng Anh ngắn gọn (2-5 từ) để tìm ảnh minh họa cho slide này (Ví dụ: 'magical castle', 'brave prince', 'evil witch').
+    3. Output BẮT BUỘC phải là một đối tượng JSON với các khóa sau:
+       - 'slides': Mảng các đối tượng, mỗi đối tượng gồm:
+         - 'text': Nội dung ngắn gọn cho slide.
+         - 'image_query': Một từ khóa tiếng Anh ngắn gọn (2-5 từ) để tìm ảnh minh họa cho slide này (Ví dụ: 'magical castle', 'brave prince', 'evil witch').
        - 'caption': Phần caption cuối cùng cho toàn bộ video (chứa cả hashtag).
     """
-
+
+def generate_fairy_tale():
+    print("Bắt đầu: Yêu cầu Gemini tạo một câu chuyện cổ tích ngẫu nhiên...")
+
+    data = generate_slides_with_repair(
+        'Cổ Tích', [FAIRY_TALE_SYSTEM_PROMPT, exclusion_prompt('fairy_tale')], slides_response_schema(4, 10, with_image_query=True),
+        min_slides=4, max_slides=10, max_words=40
+    )
+    if not data:
+        print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ cho Cổ Tích.")
+        return None, None
+
+    print("✅ Đã tạo kịch bản Truyện Cổ Tích thành công.")
+    return data['slides'], data.get('caption') or "Câu chuyện cổ tích." # Caption mặc định
+
+# --- HÀM TẠO TRUYỆN CƯỜI (GEMINI) ---
+# System Prompt cho Truyện Cười
+JOKE_SYSTEM_PROMPT = """
+    Bạn là một diễn viên hài độc thoại chuyên nghiệp. Nhiệm vụ của bạn là tạo MỘT câu chuyện cười/tình huống hài hước ngắn gọn.
+    QUY TẮC:
+    1. Câu chuyện phải cực kỳ ngắn gọn, có **tác động gây cười mạnh mẽ và bất ngờ** ở slide cuối cùng.
+    2. Kịch bản phải dài **3 đến 5 slides** (tình huống, diễn biến, punchline). Mỗi slide TỐI ĐA 30 từ.
+    3. Output BẮT BUỘC phải là một đối tượng JSON với các khóa sau:
+       - 'slides': Mảng các đối tượng, mỗi đối tượng gồm:
+         - 'text': Nội dung ngắn gọn cho slide.
+         - 'image_query': Một từ khóa tiếng Anh hài hước/độc đáo (3-5 từ) để tìm ảnh nền cho slide này (Ví dụ: 'surprised face meme', 'funny cartoon dog', 'awkward situation').
+       - 'caption': Phần caption cuối cùng cho toàn bộ video (chứa cả hashtag).
+    """
+
+def generate_joke():
+    print("Bắt đầu: Yêu cầu Gemini tạo một câu chuyện cười ngắn, mạnh...")
+
+    data = generate_slides_with_repair(
+        'Truyện Cười', [JOKE_SYSTEM_PROMPT, exclusion_prompt('joke')], slides_response_schema(3, 5, with_image_query=True),
+        min_slides=3, max_slides=5, max_words=30
+    )
+    if not data:
+        print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ cho Truyện Cười (Cần ít nhất 3 slides).")
+        return None, None
+
+    print("✅ Đã tạo kịch bản Truyện Cười thành công.")
+    return data['slides'], data.get('caption') or "Truyện cười hài hước." # Caption mặc định
+
+# --- TẠO HÀNG LOẠT KỊCH BẢN TRONG MỘT REQUEST (TRUYỆN CƯỜI / CỔ TÍCH) ---
+# Một request Gemini trả về tối đa BULK_SCRIPTS_PER_REQUEST kịch bản độc lập ({'scripts': [...]}), mỗi kịch bản
+# được kiểm tra riêng; kịch bản hỏng bị bỏ, không làm hỏng cả mẻ. Số lượng lớn hơn được chia thành nhiều
+# request chạy song song, hoặc gửi qua Gemini Batch API (bất đồng bộ, rẻ hơn) bằng submit_bulk_scripts_batch():
+# producer của bộ đệm kịch bản dùng cách này khi phần thiếu lớn (SCRIPT_BUFFER_BATCH_MIN, xem submit_buffer_batch).
+BULK_SCRIPT_SPECS = {
+    'fairy_tale': {
+        'label': 'Cổ Tích', 'prompt': FAIRY_TALE_SYSTEM_PROMPT, 'min_slides': 4, 'max_slides': 10,
+        'max_words': 40, 'default_caption': "Câu chuyện cổ tích."
+    },
+    'joke': {
+        'label': 'Truyện Cười', 'prompt': JOKE_SYSTEM_PROMPT, 'min_slides': 3, 'max_slides': 5,
+        'max_words': 30, 'default_caption': "Truyện cười hài hước."
+    }
+}
+
+def _bulk_scripts_request(kind, count):
+    """(contents, schema) cho một request sinh count kịch bản của app kind."""
+    spec = BULK_SCRIPT_SPECS[kind]
+    bulk_prompt = (
+        f"YÊU CẦU THÊM: Tạo {count} kịch bản HOÀN TOÀN KHÁC NHAU (khác câu chuyện, khác tình huống), mỗi kịch bản "
+        f"tuân thủ đúng các quy tắc trên. Output là một đối tượng JSON có khóa 'scripts' là mảng {count} kịch bản."
+    )
+    script_schema = slides_response_schema(spec['min_slides'], spec['max_slides'], with_image_query=True)
+    schema = types.Schema(
+        type=types.Type.OBJECT,
+        properties={'scripts': types.Schema(type=types.Type.ARRAY, items=script_schema, min_items=1, max_items=count)},
+        required=['scripts']
+    )
+    return [spec['prompt'], exclusion_prompt(kind), bulk_prompt], schema
+
+def _validate_bulk_scripts(kind, data):
+    """Kiểm tra từng kịch bản trong mẻ; slide quá dài của cả mẻ được rút gọn trong MỘT lần gọi."""
+    spec = BULK_SCRIPT_SPECS[kind]
+    scripts = []
+    long_slides = [] # (chỉ số kịch bản, chỉ số slide)
+    for raw_script in (data.get('scripts') or []) if isinstance(data, dict) else []:
+        script, error, too_long = validate_slides(raw_script, spec['min_slides'], spec['max_slides'], spec['max_words'])
+        if script is None:
+            print(f"  - Bỏ một kịch bản {spec['label']} không hợp lệ ({error}).")
+            continue
+        long_slides.extend((len(scripts), i) for i in too_long)
+        scripts.append({'slides': script['slides'], 'caption': script.get('caption') or spec['default_caption']})
+
+    if long_slides:
+        shortened = shorten_slide_texts([scripts[s]['slides'][i]['text'] for s, i in long_slides], spec['max_words'])
+        for (s, i), text in zip(long_slides, shortened or []):
+            if text and _word_count(text) <= spec['max_words']:
+                scripts[s]['slides'][i]['text'] = text
+    return scripts
+
+def _generate_bulk_chunk(kind, count):
+    contents, schema = _bulk_scripts_request(kind, count)
+    try:
+        return _validate_bulk_scripts(kind, gemini_json(contents, schema))
+    except Exception as e:
+        print(f"  - Lỗi khi gọi Gemini tạo hàng loạt {BULK_SCRIPT_SPECS[kind]['label']}: {e}")
+        return []
+
+def generate_scripts_bulk(kind, count):
+    """Tạo count kịch bản (ít request nhất có thể). Trả về danh sách kịch bản hợp lệ, có thể ít hơn count."""
+    print(f"Bắt đầu: Yêu cầu Gemini tạo hàng loạt {count} kịch bản {BULK_SCRIPT_SPECS[kind]['label']}...")
+    chunk_sizes = [min(BULK_SCRIPTS_PER_REQUEST, count - start) for start in range(0, count, BULK_SCRIPTS_PER_REQUEST)]
+    with ThreadPoolExecutor(max_workers=BULK_MAX_CONCURRENT_REQUESTS, thread_name_prefix='bulk_scripts') as pool:
+        chunks = list(pool.map(functools.partial(_generate_bulk_chunk, kind), chunk_sizes))
+    scripts = [script for chunk in chunks for script in chunk]
+    print(f"✅ Đã tạo {len(scripts)}/{count} kịch bản {BULK_SCRIPT_SPECS[kind]['label']} hợp lệ.")
+    return scripts
+
+def submit_bulk_scripts_batch(kind, count):
+    """Gửi một job Gemini Batch API (xử lý bất đồng bộ phía Google). Trả về tên job để lấy kết quả sau."""
+    requests_to_send = []
+    for start in range(0, count, BULK_SCRIPTS_PER_REQUEST):
+        contents, schema = _bulk_scripts_request(kind, min(BULK_SCRIPTS_PER_REQUEST, count - start))
+        requests_to_send.append(types.InlinedRequest(
+            contents=contents,
+            config=types.GenerateContentConfig(response_mime_type="application/json", response_schema=schema)
+        ))
+    with track_stage('gemini_batch', provider='gemini'):
+        job = client.batches.create(
+            model=GEMINI_MODEL,
+            src=requests_to_send,
+            config=types.CreateBatchJobConfig(display_name=f"tktk-{kind}-{int(time.time())}")
+        )
+    print(f"✅ Đã gửi batch job {job.name}: {count} kịch bản {BULK_SCRIPT_SPECS[kind]['label']} ({len(requests_to_send)} request).")
+    return job.name
+
+def collect_bulk_scripts_batch(kind, job_name):
+    """
+    Kết quả của batch job: [] nếu job đã kết thúc mà không có kết quả (FAILED/CANCELLED/EXPIRED), danh sách kịch bản
+    hợp lệ nếu job xong, None với mọi trạng thái khác (đang chờ/chạy, tạm dừng, đang huỷ...): hỏi lại sau.
+    """
+    job = client.batches.get(name=job_name)
+    if job.state in (types.JobState.JOB_STATE_FAILED, types.JobState.JOB_STATE_CANCELLED, types.JobState.JOB_STATE_EXPIRED):
+        print(f"❌ Batch job {job_name} kết thúc với trạng thái {job.state}: {job.error}")
+        return []
+    if job.state not in (types.JobState.JOB_STATE_SUCCEEDED, types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED):
+        return None
+
+    scripts = []
+    for inlined in (job.dest.inlined_responses if job.dest else None) or []:
+        if inlined.error or not inlined.response:
+            continue
+        try:
+            scripts.extend(_validate_bulk_scripts(kind, json.loads(inlined.response.text)))
+        except ValueError as e:
+            print(f"  - Bỏ một response lỗi JSON trong batch job {job_name}: {e}")
+    print(f"✅ Batch job {job_name}: {len(scripts)} kịch bản hợp lệ.")
+    return scripts
+
+# --- LỊCH SỬ NỘI DUNG ĐÃ TẠO + CHỈ MỤC GẦN TRÙNG (SHINGLE + MINHASH/LSH) ---
+# Mỗi kịch bản được chấp nhận được ghi một dòng (app, tiêu đề, chữ ký MinHash) vào bảng content_history của JOB_QUEUE_DB.
+# Chữ ký MinHash được chia thành các band (LSH, bảng content_bands): chỉ so sánh với các kịch bản trùng ít nhất một
+# band, nên tra cứu gần trùng không phải duyệt toàn bộ lịch sử. Mọi tra cứu đọc thẳng từ DB nên scheduler và các
+# worker (nhiều tiến trình) luôn thấy nội dung của nhau. Kịch bản gần trùng bị loại trước khi tải ảnh/upload.
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16 # 16 band x 4 hàng: cặp có Jaccard ~0.5 đã có ~65% khả năng thành ứng viên, ~0.7 là ~99%
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240601) # Hệ số cố định: chữ ký lưu trên đĩa phải so sánh được giữa các lần chạy
+MINHASH_COEFFS = [
+    (_minhash_rng.randrange(1, MINHASH_PRIME), _minhash_rng.randrange(0, MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+def content_shingles(text, k=3):
+    """Tập shingle k từ liên tiếp (chữ thường, bỏ dấu câu, giữ dấu tiếng Việt)."""
+    words = re.findall(r'\w+', text.lower())
+    k = min(k, len(words)) or 1
+    return {' '.join(words[i:i + k]) for i in range(max(1, len(words) - k + 1))}
+
+def minhash_signature(text):
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for shingle in content_shingles(text)
+    ]
+    return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_COEFFS]
+
+def _signature_bands(signature):
+    """Khoá band dạng '<band>:<hash>' (một khoá cho mỗi band của chữ ký)."""
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [
+        f"{band}:" + hashlib.blake2b(repr(signature[band * rows:(band + 1) * rows]).encode('ascii'), digest_size=8).hexdigest()
+        for band in range(MINHASH_BANDS)
+    ]
+
+def script_content_text(script):
+    return ' '.join([script.get('theme') or ''] + [slide['text'] for slide in script['slides']])
+
+def script_title(script):
+    """Tên ngắn của kịch bản dùng trong prompt loại trừ: chủ đề, hoặc câu đầu của slide đầu tiên."""
+    return script.get('theme') or script['slides'][0]['text'].split('.')[0].strip()[:80]
+
+def find_near_duplicate(kind, text, signature=None):
+    """Kịch bản cũ gần trùng nhất (Jaccard ước lượng >= CONTENT_DUP_THRESHOLD) của cùng app, hoặc None."""
+    signature = signature or minhash_signature(text)
+    band_keys = _signature_bands(signature)
+    rows = _job_db().execute(
+        f"SELECT DISTINCT h.title, h.signature FROM content_bands b JOIN content_history h ON h.id = b.history_id "
+        f"WHERE b.kind = ? AND b.band_key IN ({','.join('?' * len(band_keys))})",
+        [kind] + band_keys
+    ).fetchall()
+    best, best_score = None, CONTENT_DUP_THRESHOLD
+    for row in rows:
+        other = json.loads(row['signature'])
+        score = sum(x == y for x, y in zip(signature, other)) / MINHASH_PERMUTATIONS
+        if score >= best_score:
+            best, best_score = {'kind': kind, 'title': row['title'], 'signature': other}, score
+    return best
+
+def _insert_content(conn, kind, title, signature, created_at, job_key=None):
+    cursor = conn.execute(
+        "INSERT INTO content_history (kind, title, created_at, signature, job_key) VALUES (?, ?, ?, ?, ?)",
+        (kind, title, created_at, json.dumps(signature), job_key)
+    )
+    conn.executemany(
+        "INSERT INTO content_bands (band_key, kind, history_id) VALUES (?, ?, ?)",
+        [(band_key, kind, cursor.lastrowid) for band_key in _signature_bands(signature)]
+    )
+    return cursor.lastrowid
+
+def remember_content(kind, title, text, signature=None, job_key=None, check_duplicate=False):
+    """
+    Ghi kịch bản vào lịch sử. Trả về (id dòng lịch sử (dùng cho forget_content), None), hoặc (None, kịch bản gần trùng)
+    khi check_duplicate và lịch sử đã có nội dung gần trùng. Tra cứu và ghi nằm trong cùng một giao dịch BEGIN IMMEDIATE
+    nên hai job chạy song song không thể cùng nhận hai kịch bản gần trùng nhau. Với job_key, dòng cũ của cùng job
+    (lần chạy trước bị crash) được thay thế thay vì ghi thêm.
+    """
+    signature = signature or minhash_signature(text)
+    conn = _job_db()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[system_prompt],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
+        if job_key is not None:
+            conn.execute(
+                "DELETE FROM content_bands WHERE history_id IN (SELECT id FROM content_history WHERE job_key = ?)", (job_key,)
             )
-        )
-
-        data = json.loads(response.text)
-        caption = "Câu chuyện cổ tích." # Caption mặc định
-
-        # XỬ LÝ LINH HOẠT TỪ ĐIỂN HOẶC DANH SÁCH (Tương tự hàm generate_story_and_prompts)
-        if isinstance(data, dict):
-             # Trường hợp Gemini trả về object { "slides": [{}], "caption": "..." }
-            story_slides = data.get('slides', data.get('story', []))
-            caption = data.get('caption', caption)
-        elif isinstance(data, list):
-            # Trường hợp Gemini trả về array trực tiếp [{}, {}]
-            story_slides = data
-            if story_slides and 'caption' in story_slides[-1]:
-                caption = story_slides[-1]['caption'] # Lấy caption từ slide cuối nếu có
-        else:
-            story_slides = []
+            conn.execute("DELETE FROM content_history WHERE job_key = ?", (job_key,))
+        duplicate = find_near_duplicate(kind, text, signature) if check_duplicate else None
+        if duplicate is not None:
+            conn.execute("ROLLBACK")
+            return None, duplicate
+        history_id = _insert_content(conn, kind, title, signature, time.time(), job_key)
+        # Chỉ giữ CONTENT_HISTORY_MAX dòng mới nhất (dọn theo lô khi vượt quá 20%)
+        count = conn.execute("SELECT COUNT(*) FROM content_history").fetchone()[0]
+        if count > CONTENT_HISTORY_MAX * 1.2:
+            cutoff = conn.execute(
+                "SELECT id FROM content_history ORDER BY id DESC LIMIT 1 OFFSET ?", (CONTENT_HISTORY_MAX,)
+            ).fetchone()[0]
+            conn.execute("DELETE FROM content_bands WHERE history_id <= ?", (cutoff,))
+            conn.execute("DELETE FROM content_history WHERE id <= ?", (cutoff,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return history_id, None
+
+def forget_content(history_id):
+    """Xoá một dòng lịch sử (kịch bản đã giữ chỗ nhưng job không đăng được)."""
+    conn = _job_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM content_bands WHERE history_id = ?", (history_id,))
+        conn.execute("DELETE FROM content_history WHERE id = ?", (history_id,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _current_job_key():
+    checkpoint = current_checkpoint()
+    if checkpoint is not None:
+        return checkpoint.key
+    job = current_job()
+    return job['idempotency_key'] if job else None
+
+def reserve_content(kind, script, text=None, signature=None, check_duplicate=True):
+    """
+    Ghi kịch bản của job đang chạy vào lịch sử ngay khi nhận (job khác chạy song song sẽ thấy và tránh trùng).
+    Trả về kịch bản gần trùng đã có trong lịch sử (không giữ chỗ), hoặc None khi đã giữ chỗ. Mỗi job giữ tối đa một
+    dòng (theo key của job), nên job chạy tiếp sau crash không ghi thêm dòng trùng.
+    run_app_job gỡ lại bằng release_reserved_content() nếu job thất bại, để nội dung chưa đăng không bị chặn mãi.
+    """
+    text = text or script_content_text(script)
+    history_id, duplicate = remember_content(
+        kind, script_title(script), text, signature, job_key=_current_job_key(), check_duplicate=check_duplicate
+    )
+    if duplicate is None:
+        _job_context.content_id = history_id
+    return duplicate
+
+def release_reserved_content():
+    history_id = getattr(_job_context, 'content_id', None)
+    _job_context.content_id = None
+    if history_id is not None:
+        try:
+            forget_content(history_id)
+        except sqlite3.Error as e:
+            print(f"  - Cảnh báo: Không gỡ được kịch bản khỏi lịch sử: {e}")
+
+def recent_titles(kind, limit=None):
+    """Tiêu đề các kịch bản gần nhất của app (mới nhất trước), dùng làm danh sách loại trừ trong prompt."""
+    limit = CONTENT_EXCLUDE_RECENT if limit is None else limit
+    rows = _job_db().execute(
+        "SELECT title FROM content_history WHERE kind = ? AND title != '' GROUP BY title ORDER BY MAX(id) DESC LIMIT ?",
+        (kind, limit)
+    ).fetchall()
+    return [row['title'] for row in rows]
+
+def exclusion_prompt(kind):
+    """Đoạn prompt liệt kê nội dung đã làm gần đây để Gemini tránh lặp lại (rỗng nếu chưa có lịch sử)."""
+    titles = recent_titles(kind)
+    if not titles:
+        return ""
+    return "TRÁNH LẶP LẠI các nội dung đã làm gần đây (không dùng lại hoặc biến tấu nhẹ):\n" + "\n".join(f"- {t}" for t in titles)
+
+# --- BỘ ĐỆM KỊCH BẢN TẠO SẴN (SQLITE) + PRODUCER CHẠY NỀN ---
+# Mỗi app (và chủ đề của nó) có một hàng đợi kịch bản đã tạo sẵn bằng chính các hàm Gemini ở trên, lưu trong bảng
+# script_buffer của JOB_QUEUE_DB. Lấy kịch bản ra là một giao dịch BEGIN IMMEDIATE (như claim_job) nên hai worker
+# không bao giờ nhận cùng một kịch bản.
+# Vòng lặp chính lấy kịch bản từ đây nên không phải chờ Gemini; hàng đợi rỗng thì tạo trực tiếp như cũ.
+# Producer nạp lại khi hàng đợi xuống dưới ngưỡng thấp (low) và chỉ nạp đầy tới ngưỡng cao (high)
+# trong khung giờ thấp điểm SCRIPT_BUFFER_OFFPEAK_HOURS. Kịch bản quá SCRIPT_BUFFER_MAX_AGE_HOURS bị bỏ.
+SPIRITUAL_APP_SLIDES = {'phong_thuy': 4, 'tu_vi': 5, 'tarot': 3, 'cung_hoang_dao': 5}
+APP_SCRIPT_KINDS = {
+    1: 'story',
+    2: 'phong_thuy',
+    3: 'tu_vi',
+    4: 'tarot',
+    5: 'cung_hoang_dao',
+    6: 'fairy_tale',
+    7: 'joke'
+}
+_script_buffer_targets = []
+_script_producer_thread = None
+_script_producer_wakeup = threading.Event()
 
-        if not story_slides or not isinstance(story_slides, list):
-            print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ cho Cổ Tích.")
-            return None, None
+def generate_script(kind, topic):
+    """
+    Gọi Gemini tạo kịch bản cho một app. Trả về dict {'slides', 'caption', ...} hoặc None.
+    App Câu Chuyện có thêm 'theme'; các app tâm linh có thêm 'image_query'.
+    """
+    if kind == 'story':
+        if STORY_SINGLE_CALL:
+            theme, story_slides, caption = generate_theme_and_story(topic)
+            if story_slides:
+                return {'theme': theme, 'slides': story_slides, 'caption': caption}
+        theme = propose_random_theme(topic)
+        if not theme:
+            return None
+        story_slides, caption = generate_story_and_prompts(theme)
+        return {'theme': theme, 'slides': story_slides, 'caption': caption} if story_slides else None
+    if kind in SPIRITUAL_APP_SLIDES:
+        story_slides, image_query, caption = propose_content_and_image_query(kind, topic, num_slides=SPIRITUAL_APP_SLIDES[kind])
+        return {'slides': story_slides, 'image_query': image_query, 'caption': caption} if story_slides else None
+    if kind == 'fairy_tale':
+        story_slides, caption = generate_fairy_tale()
+    elif kind == 'joke':
+        story_slides, caption = generate_joke()
+    else:
+        return None
+    return {'slides': story_slides, 'caption': caption} if story_slides else None
 
-        print("✅ Đã tạo kịch bản Truyện Cổ Tích thành công.")
-        return story_slides, caption
+def _script_buffer_key(kind, topic):
+    return f"{kind}:{topic or ''}"
 
-    except Exception as e:
-        print(f"Lỗi khi gọi Gemini tạo kịch bản Truyện Cổ Tích: {e}")
-        return None, None
+def _script_watermarks(kind):
+    return SCRIPT_BUFFER_WATERMARKS.get(kind, (SCRIPT_BUFFER_LOW, SCRIPT_BUFFER_HIGH))
 
-# --- HÀM TẠO TRUYỆN CƯỜI (GEMINI) ---
-def generate_joke():
-    print("Bắt đầu: Yêu cầu Gemini tạo một câu chuyện cười ngắn, mạnh...")
+def _script_buffer_min_created_at():
+    return time.time() - SCRIPT_BUFFER_MAX_AGE_HOURS * 3600
 
-    # System Prompt cho Truyện Cười
-    system_prompt = """
-    Bạn là một diễn viên hài độc thoại chuyên nghiệp. Nhiệm vụ của bạn là tạo MỘT câu chuyện cười/tình huống hài hước ngắn gọn.
-    QUY TẮC:
-    1. Câu chuyện phải cực kỳ ngắn gọn, có **tác động gây cười mạnh mẽ và bất ngờ** ở slide cuối cùng.
-    2. Kịch bản phải dài **3 đến 5 slides** (tình huống, diễn biến, punchline). Mỗi slide TỐI ĐA 30 từ.
-    3. Output BẮT BUỘC phải là một đối tượng JSON (array of objects) với các khóa sau:
-       - 'text': Nội dung ngắn gọn cho slide.
-       - 'image_query': Một từ khóa tiếng Anh hài hước/độc đáo (3-5 từ) để tìm ảnh nền cho slide này (Ví dụ: 'surprised face meme', 'funny cartoon dog', 'awkward situation').
-       - 'caption': Phần caption cuối cùng cho toàn bộ video (chứa cả hashtag).
-    """
+def script_buffer_size(kind, topic):
+    return _job_db().execute(
+        "SELECT COUNT(*) FROM script_buffer WHERE buffer_key = ? AND created_at >= ?",
+        (_script_buffer_key(kind, topic), _script_buffer_min_created_at())
+    ).fetchone()[0]
 
+def push_script(kind, topic, script, signature=None):
+    key = _script_buffer_key(kind, topic)
+    signature = signature or minhash_signature(script_content_text(script))
+    conn = _job_db()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[system_prompt],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-            )
+        conn.execute(
+            "INSERT INTO script_buffer (buffer_key, kind, created_at, script, signature) VALUES (?, ?, ?, ?, ?)",
+            (key, kind, time.time(), json.dumps(script, ensure_ascii=False), json.dumps(signature))
         )
+        # Không bao giờ giữ quá ngưỡng cao: bỏ kịch bản cũ nhất
+        conn.execute(
+            "DELETE FROM script_buffer WHERE buffer_key = ? AND id NOT IN "
+            "(SELECT id FROM script_buffer WHERE buffer_key = ? ORDER BY id DESC LIMIT ?)",
+            (key, key, _script_watermarks(kind)[1])
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def find_buffered_duplicate(kind, signature):
+    """Kịch bản đang nằm trong bộ đệm (mọi chủ đề của app) gần trùng với signature, hoặc None."""
+    rows = _job_db().execute(
+        "SELECT script, signature FROM script_buffer WHERE kind = ? AND signature IS NOT NULL", (kind,)
+    ).fetchall()
+    for row in rows:
+        score = sum(x == y for x, y in zip(signature, json.loads(row['signature']))) / MINHASH_PERMUTATIONS
+        if score >= CONTENT_DUP_THRESHOLD:
+            return json.loads(row['script'])
+    return None
+
+def pop_script(kind, topic):
+    """Lấy (và xoá) kịch bản cũ nhất còn hạn của app (FIFO) trong một giao dịch, None nếu hàng đợi rỗng."""
+    conn = _job_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM script_buffer WHERE created_at < ?", (_script_buffer_min_created_at(),))
+        row = conn.execute(
+            "SELECT id, script FROM script_buffer WHERE buffer_key = ? ORDER BY id LIMIT 1", (_script_buffer_key(kind, topic),)
+        ).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM script_buffer WHERE id = ?", (row['id'],))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    _script_producer_wakeup.set()
+    return json.loads(row['script'])
 
-        data = json.loads(response.text)
-        caption = "Truyện cười hài hước." # Caption mặc định
-
-        # XỬ LÝ LINH HOẠT (Tương tự hàm generate_fairy_tale)
-        if isinstance(data, dict):
-            story_slides = data.get('slides', data.get('joke', []))
-            caption = data.get('caption', caption)
-        elif isinstance(data, list):
-            story_slides = data
-            if story_slides and 'caption' in story_slides[-1]:
-                caption = story_slides[-1]['caption']
-        else:
-            story_slides = []
+def pending_batch_count(kind, topic):
+    """Số kịch bản đang chờ từ các batch job đã gửi cho hàng đợi này."""
+    return _job_db().execute(
+        "SELECT COALESCE(SUM(count), 0) FROM script_batches WHERE kind = ? AND topic = ?", (kind, topic or '')
+    ).fetchone()[0]
+
+def submit_buffer_batch(kind, topic, count):
+    """
+    Gửi batch job nạp count kịch bản cho hàng đợi. Dòng script_batches được ghi TRƯỚC khi gửi (trong giao dịch, kiểm
+    tra chưa có batch nào của hàng đợi) nên nhiều producer không gửi trùng. False nếu không gửi (đã có batch, hoặc lỗi).
+    """
+    conn = _job_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM script_batches WHERE kind = ? AND topic = ?", (kind, topic or '')).fetchone():
+            conn.execute("ROLLBACK")
+            return False
+        batch_id = conn.execute(
+            "INSERT INTO script_batches (kind, topic, count, created_at) VALUES (?, ?, ?, ?)",
+            (kind, topic or '', count, time.time())
+        ).lastrowid
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    try:
+        job_name = submit_bulk_scripts_batch(kind, count)
+    except Exception as e:
+        conn.execute("DELETE FROM script_batches WHERE id = ?", (batch_id,))
+        print(f"  - Producer kịch bản: không gửi được batch job {kind} ({e}), tạo đồng bộ.")
+        return False
+    conn.execute("UPDATE script_batches SET name = ? WHERE id = ?", (job_name, batch_id))
+    return True
+
+def collect_buffer_batches():
+    """Lấy kết quả các batch job đã xong và nạp vào bộ đệm. Trả về True nếu có kịch bản mới."""
+    conn = _job_db()
+    # Producer chết giữa lúc gửi: bỏ dòng giữ chỗ để hàng đợi không bị chặn mãi
+    conn.execute("DELETE FROM script_batches WHERE name IS NULL AND created_at < ?", (time.time() - 600,))
+    produced = False
+    for row in conn.execute("SELECT id, name, kind, topic FROM script_batches WHERE name IS NOT NULL").fetchall():
+        try:
+            scripts = collect_bulk_scripts_batch(row['kind'], row['name'])
+        except Exception as e:
+            print(f"  - Producer kịch bản: lỗi khi kiểm tra batch job {row['name']} ({e}).")
+            continue
+        # Chỉ tiến trình xoá được dòng của batch mới nạp kết quả (producer khác cũng có thể vừa lấy xong)
+        if scripts is None or conn.execute("DELETE FROM script_batches WHERE id = ?", (row['id'],)).rowcount != 1:
+            continue
+        produced = _push_new_scripts(row['kind'], row['topic'], scripts) or produced
+    return produced
+
+def _push_new_scripts(kind, topic, scripts):
+    """Nạp các kịch bản vào bộ đệm, bỏ kịch bản gần trùng với nội dung đã làm lẫn với kịch bản đang chờ trong bộ đệm."""
+    produced = False
+    for script in filter(None, scripts):
+        signature = minhash_signature(script_content_text(script))
+        if find_near_duplicate(kind, None, signature) or find_buffered_duplicate(kind, signature):
+            continue
+        push_script(kind, topic, script, signature)
+        print(f"  - Producer kịch bản: đã nạp {kind} '{topic}' ({script_buffer_size(kind, topic)}/{_script_watermarks(kind)[1]}).")
+        produced = True
+    return produced
+
+def _next_script(kind, topic):
+    if SCRIPT_BUFFER_ENABLED:
+        script = pop_script(kind, topic)
+        if script:
+            print(f"♻️ Dùng kịch bản tạo sẵn cho {kind} (bỏ qua chờ Gemini).")
+            return script
+        print(f"  - Bộ đệm kịch bản {kind} đang rỗng, tạo trực tiếp bằng Gemini...")
+    return generate_script(kind, topic)
+
+def take_script(kind, topic):
+    """
+    Kịch bản cho một lần chạy app: ưu tiên bộ đệm, hết thì gọi Gemini trực tiếp.
+    Kịch bản gần trùng với nội dung đã làm bị loại (tạo lại tối đa CONTENT_DUP_MAX_RETRIES lần) TRƯỚC khi
+    tải ảnh nền/upload; kịch bản được chấp nhận được giữ chỗ trong lịch sử (gỡ lại nếu job thất bại, xem
+    reserve_content) và ghi vào checkpoint của job (job chạy tiếp sau crash dùng lại đúng kịch bản đó).
+    """
+    checkpoint = current_checkpoint()
+    if checkpoint is not None and checkpoint.get('script'):
+        print("  - Dùng lại kịch bản đã lưu trong checkpoint của job.")
+        script = checkpoint.get('script')
+        reserve_content(kind, script, check_duplicate=False) # Lần chạy trước thất bại đã gỡ khỏi lịch sử
+        return script
+    for attempt in range(CONTENT_DUP_MAX_RETRIES + 1):
+        script = _next_script(kind, topic)
+        if not script:
+            return None
+        text = script_content_text(script)
+        signature = minhash_signature(text)
+        duplicate = reserve_content(kind, script, text, signature)
+        if duplicate is None:
+            if checkpoint is not None:
+                checkpoint.set('script', script)
+            return script
+        print(f"⚠️ Kịch bản {kind} gần trùng với nội dung đã làm: '{duplicate['title']}'. Bỏ qua.")
+    print(f"❌ Không tạo được kịch bản {kind} mới sau {CONTENT_DUP_MAX_RETRIES + 1} lần thử.")
+    return None
+
+def script_targets_for_app_modes(app_modes):
+    """Danh sách (kind, topic) mà producer cần nạp sẵn, theo cùng quy tắc chọn chủ đề của vòng lặp chính."""
+    targets = []
+    for app_id, config in app_modes.items():
+        kind = APP_SCRIPT_KINDS.get(app_id)
+        domains = config.get('domains') or []
+        if kind == 'story':
+            targets.extend((kind, domain) for domain in domains)
+        elif kind in ('fairy_tale', 'joke'):
+            targets.append((kind, ''))
+        elif kind and domains:
+            targets.append((kind, domains[0]))
+    return targets
+
+def _is_offpeak(now=None):
+    if not SCRIPT_BUFFER_OFFPEAK_HOURS:
+        return True
+    start_hour, end_hour = SCRIPT_BUFFER_OFFPEAK_HOURS
+    hour = (now or datetime.datetime.now()).hour
+    if start_hour <= end_hour:
+        return start_hour <= hour < end_hour
+    return hour >= start_hour or hour < end_hour # Khung giờ qua nửa đêm, ví dụ 22-6
+
+def _script_producer_loop():
+    while True:
+        _script_producer_wakeup.clear()
+        offpeak = _is_offpeak()
+        try:
+            produced = collect_buffer_batches()
+        except sqlite3.Error as e:
+            print(f"  - Producer kịch bản: lỗi khi đọc batch job đang chờ ({e}).")
+            produced = False
+        for kind, topic in list(_script_buffer_targets):
+            low, high = _script_watermarks(kind)
+            size = script_buffer_size(kind, topic)
+            target = high if offpeak else low
+            pending = pending_batch_count(kind, topic) if kind in BULK_SCRIPT_SPECS else 0
+            if size >= target or (size >= low and size + pending >= target):
+                continue
+            shortfall = target - size - pending if size >= low else target - size
+            try:
+                if kind in BULK_SCRIPT_SPECS:
+                    # Truyện cười/cổ tích không phụ thuộc chủ đề: nạp cả phần thiếu trong một request, hoặc qua
+                    # Batch API (rẻ hơn, chậm) khi phần thiếu lớn và bộ đệm chưa cạn
+                    if (SCRIPT_BUFFER_BATCH_MIN > 0 and size >= low and shortfall >= SCRIPT_BUFFER_BATCH_MIN
+                            and submit_buffer_batch(kind, topic, shortfall)):
+                        continue
+                    scripts = generate_scripts_bulk(kind, shortfall)
+                else:
+                    scripts = [generate_script(kind, topic)]
+            except Exception as e:
+                print(f"  - Producer kịch bản: lỗi khi tạo {kind} ({e}).")
+                scripts = []
+            produced = _push_new_scripts(kind, topic, scripts) or produced
+        if not produced:
+            # Mọi hàng đợi đã đủ (hoặc Gemini lỗi): chờ tới lượt kiểm tra sau hoặc khi có kịch bản bị lấy ra
+            _script_producer_wakeup.wait(SCRIPT_BUFFER_POLL_SECONDS)
+
+def start_script_producer(targets):
+    """Cập nhật danh sách app cần nạp sẵn và khởi động producer chạy nền (một lần)."""
+    global _script_buffer_targets, _script_producer_thread
+    _script_buffer_targets = list(targets)
+    if _script_producer_thread is None:
+        _script_producer_thread = threading.Thread(target=_script_producer_loop, name='script_producer', daemon=True)
+        _script_producer_thread.start()
+    _script_producer_wakeup.set()
+
+# --- KHÔNG GIAN LÀM VIỆC CỦA MỖI JOB (CHỈ DÙNG KHI BẬT GHI RA ĐĨA) ---
+@contextlib.contextmanager
+def slide_workspace():
+    """
+    Mặc định slide chỉ nằm trong bộ nhớ (yield None). Khi bật SLIDE_SPILL_TO_DISK, tạo thư mục tạm
+    riêng cho job (ưu tiên tmpfs /dev/shm) và tự xoá khi job kết thúc, kể cả khi gặp lỗi giữa chừng.
+    """
+    if not SLIDE_SPILL_TO_DISK:
+        yield None
+        return
+    base_dir = SLIDE_SPILL_DIR or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+    with tempfile.TemporaryDirectory(prefix='tktk_job_', dir=base_dir) as job_dir:
+        yield job_dir
+
+# --- PIPELINE NHIỀU TẦNG CHO CÁC SLIDE (TẢI NỀN / VẼ / UPLOAD) ---
+# Tầng tải ảnh nền và tầng upload Drive chạy trên hai thread pool riêng; tầng vẽ chạy trên process pool theo số nhân CPU.
+# Pool được tạo một lần và dùng chung cho mọi job.
+_io_pool = None
+_upload_pool = None
+_render_pool = None
+_pipeline_pool_lock = threading.Lock()
+
+def get_io_pool():
+    global _io_pool
+    with _pipeline_pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=PIPELINE_IO_WORKERS, thread_name_prefix='slide_io')
+        return _io_pool
+
+def get_upload_pool():
+    """Thread pool riêng cho upload Drive: giới hạn số file đẩy lên cùng lúc (quota Drive) độc lập với tầng tải nền."""
+    global _upload_pool
+    with _pipeline_pool_lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPoolExecutor(max_workers=DRIVE_UPLOAD_WORKERS, thread_name_prefix='drive_upload')
+        return _upload_pool
+
+def get_render_pool():
+    """Process pool cho tầng vẽ; None nếu PIPELINE_RENDER_WORKERS = 0 (vẽ ngay trong thread I/O)."""
+    global _render_pool
+    if PIPELINE_RENDER_WORKERS <= 0:
+        return None
+    with _pipeline_pool_lock:
+        if _render_pool is None:
+            # Không fork từ tiến trình đang có nhiều thread (dễ kẹt lock); dùng forkserver/spawn
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _render_pool = ProcessPoolExecutor(max_workers=PIPELINE_RENDER_WORKERS, mp_context=context)
+        return _render_pool
+
+def _reset_render_pool():
+    global _render_pool
+    with _pipeline_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+def run_slide_pipeline(drive_service, story_slides, folder_id, slide_queries, spill_dir=None, prefetched_backgrounds=None, rendered_slides=None, checkpoint=None):
+    """
+    Chạy các slide qua 3 tầng chồng lấn nhau: tải nền -> vẽ -> upload.
+    Nếu đã có prefetched_backgrounds (tải trước bằng lớp async) thì bỏ qua tầng tải nền.
+    Tối đa PIPELINE_MAX_IN_FLIGHT slide nằm trong pipeline cùng lúc (giới hạn bộ nhớ ảnh đã giải mã).
+    Trả về danh sách link theo ĐÚNG thứ tự slide (bỏ qua slide lỗi).
+    Nếu truyền list rendered_slides, JPEG của các slide vẽ được sẽ được thêm vào đó theo thứ tự slide.
+    Nếu có checkpoint của job: ảnh nền, hash JPEG và file đã upload của từng slide được ghi lại ngay sau mỗi tầng.
+    Slide đã upload ở lần chạy trước không upload lại (chỉ vẽ lại từ nền đã lưu khi cần rendered_slides).
+    """
+    io_pool = get_io_pool()
+    upload_pool = get_upload_pool()
+    render_pool = get_render_pool()
+    total = len(story_slides)
+    drive_links = [None] * total
+    slide_jpegs = [None] * total
+    pending = {} # future -> (tầng, chỉ số slide)
+    backgrounds = {} # Ảnh nền đang chờ vẽ, giữ lại để vẽ lại nếu process pool hỏng
+    next_index = 0
+
+    def submit_render(i, background):
+        if render_pool is not None:
+            return render_pool.submit(render_slide_timed, story_slides[i]['text'], background)
+        return io_pool.submit(render_slide_timed, story_slides[i]['text'], background)
+
+    def fetch_and_keep(i):
+        background = fetch_background(drive_service, i + 1, slide_queries[i])
+        if checkpoint is not None and background is not None:
+            checkpoint.save_background(i, background)
+        return background
+
+    while next_index < total or pending:
+        # Nạp thêm slide vào tầng đầu khi còn chỗ trong pipeline
+        while next_index < total and len(pending) < PIPELINE_MAX_IN_FLIGHT:
+            i = next_index
+            next_index += 1
+            if checkpoint is not None:
+                drive_links[i] = checkpoint.slide(i).get('link')
+                if drive_links[i] and rendered_slides is None:
+                    continue # Đã upload ở lần chạy trước
+            if prefetched_backgrounds is not None:
+                background = prefetched_backgrounds[i] # Đã gồm nền mở lại từ checkpoint
+            else:
+                background = checkpoint.load_background(i) if checkpoint is not None else None
+            if background is None:
+                pending[io_pool.submit(fetch_and_keep, i)] = ('fetch', i)
+                continue
+            backgrounds[i] = background
+            pending[submit_render(i, background)] = ('render', i)
+
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, i = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                if stage == 'render' and isinstance(e, BrokenProcessPool):
+                    # Process pool hỏng (worker chết): tạo lại pool lần sau, vẽ slide này ngay tại thread I/O
+                    print(f"  - Cảnh báo: Process pool vẽ slide bị hỏng ({e}). Vẽ lại slide {i + 1} trong thread.")
+                    _reset_render_pool()
+                    render_pool = None
+                    pending[io_pool.submit(render_slide_timed, story_slides[i]['text'], backgrounds.get(i))] = ('render', i)
+                    continue
+                print(f"  - Lỗi slide {i + 1} ở bước {stage}: {e}")
+                backgrounds.pop(i, None)
+                if stage == 'fetch':
+                    # Không lấy được nền vẫn vẽ được slide (nền đen)
+                    pending[submit_render(i, None)] = ('render', i)
+                continue
+
+            if stage == 'fetch':
+                backgrounds[i] = result
+                pending[submit_render(i, result)] = ('render', i)
+            elif stage == 'render':
+                backgrounds.pop(i, None)
+                result, timings = result
+                observe_stages(timings)
+                slide_jpegs[i] = result
+                if checkpoint is not None:
+                    checkpoint.record_render(i, result)
+                if drive_links[i]:
+                    continue # Đã upload ở lần chạy trước, chỉ vẽ lại để gửi album
+                final_image = package_slide(result, i + 1, spill_dir)
+                future = upload_pool.submit(upload_slide_to_drive, final_image, drive_service, folder_id, i, checkpoint)
+                pending[future] = ('upload', i)
+            else:
+                drive_links[i] = result
 
-        if not story_slides or not isinstance(story_slides, list) or len(story_slides) < 3:
-            print("Lỗi: Gemini không trả về dữ liệu slides hợp lệ cho Truyện Cười (Cần ít nhất 3 slides).")
-            return None, None
+    if rendered_slides is not None:
+        rendered_slides.extend(jpeg for jpeg in slide_jpegs if jpeg)
+    return [link for link in drive_links if link]
 
-        print("✅ Đã tạo kịch bản Truyện Cười thành công.")
-        return story_slides, caption
+# --- HÀM XỬ LÝ CHUNG: TẠO ẢNH TỪNG SLIDE VÀ TẢI LÊN DRIVE ---
+def render_and_upload_slides(drive_service, story_slides, folder_id, image_query, slide_query_key=None, rendered_slides=None):
+    """
+    Tạo ảnh cho từng slide rồi tải thẳng lên Drive, trả về danh sách alternateLink theo thứ tự slide.
+    Nếu slide_query_key được truyền, mỗi slide dùng query riêng (dự phòng bằng image_query).
+    Nếu truyền list rendered_slides, JPEG của từng slide được giữ lại trong đó (để gửi album Telegram).
+    """
+    slide_queries = [
+        slide.get(slide_query_key, image_query) if slide_query_key else image_query
+        for slide in story_slides
+    ]
+    total = len(story_slides)
+    # Checkpoint của job đang chạy (nếu có): slide nào đã có nền/đã upload ở lần chạy trước thì không làm lại
+    checkpoint = current_checkpoint()
+    saved_slides = [checkpoint.slide(i) if checkpoint is not None else {} for i in range(total)]
+
+    # Tải ảnh nền của job cùng lúc qua lớp mạng async (nếu bật), bỏ qua slide mở lại được nền từ checkpoint
+    # (nền trong checkpoint hỏng hoặc đã bị loại khỏi cache thì tải nền mới như slide chưa có nền)
+    backgrounds = None
+    if ASYNC_PREFETCH_BACKGROUNDS:
+        backgrounds = [None] * total
+        needed = [i for i, saved in enumerate(saved_slides) if not (saved.get('link') and rendered_slides is None)]
+        if checkpoint is not None:
+            for i in needed:
+                backgrounds[i] = checkpoint.load_background(i)
+        missing = [i for i in needed if backgrounds[i] is None]
+        fetched = fetch_backgrounds(drive_service, [slide_queries[i] for i in missing]) if missing else []
+        for i, background in zip(missing, fetched):
+            backgrounds[i] = background
+        if checkpoint is not None:
+            kept = [(i, backgrounds[i]) for i in missing if backgrounds[i] is not None]
+            list(get_io_pool().map(lambda item: checkpoint.save_background(*item), kept))
+
+    with slide_workspace() as spill_dir:
+        if PIPELINE_ENABLED:
+            return run_slide_pipeline(
+                drive_service, story_slides, folder_id, slide_queries, spill_dir, backgrounds, rendered_slides, checkpoint
+            )
 
-    except Exception as e:
-        print(f"Lỗi khi gọi Gemini tạo kịch bản Truyện Cười: {e}")
-        return None, None
+        # Vẽ tuần tự, sau đó upload song song toàn bộ slide của job
+        drive_links = [saved.get('link') for saved in saved_slides]
+        final_images = []
+        for i, slide in enumerate(story_slides):
+            if drive_links[i] and rendered_slides is None:
+                continue # Đã upload ở lần chạy trước
+            if backgrounds is not None:
+                background = backgrounds[i]
+            else:
+                background = checkpoint.load_background(i) if checkpoint is not None else None
+            if background is None:
+                background = fetch_background(drive_service, i + 1, slide_queries[i])
+                if checkpoint is not None and background is not None:
+                    checkpoint.save_background(i, background)
+            jpeg_bytes = render_slide(slide['text'], background)
+            if checkpoint is not None:
+                checkpoint.record_render(i, jpeg_bytes)
+            if rendered_slides is not None:
+                rendered_slides.append(jpeg_bytes)
+            if drive_links[i]:
+                continue
+            final_image = package_slide(jpeg_bytes, i + 1, spill_dir)
+            if final_image:
+                final_images.append((i, final_image))
+        upload_pool = get_upload_pool()
+        futures = [
+            (i, upload_pool.submit(upload_slide_to_drive, final_image, drive_service, folder_id, i, checkpoint))
+            for i, final_image in final_images
+        ]
+        for i, future in futures:
+            drive_links[i] = future.result()
+        return [link for link in drive_links if link]
 
 # ==========================================================
 # --- KHỐI HÀM APP CON ---
 # ==========================================================
+# Mỗi app trả về True khi bài đã được đăng trọn vẹn (mọi slide lên Drive + Telegram đã nhận thông báo), False nếu thất bại
+# ở bất kỳ bước nào. run_app_job dựa vào kết quả này để ack/thử lại job và tính số liệu.
+def deliver_result(app_label, story_slides, drive_file_links, full_message, slide_images):
+    """Bước cuối của app: thiếu slide thì báo lỗi (job được thử lại từ checkpoint), đủ thì gửi kết quả lên Telegram."""
+    if len(drive_file_links) < len(story_slides):
+        send_telegram_notification(
+            f"❌ Quy trình {app_label} thất bại: chỉ tải lên được {len(drive_file_links)}/{len(story_slides)} slide."
+        )
+        return False
+    # Phần album đã gửi ở lần chạy trước (lưu trong checkpoint) không gửi lại
+    checkpoint = current_checkpoint()
+    delivered = send_telegram_notification(
+        full_message, image_urls=drive_file_links, slide_images=slide_images,
+        album_start=(checkpoint.get('album_sent') or 0) if checkpoint is not None else 0,
+        on_album_progress=(lambda sent: checkpoint.set('album_sent', sent)) if checkpoint is not None else None
+    )
+    if not delivered:
+        print(f"❌ Chưa gửi được kết quả {app_label} lên Telegram. Job sẽ được thử lại.")
+        return False
+    if checkpoint is not None:
+        checkpoint.set('notified', True) # Crash trước khi xoá checkpoint: lần chạy tiếp không đăng lại
+    return True
 
 # 1. HÀM APP CÂU CHUYỆN
 def run_story_app(drive_service, theme_domain):
     print("\n--- 📝 App Câu Chuyện Khởi Động ---")
     print(f"-> Sử dụng lĩnh vực: {theme_domain}")
 
-    # 1. AI TỰ ĐỀ XUẤT CHỦ ĐỀ
-    # Sử dụng lĩnh vực đã chọn ngẫu nhiên để đề xuất chủ đề cụ thể
-    chosen_theme = propose_random_theme(theme_domain)
-    if not chosen_theme:
-        send_telegram_notification("❌ Lỗi: Không thể đề xuất chủ đề từ AI.")
-        return
-
-    # 2. TẠO KỊCH BẢN
-    story_slides, final_caption = generate_story_and_prompts(chosen_theme)
-    if not story_slides:
-        send_telegram_notification(f"❌ Lỗi: Không thể tạo kịch bản cho chủ đề '{chosen_theme}'.")
-        return
+    # 1 + 2. ĐỀ XUẤT CHỦ ĐỀ VÀ TẠO KỊCH BẢN (lấy từ bộ đệm tạo sẵn nếu có, xem generate_script)
+    script = take_script('story', theme_domain)
+    if not script:
+        send_telegram_notification(f"❌ Lỗi: Không thể tạo chủ đề/kịch bản cho lĩnh vực '{theme_domain}'.")
+        return False
+    chosen_theme, story_slides, final_caption = script['theme'], script['slides'], script['caption']
 
     # 3. TẠO THƯ MỤC MỚI
     safe_folder_name = re.sub(r'[^\w\s-]', '', chosen_theme).strip()[:50] # bỏ .replace(' ', '-')
@@ -696,45 +2964,29 @@ def run_story_app(drive_service, theme_domain):
 
     if not new_folder_id:
         send_telegram_notification(f"❌ Lỗi: Không thể tạo thư mục Drive cho chủ đề '{chosen_theme}'.")
-        return
+        return False
 
     # 4. LẶP QUA CÁC SLIDE & TẢI LÊN DRIVE (Logic giữ nguyên)
-    drive_file_links = []
     print(f"\n--- Bắt đầu xử lý {len(story_slides)} slides cho chủ đề: '{chosen_theme}' ---")
-
-    for i, slide in enumerate(story_slides):
-        final_image_file = create_image_with_text(
-            slide['text'],
-            drive_service,
-            i + 1,
-            chosen_theme # Theme dùng làm query dự phòng cho ảnh
-        )
-
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link:
-                drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file):
-                os.remove(final_image_file)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, chosen_theme, rendered_slides=slide_images)
 
     # 5. GỬI THÔNG BÁO CUỐI CÙNG
-    if drive_file_links:
-        full_message = (
-            f"✅ <b>Quy trình CÂU CHUYỆN HOÀN TẤT!</b>\n"
-            f"<b>Chủ đề:</b> {chosen_theme}\n"
-            f"<b>Caption gợi ý:</b> {final_caption}\n\n"
-        )
-        send_telegram_notification(full_message, image_urls=drive_file_links)
-    else:
-        send_telegram_notification(f"❌ Quy trình Câu chuyện thất bại cho chủ đề '{chosen_theme}'.")
+    full_message = (
+        f"✅ <b>Quy trình CÂU CHUYỆN HOÀN TẤT!</b>\n"
+        f"<b>Chủ đề:</b> {chosen_theme}\n"
+        f"<b>Caption gợi ý:</b> {final_caption}\n\n"
+    )
+    return deliver_result('Câu chuyện', story_slides, drive_file_links, full_message, slide_images)
 
 # 2. HÀM APP PHONG THỦY
 def run_phong_thuy(drive_service, topic):
     print(f"--- 🔮 App Phong Thủy Khởi Động cho chủ đề: {topic} ---")
 
     # 1. TẠO NỘI DUNG & PROMPT ẢNH
-    story_slides, image_query, final_caption = propose_content_and_image_query('phong_thuy', topic, num_slides=4)
-    if not story_slides: return
+    script = take_script('phong_thuy', topic)
+    if not script: return False
+    story_slides, image_query, final_caption = script['slides'], script['image_query'], script['caption']
 
     # 2. TẠO THƯ MỤC VÀ UPLOAD
     safe_folder_name = f"PT {topic}" # bỏ .replace(' ', '-')
@@ -742,107 +2994,75 @@ def run_phong_thuy(drive_service, topic):
 
     if not new_folder_id:
         send_telegram_notification(f"❌ Lỗi: Không thể tạo thư mục Drive cho Phong Thủy.")
-        return
+        return False
 
-    drive_file_links = []
-    for i, slide in enumerate(story_slides):
-        # TẠO ẢNH: Sử dụng image_query cố định cho Phong Thủy
-        final_image_file = create_image_with_text(
-            slide['text'],
-            drive_service,
-            i + 1,
-            image_query # Dùng query cố định cho chủ đề này
-        )
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link: drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file): os.remove(final_image_file)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, image_query, rendered_slides=slide_images)
 
-    if drive_file_links:
-        full_message = (f"✅ <b>Quy trình PHONG THỦY HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
-        send_telegram_notification(full_message, image_urls=drive_file_links)
+    full_message = (f"✅ <b>Quy trình PHONG THỦY HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
+    return deliver_result('Phong Thủy', story_slides, drive_file_links, full_message, slide_images)
 
 # 3. HÀM APP TỬ VI
 def run_la_so_tu_vi(drive_service, topic):
     print(f"--- 🌌 App Tử Vi Khởi Động cho chủ đề: {topic} ---")
 
-    story_slides, image_query, final_caption = propose_content_and_image_query('tu_vi', topic, num_slides=5)
-    if not story_slides: return
+    script = take_script('tu_vi', topic)
+    if not script: return False
+    story_slides, image_query, final_caption = script['slides'], script['image_query'], script['caption']
 
     safe_folder_name = f"TV {topic}" # bỏ .replace(' ', '-')
     new_folder_id = create_drive_folder(safe_folder_name, TU_VI_DRIVE_FOLDER_ID, drive_service)
 
     if not new_folder_id:
         send_telegram_notification(f"❌ Lỗi: Không thể tạo thư mục Drive cho Tử Vi.")
-        return
+        return False
 
-    drive_file_links = []
-    for i, slide in enumerate(story_slides):
-        final_image_file = create_image_with_text(
-            slide['text'],
-            drive_service,
-            i + 1,
-            image_query
-        )
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link: drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file): os.remove(final_image_file)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, image_query, rendered_slides=slide_images)
 
-    if drive_file_links:
-        full_message = (f"✅ <b>Quy trình TỬ VI HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
-        send_telegram_notification(full_message, image_urls=drive_file_links)
+    full_message = (f"✅ <b>Quy trình TỬ VI HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
+    return deliver_result('Tử Vi', story_slides, drive_file_links, full_message, slide_images)
 
 # 4. HÀM APP TAROT
 def run_tarot(drive_service, topic):
     print(f"--- 🃏 App Tarot Khởi Động cho chủ đề: {topic} ---")
 
-    story_slides, image_query, final_caption = propose_content_and_image_query('tarot', topic, num_slides=3)
-    if not story_slides: return
+    script = take_script('tarot', topic)
+    if not script: return False
+    story_slides, image_query, final_caption = script['slides'], script['image_query'], script['caption']
 
     safe_folder_name = f"Tarot {topic}" # bỏ .replace(' ', '-')
     new_folder_id = create_drive_folder(safe_folder_name, TAROT_DRIVE_FOLDER_ID, drive_service)
 
-    if not new_folder_id: return
+    if not new_folder_id: return False
 
     # Lặp và upload ảnh
-    drive_file_links = []
-    for i, slide in enumerate(story_slides):
-        final_image_file = create_image_with_text(slide['text'], drive_service, i + 1, image_query)
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link: drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file): os.remove(final_image_file)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, image_query, rendered_slides=slide_images)
 
-    if drive_file_links:
-        full_message = (f"✅ <b>Quy trình TAROT HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
-        send_telegram_notification(full_message, image_urls=drive_file_links)
+    full_message = (f"✅ <b>Quy trình TAROT HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
+    return deliver_result('Tarot', story_slides, drive_file_links, full_message, slide_images)
 
 
 # 5. HÀM APP CUNG HOÀNG ĐẠO
 def run_cung_hoang_dao(drive_service, topic):
     print(f"--- 🌟 App Cung Hoàng Đạo Khởi Động cho chủ đề: {topic} ---")
 
-    story_slides, image_query, final_caption = propose_content_and_image_query('cung_hoang_dao', topic, num_slides=5)
-    if not story_slides: return
+    script = take_script('cung_hoang_dao', topic)
+    if not script: return False
+    story_slides, image_query, final_caption = script['slides'], script['image_query'], script['caption']
 
     safe_folder_name = f"CHĐ {topic}" # bỏ .replace(' ', '-')
     new_folder_id = create_drive_folder(safe_folder_name, CUNG_HOANG_DAO_DRIVE_FOLDER_ID, drive_service)
 
-    if not new_folder_id: return
+    if not new_folder_id: return False
 
     # Lặp và upload ảnh
-    drive_file_links = []
-    for i, slide in enumerate(story_slides):
-        final_image_file = create_image_with_text(slide['text'], drive_service, i + 1, image_query)
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link: drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file): os.remove(final_image_file)
-
-    if drive_file_links:
-        full_message = (f"✅ <b>Quy trình CUNG HOÀNG ĐẠO HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
-        send_telegram_notification(full_message, image_urls=drive_file_links)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, image_query, rendered_slides=slide_images)
+
+    full_message = (f"✅ <b>Quy trình CUNG HOÀNG ĐẠO HOÀN TẤT!</b>\n<b>Chủ đề:</b> {topic}\n<b>Caption gợi ý:</b> {final_caption}")
+    return deliver_result('Cung Hoàng Đạo', story_slides, drive_file_links, full_message, slide_images)
 
 # --- HÀM APP TRUYỆN CỔ TÍCH ---
 def run_fairy_tale_app(drive_service, topic=None): # Giữ topic để phù hợp với hàm main, nhưng không dùng
@@ -850,8 +3070,9 @@ def run_fairy_tale_app(drive_service, topic=None): # Giữ topic để phù hợ
 
     # 1. TẠO NỘI DUNG & PROMPT ẢNH (Không cần chủ đề)
     # Hàm generate_fairy_tale sẽ trả về story_slides (gồm text và image_query) và final_caption
-    story_slides, final_caption = generate_fairy_tale()
-    if not story_slides: return
+    script = take_script('fairy_tale', '')
+    if not script: return False
+    story_slides, final_caption = script['slides'], script['caption']
 
     # 2. TẠO THƯ MỤC VÀ UPLOAD
     # Tên thư mục sẽ lấy một phần nội dung slide đầu tiên
@@ -861,34 +3082,23 @@ def run_fairy_tale_app(drive_service, topic=None): # Giữ topic để phù hợ
 
     if not new_folder_id:
         send_telegram_notification(f"❌ Lỗi: Không thể tạo thư mục Drive cho Truyện Cổ Tích.")
-        return
+        return False
 
-    drive_file_links = []
-    for i, slide in enumerate(story_slides):
-        # TẠO ẢNH: Sử dụng image_query của từng slide
-        image_query = slide.get('image_query', 'magical fairy tale forest') # Image query dự phòng
-        final_image_file = create_image_with_text(
-            slide['text'],
-            drive_service,
-            i + 1,
-            image_query
-        )
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link: drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file): os.remove(final_image_file)
+    # TẠO ẢNH: Sử dụng image_query của từng slide (có query dự phòng)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, 'magical fairy tale forest', slide_query_key='image_query', rendered_slides=slide_images)
 
-    if drive_file_links:
-        full_message = (f"✅ <b>Quy trình TRUYỆN CỔ TÍCH HOÀN TẤT!</b>\n<b>Chủ đề:</b> {first_text}...\n<b>Caption gợi ý:</b> {final_caption}")
-        send_telegram_notification(full_message, image_urls=drive_file_links)
+    full_message = (f"✅ <b>Quy trình TRUYỆN CỔ TÍCH HOÀN TẤT!</b>\n<b>Chủ đề:</b> {first_text}...\n<b>Caption gợi ý:</b> {final_caption}")
+    return deliver_result('Truyện Cổ Tích', story_slides, drive_file_links, full_message, slide_images)
 
 # --- HÀM APP TRUYỆN CƯỜI ---
 def run_joke_app(drive_service, topic=None): # Giữ topic để phù hợp với hàm main, nhưng không dùng
     print("--- 😂 App TRUYỆN CƯỜI Khởi Động ---")
 
     # 1. TẠO NỘI DUNG & PROMPT ẢNH (Không cần chủ đề)
-    story_slides, final_caption = generate_joke()
-    if not story_slides: return
+    script = take_script('joke', '')
+    if not script: return False
+    story_slides, final_caption = script['slides'], script['caption']
 
     # 2. TẠO THƯ MỤC VÀ UPLOAD
     # Tên thư mục sẽ lấy một phần nội dung slide đầu tiên
@@ -898,26 +3108,14 @@ def run_joke_app(drive_service, topic=None): # Giữ topic để phù hợp vớ
 
     if not new_folder_id:
         send_telegram_notification(f"❌ Lỗi: Không thể tạo thư mục Drive cho Truyện Cười.")
-        return
+        return False
 
-    drive_file_links = []
-    for i, slide in enumerate(story_slides):
-        # TẠO ẢNH: Sử dụng image_query của từng slide
-        image_query = slide.get('image_query', 'funny unexpected moment') # Image query dự phòng
-        final_image_file = create_image_with_text(
-            slide['text'],
-            drive_service,
-            i + 1,
-            image_query
-        )
-        if final_image_file:
-            drive_link = upload_to_drive(final_image_file, drive_service, new_folder_id)
-            if drive_link: drive_file_links.append(drive_link)
-            if os.path.exists(final_image_file): os.remove(final_image_file)
+    # TẠO ẢNH: Sử dụng image_query của từng slide (có query dự phòng)
+    slide_images = []
+    drive_file_links = render_and_upload_slides(drive_service, story_slides, new_folder_id, 'funny unexpected moment', slide_query_key='image_query', rendered_slides=slide_images)
 
-    if drive_file_links:
-        full_message = (f"✅ <b>Quy trình TRUYỆN CƯỜI HOÀN TẤT!</b>\n<b>Chủ đề:</b> {first_text}...\n<b>Caption gợi ý:</b> {final_caption}")
-        send_telegram_notification(full_message, image_urls=drive_file_links)
+    full_message = (f"✅ <b>Quy trình TRUYỆN CƯỜI HOÀN TẤT!</b>\n<b>Chủ đề:</b> {first_text}...\n<b>Caption gợi ý:</b> {final_caption}")
+    return deliver_result('Truyện Cười', story_slides, drive_file_links, full_message, slide_images)
 
 # ==========================================================
 # --- KHỐI CẤU HÌNH TỰ ĐỘNG CHỌN (MỚI) ---
@@ -938,78 +3136,1221 @@ APP_COLUMN_MAPPING = {
 # ==========================================================
 # --- HÀM TẢI CẤU HÌNH TỪ GOOGLE SHEET (SỬA LẠI THEO CỘT) ---
 # ==========================================================
-def load_app_modes_from_sheet(gsheet_id):
-    EXPORT_URL = f"https://docs.google.com/spreadsheets/d/{gsheet_id}/export?format=csv&gid=0"
+def parse_app_modes_csv(csv_data):
+    """Phân tích CSV xuất từ Sheet thành cấu hình ứng dụng theo cột."""
+    reader = csv.reader(StringIO(csv_data))
+
+    # 1. Đọc dòng tiêu đề (HEADER)
+    try:
+        headers = next(reader)
+        if not headers: raise StopIteration
+    except StopIteration:
+        print("❌ Sheet trống hoặc không có dòng tiêu đề.")
+        return None
+
+    dynamic_app_modes_raw = {}
+
+    # 2. Xử lý tiêu đề và tạo cấu hình ban đầu
+    for col_index, header in enumerate(headers):
+        # Chuẩn hóa tên tiêu đề để so khớp với APP_COLUMN_MAPPING
+        normalized_header = header.strip().upper().replace(' ', '')
+
+        # Lấy ID và tên chính xác dựa trên tiêu đề cột
+        app_id = APP_COLUMN_MAPPING.get(normalized_header)
+
+        if app_id:
+            dynamic_app_modes_raw[app_id] = {
+                "name": header.strip(), # Giữ nguyên tên gốc có dấu
+                "domains": [], # Khởi tạo danh sách domains trống
+                "col_index": col_index # Lưu chỉ mục cột để quét domain sau này
+            }
 
+    if not dynamic_app_modes_raw:
+        print("❌ Không tìm thấy tiêu đề cột hợp lệ (Câu chuyện, Phong thủy,...) trong Sheet.")
+        return None
+
+    # 3. Quét các dòng còn lại để thu thập Domains (chủ đề)
+    for row in reader:
+        for app_id, config in dynamic_app_modes_raw.items():
+            col_index = config["col_index"]
+
+            if col_index < len(row):
+                domain = row[col_index].strip()
+                if domain:
+                    # Thêm domain (chủ đề) vào danh sách ứng dụng tương ứng
+                    config["domains"].append(domain)
+
+    # 4. Loại bỏ chỉ mục cột trước khi trả về
+    for config in dynamic_app_modes_raw.values():
+        del config["col_index"]
+
+    print(f"✅ Đã tải thành công {len(dynamic_app_modes_raw)} cấu hình ứng dụng theo cột.")
+    return dynamic_app_modes_raw
+
+# --- BỘ NHỚ ĐỆM CẤU HÌNH ỨNG DỤNG (TTL + REQUEST CÓ ĐIỀU KIỆN + FILE CỤC BỘ) ---
+# Vòng lặp chính lấy cấu hình qua get_app_modes(): trong TTL thì dùng bản đã có; hết TTL thì trả ngay bản cũ
+# và kiểm tra lại Sheet ở thread nền bằng If-None-Match/If-Modified-Since (304 = không đổi, không tải lại CSV).
+# Tải lỗi thì tiếp tục dùng cấu hình tốt gần nhất (lưu cả ra đĩa để dùng sau khi khởi động lại).
+# Nếu đặt APP_CONFIG_LOCAL_FILE (.csv cùng định dạng Sheet, hoặc .json {"Tên cột": ["chủ đề", ...]}), file này
+# được dùng thay cho Sheet và tự nạp lại khi file thay đổi.
+_app_config = None # {'modes', 'fetched_at', 'etag', 'last_modified'}
+_app_config_lock = threading.Lock()
+_app_config_refreshing = False
+_local_config = {'mtime': None, 'modes': None}
+
+def parse_app_modes_json(json_data):
+    """
+    Cấu hình dạng JSON {"Tên cột": ["chủ đề 1", ...]} -> cùng cấu trúc với parse_app_modes_csv.
+    ValueError nếu JSON không đúng dạng đó (gốc không phải object, danh sách chủ đề không phải mảng chuỗi).
+    """
+    data = json.loads(json_data)
+    if not isinstance(data, dict):
+        raise ValueError("cấu hình JSON phải là một object {\"Tên cột\": [\"chủ đề\", ...]}")
+    app_modes = {}
+    for header, domains in data.items():
+        app_id = APP_COLUMN_MAPPING.get(header.strip().upper().replace(' ', ''))
+        if not app_id:
+            continue
+        if not isinstance(domains, list) or not all(isinstance(d, str) for d in domains):
+            raise ValueError(f"chủ đề của '{header}' phải là một mảng chuỗi")
+        app_modes[app_id] = {"name": header.strip(), "domains": [d.strip() for d in domains if d.strip()]}
+    if not app_modes:
+        print("❌ Không tìm thấy tên ứng dụng hợp lệ (Câu chuyện, Phong thủy,...) trong file cấu hình JSON.")
+        return None
+    return app_modes
+
+def _copy_app_modes(app_modes):
+    # Vòng lặp chính gắn thêm khoá vào từng cấu hình: trả bản sao để không sửa vào cache
+    return {app_id: dict(config, domains=list(config["domains"])) for app_id, config in app_modes.items()}
+
+def _load_local_app_modes():
+    """Cấu hình từ APP_CONFIG_LOCAL_FILE, chỉ đọc lại khi mtime thay đổi. Lỗi thì giữ bản đã đọc trước đó."""
+    try:
+        mtime = os.path.getmtime(APP_CONFIG_LOCAL_FILE)
+    except OSError as e:
+        print(f"❌ Không đọc được file cấu hình cục bộ {APP_CONFIG_LOCAL_FILE}: {e}")
+        return _local_config['modes']
+    if mtime != _local_config['mtime']:
+        try:
+            with open(APP_CONFIG_LOCAL_FILE, 'r', encoding='utf-8') as f:
+                content = f.read()
+            if APP_CONFIG_LOCAL_FILE.lower().endswith('.json'):
+                modes = parse_app_modes_json(content)
+            else:
+                modes = parse_app_modes_csv(content)
+        except (OSError, ValueError) as e:
+            print(f"❌ Lỗi đọc file cấu hình cục bộ: {e}")
+            modes = None
+        _local_config['mtime'] = mtime
+        if modes:
+            print(f"✅ Đã nạp cấu hình từ file cục bộ {APP_CONFIG_LOCAL_FILE}.")
+            _local_config['modes'] = modes
+    return _local_config['modes']
+
+def _load_app_config_cache():
+    try:
+        with open(APP_CONFIG_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        cached['modes'] = {int(app_id): config for app_id, config in cached['modes'].items()}
+        return cached
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _save_app_config_cache(config_cache):
+    tmp_path = f"{APP_CONFIG_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(config_cache, f, ensure_ascii=False)
+        os.replace(tmp_path, APP_CONFIG_CACHE_FILE)
+    except OSError as e:
+        print(f"  - Cảnh báo: Không thể lưu cache cấu hình: {e}")
+
+def refresh_app_modes_from_sheet(gsheet_id):
+    """Tải lại Sheet có điều kiện (ETag/Last-Modified). Trả về cấu hình mới nhất, hoặc None nếu lỗi."""
+    global _app_config
+    with _app_config_lock:
+        cached = _app_config
+    new_config = run_async(async_load_app_modes_from_sheet(gsheet_id, cached=cached))
+    if new_config is None:
+        return None
+    with _app_config_lock:
+        _app_config = new_config
+    _save_app_config_cache(new_config)
+    return new_config['modes']
+
+def _refresh_app_modes_in_background(gsheet_id):
+    global _app_config_refreshing
     try:
-        print(f"Đang tải cấu hình ứng dụng từ Google Sheet ID: {gsheet_id}...")
-        response = requests.get(EXPORT_URL, timeout=10)
+        if refresh_app_modes_from_sheet(gsheet_id) is None:
+            print("  - Cảnh báo: Không cập nhật được cấu hình từ Sheet, tiếp tục dùng cấu hình tốt gần nhất.")
+    finally:
+        with _app_config_lock:
+            _app_config_refreshing = False
+
+def get_app_modes(gsheet_id):
+    """
+    Cấu hình ứng dụng cho vòng lặp chính mà không phải chờ Sheet: file cục bộ (nếu có) -> cache còn hạn
+    -> cache hết hạn (đồng thời làm mới nền) -> tải đồng bộ lần đầu. None nếu chưa từng tải được.
+    """
+    global _app_config, _app_config_refreshing
+    if APP_CONFIG_LOCAL_FILE:
+        modes = _load_local_app_modes()
+        return _copy_app_modes(modes) if modes else None
+
+    with _app_config_lock:
+        if _app_config is None:
+            _app_config = _load_app_config_cache()
+        cached = _app_config
+        start_refresh = (
+            cached is not None
+            and time.time() - cached.get('fetched_at', 0) >= APP_CONFIG_TTL_SECONDS
+            and not _app_config_refreshing
+        )
+        if start_refresh:
+            _app_config_refreshing = True
+
+    if cached is None:
+        modes = refresh_app_modes_from_sheet(gsheet_id)
+        return _copy_app_modes(modes) if modes else None
+    if start_refresh:
+        threading.Thread(target=_refresh_app_modes_in_background, args=(gsheet_id,), daemon=True).start()
+    return _copy_app_modes(cached['modes'])
+
+# ==========================================================
+# --- KHỐI MẠNG BẤT ĐỒNG BỘ (ASYNCIO + HTTPX) ---
+# ==========================================================
+# Các hàm async dùng chung logic (request, cache, rendition, giải mã) với bản sync ở trên.
+# Gửi Telegram và tải cấu hình Sheet chỉ có bản async; send_telegram_notification / refresh_app_modes_from_sheet
+# là mặt tiền đồng bộ chạy chúng qua run_async().
+# Việc nặng CPU/đĩa (giải mã ảnh, cache trên đĩa, pydrive2) được đẩy sang thread bằng asyncio.to_thread.
+
+def _new_async_client():
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT),
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=ASYNC_MAX_CONCURRENCY * 2)
+    )
+
+@contextlib.asynccontextmanager
+async def _async_client_scope(client=None):
+    # Dùng client được truyền vào (chia sẻ kết nối trong job) hoặc tự tạo và tự đóng
+    if client is not None:
+        yield client
+        return
+    async with _new_async_client() as own_client:
+        yield own_client
+
+async def async_http_request(client, method, url, timeout=None, metric_labels=None, idempotent=None, **kwargs):
+    """Bản async của http_request: cùng chính sách thử lại/backoff, chờ bằng asyncio.sleep."""
+    stage, provider = metric_labels or http_metric_labels(url)
+    if idempotent is None:
+        idempotent = method.upper() in HTTP_IDEMPOTENT_METHODS
+    with track_stage(stage):
+        try:
+            response = await _async_http_request_with_retry(client, method, url, timeout, idempotent, **kwargs)
+        except httpx.HTTPError:
+            count_provider(provider, False)
+            raise
+        record_http_response(provider, response)
+    return response
+
+async def _async_http_request_with_retry(client, method, url, timeout=None, idempotent=True, **kwargs):
+    retry_statuses = HTTP_RETRY_STATUSES if idempotent else HTTP_UNSENT_RETRY_STATUSES
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        is_last = attempt == HTTP_MAX_RETRIES
+        try:
+            response = await client.request(method, url, timeout=timeout or HTTP_TIMEOUT, **kwargs)
+        except httpx.TransportError as e:
+            # ConnectError/ConnectTimeout: chưa kết nối được nên request chưa tới server
+            if is_last or not (idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))):
+                raise
+            delay = retry_delay(attempt)
+            print(f"  - HTTP {method} {urlsplit(url).netloc}: lỗi kết nối ({e}). Thử lại sau {delay:.1f}s.")
+            await asyncio.sleep(delay)
+            continue
 
+        if response.status_code not in retry_statuses or is_last:
+            return response
+        delay = retry_delay(attempt, response.status_code, response.headers.get('Retry-After'))
+        if delay is None:
+            return response
+        print(f"  - HTTP {method} {urlsplit(url).netloc}: status {response.status_code}. Thử lại sau {delay:.1f}s.")
+        await asyncio.sleep(delay)
+
+def run_async(coro):
+    """Mặt tiền đồng bộ: chạy coroutine tới khi xong, kể cả khi đang ở trong một event loop khác."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # Đang ở trong event loop: chạy trên thread riêng để không chặn/lồng loop hiện tại
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+# Khoá làm mới theo từ khoá, riêng cho từng event loop (asyncio.Lock gắn với loop đã tạo ra nó; các job chạy
+# song song mỗi job một loop trên thread riêng). Bộ khoá của loop đã đóng được bỏ ở lần gọi sau.
+# (Không dùng WeakKeyDictionary: Lock giữ tham chiếu tới loop nên loop không bao giờ được giải phóng.)
+_async_refresh_locks = {} # loop -> {từ khoá: asyncio.Lock}
+_async_refresh_locks_lock = threading.Lock()
+
+def _async_pexels_refresh_lock(random_theme):
+    loop = asyncio.get_running_loop()
+    with _async_refresh_locks_lock:
+        for closed_loop in [other for other in _async_refresh_locks if other.is_closed()]:
+            del _async_refresh_locks[closed_loop]
+        loop_locks = _async_refresh_locks.setdefault(loop, {})
+        return loop_locks.setdefault(random_theme, asyncio.Lock())
+
+async def async_search_pexels_photos(client, random_theme):
+    fresh_photos, page, stale_photos = _pexels_pool_lookup(random_theme)
+    if fresh_photos is not None:
+        return fresh_photos
+
+    async with _async_pexels_refresh_lock(random_theme):
+        fresh_photos, page, stale_photos = _pexels_pool_lookup(random_theme)
+        if fresh_photos is not None:
+            return fresh_photos
+        return await _async_refresh_pexels_pool(client, random_theme, page, stale_photos)
+
+async def _async_refresh_pexels_pool(client, random_theme, page, stale_photos):
+    pexels_url, headers, params = _pexels_search_request(random_theme, page)
+    try:
+        response = await async_http_request(client, 'GET', pexels_url, headers=headers, params=params)
         if response.status_code != 200:
-            print(f"❌ Lỗi tải Sheet (Status {response.status_code}). Đảm bảo Sheet Public và ID chính xác.")
-            return None
+            print(f"  - Lỗi Pexels (Search): Status code {response.status_code}. Vui lòng kiểm tra API Key hoặc Limit.")
+            return _pexels_record_failure(random_theme, page, stale_photos)
+        data = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"  - Lỗi kết nối Pexels (Search): {e}.")
+        return _pexels_record_failure(random_theme, page, stale_photos)
+
+    return _pexels_merge_page(random_theme, page, data)
+
+async def async_download_rendition(client, candidates, provider_name):
+    response = None
+    for position, image_url in enumerate(candidates):
+        is_last = position == len(candidates) - 1
+        try:
+            response = await async_http_request(
+                client, 'GET', image_url, timeout=15, metric_labels=('image_download', provider_name.lower())
+            )
+        except httpx.HTTPError as e:
+            if is_last:
+                raise
+            print(f"  - {provider_name}: Lỗi tải rendition ({e}), thử kích thước lớn hơn.")
+            continue
+        if response.status_code == 200 or is_last:
+            return response
+        print(f"  - {provider_name}: Rendition trả về status {response.status_code}, thử kích thước lớn hơn.")
+    return response
 
-        csv_data = response.content.decode('utf-8')
-        reader = csv.reader(StringIO(csv_data))
+async def async_get_random_pexels_image(query, slide_index, client=None):
+    if not PEXELS_API_KEY or PEXELS_API_KEY == "YOUR_PEXELS_API_KEY":
+        print("  - Cảnh báo: PEXELS_API_KEY chưa được cấu hình. Bỏ qua Pexels.")
+        return None
 
-        # 1. Đọc dòng tiêu đề (HEADER)
+    random_theme = random.choice(BACKGROUND_THEME_KEYWORDS)
+    print(f"  - [async] Đang thử lấy ảnh nền từ Pexels theo chủ đề ngẫu nhiên: '{random_theme}'")
+
+    async with _async_client_scope(client) as http:
         try:
-            headers = next(reader)
-            if not headers: raise StopIteration
-        except StopIteration:
-            print("❌ Sheet trống hoặc không có dòng tiêu đề.")
+            photos = await async_search_pexels_photos(http, random_theme)
+            if not photos:
+                print(f"  - Pexels: Không tìm thấy ảnh nào cho chủ đề '{random_theme}'.")
+                return None
+
+            random_photo = random.choice(photos)
+            cached_img = await asyncio.to_thread(bg_cache_get, 'pexels', random_photo['id'])
+            if cached_img is not None:
+                print(f"  - ♻️ Ảnh nền Pexels đã có trong cache, bỏ qua tải xuống.")
+                return cached_img
+
+            image_response = await async_download_rendition(http, pexels_rendition_candidates(random_photo), 'Pexels')
+            if image_response is not None and image_response.status_code == 200:
+                print(f"  - ✅ Đã tải ảnh nền từ Pexels thành công.")
+                return await asyncio.to_thread(
+                    prepare_downloaded_background, image_response.content, 'pexels', random_photo['id']
+                )
+            print(f"  - Lỗi Pexels (Download): Status code {getattr(image_response, 'status_code', None)}.")
             return None
 
-        dynamic_app_modes_raw = {}
+        except httpx.HTTPError as e:
+            print(f"  - Lỗi kết nối Pexels: {e}. Chuyển sang dùng Unsplash.")
+            return None
 
-        # 2. Xử lý tiêu đề và tạo cấu hình ban đầu
-        for col_index, header in enumerate(headers):
-            # Chuẩn hóa tên tiêu đề để so khớp với APP_COLUMN_MAPPING
-            normalized_header = header.strip().upper().replace(' ', '')
+async def async_get_random_unsplash_image(query, slide_index, client=None):
+    if not UNSPLASH_ACCESS_KEY or UNSPLASH_ACCESS_KEY == "YOUR_UNSPLASH_ACCESS_KEY":
+        print("  - Cảnh báo: UNSPLASH_ACCESS_KEY chưa được cấu hình. Bỏ qua Unsplash.")
+        return None
 
-            # Lấy ID và tên chính xác dựa trên tiêu đề cột
-            app_id = APP_COLUMN_MAPPING.get(normalized_header)
+    random_theme = random.choice(BACKGROUND_THEME_KEYWORDS)
+    print(f"  - [async] Đang thử lấy ảnh nền từ Unsplash API theo chủ đề ngẫu nhiên: '{random_theme}'")
+    unsplash_url, headers, params = _unsplash_random_request(random_theme)
 
-            if app_id:
-                dynamic_app_modes_raw[app_id] = {
-                    "name": header.strip(), # Giữ nguyên tên gốc có dấu
-                    "domains": [], # Khởi tạo danh sách domains trống
-                    "col_index": col_index # Lưu chỉ mục cột để quét domain sau này
-                }
+    async with _async_client_scope(client) as http:
+        try:
+            response = await async_http_request(http, 'GET', unsplash_url, headers=headers, params=params)
+            if response.status_code != 200:
+                print(f"  - Lỗi Unsplash (Search): Status code {response.status_code}. Chi tiết: {response.text}")
+                return None
+
+            photo = _unsplash_pick_photo(response.json())
+            if photo is None:
+                print(f"  - Unsplash: Không tìm thấy ảnh nào cho chủ đề '{random_theme}'.")
+                return None
+
+            cached_img = await asyncio.to_thread(bg_cache_get, 'unsplash', photo['id'])
+            if cached_img is not None:
+                print(f"  - ♻️ Ảnh nền Unsplash đã có trong cache, bỏ qua tải xuống.")
+                return cached_img
+
+            image_response = await async_download_rendition(http, unsplash_rendition_candidates(photo), 'Unsplash')
+            if image_response is not None and image_response.status_code == 200:
+                print(f"  - ✅ Đã tải ảnh nền từ Unsplash thành công.")
+                return await asyncio.to_thread(
+                    prepare_downloaded_background, image_response.content, 'unsplash', photo['id']
+                )
+            print(f"  - Lỗi Unsplash (Download): Status code {getattr(image_response, 'status_code', None)}.")
+            return None
 
-        if not dynamic_app_modes_raw:
-            print("❌ Không tìm thấy tiêu đề cột hợp lệ (Câu chuyện, Phong thủy,...) trong Sheet.")
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"  - Lỗi kết nối Unsplash: {e}. Chuyển sang nguồn dự phòng.")
             return None
 
-        # 3. Quét các dòng còn lại để thu thập Domains (chủ đề)
-        for row in reader:
-            for app_id, config in dynamic_app_modes_raw.items():
-                col_index = config["col_index"]
+async def async_fetch_background(drive_service, slide_index, theme, client=None):
+    """Bản async của fetch_background: cùng thứ tự ưu tiên PEXELS -> UNSPLASH -> GOOGLE DRIVE."""
+    if BG_CACHE_REUSE_RATIO > 0 and random.random() < BG_CACHE_REUSE_RATIO:
+        img = await asyncio.to_thread(bg_cache_random)
+        if img is not None:
+            print("  - ♻️ Dùng lại ảnh nền có sẵn trong cache.")
+            count_background_source('cache', img)
+            return img
+
+    img = await async_get_random_pexels_image(theme, slide_index, client)
+    count_background_source('pexels', img)
+    if img is None:
+        img = await async_get_random_unsplash_image(theme, slide_index, client)
+        count_background_source('unsplash', img, fallback=True)
+    if img is None:
+        # pydrive2 chỉ có API đồng bộ
+        img = await asyncio.to_thread(
+            get_random_background_image, drive_service, BACKGROUND_IMAGES_FOLDER_ID, slide_index
+        )
+        count_background_source('drive', img, fallback=True)
+    return img
 
-                if col_index < len(row):
-                    domain = row[col_index].strip()
-                    if domain:
-                        # Thêm domain (chủ đề) vào danh sách ứng dụng tương ứng
-                        config["domains"].append(domain)
+async def async_fetch_backgrounds(drive_service, slide_queries):
+    """Tải ảnh nền cho TẤT CẢ slide của một job cùng lúc (tối đa ASYNC_MAX_CONCURRENCY), giữ đúng thứ tự."""
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
 
-        # 4. Loại bỏ chỉ mục cột trước khi trả về
-        for config in dynamic_app_modes_raw.values():
-            del config["col_index"]
+    async with _new_async_client() as client:
+        async def fetch_one(i, query):
+            async with semaphore:
+                try:
+                    return await async_fetch_background(drive_service, i + 1, query, client)
+                except Exception as e:
+                    print(f"  - Lỗi tải ảnh nền cho slide {i + 1}: {e}")
+                    return None
 
-        print(f"✅ Đã tải thành công {len(dynamic_app_modes_raw)} cấu hình ứng dụng theo cột.")
-        return dynamic_app_modes_raw
+        return await asyncio.gather(*(fetch_one(i, q) for i, q in enumerate(slide_queries)))
 
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Lỗi kết nối khi tải Google Sheet: {e}")
+def fetch_backgrounds(drive_service, slide_queries):
+    """Mặt tiền đồng bộ của async_fetch_backgrounds cho các call site hiện có."""
+    return run_async(async_fetch_backgrounds(drive_service, slide_queries))
+
+async def async_send_telegram_album(text_message, slide_images, start=0, client=None, on_progress=None):
+    """
+    Gửi album bắt đầu từ request thứ `start` (các request trước đó đã gửi thành công ở lần gọi trước).
+    Trả về (số request đã gửi xong, tổng số request); hai số bằng nhau là đã gửi đủ.
+    on_progress(số request đã gửi) được gọi sau mỗi request thành công (để lưu tiến độ vào checkpoint).
+    """
+    print(f"\n--- Đang gửi {len(slide_images)} slide dạng album đến Telegram ---")
+    # Thu nhỏ ảnh là việc CPU: làm ngoài event loop
+    album_requests = await asyncio.to_thread(_telegram_album_requests, text_message, slide_images)
+    sent = start
+    async with _async_client_scope(client) as http:
+        try:
+            for method, data, files in album_requests[start:]:
+                url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/{method}"
+                response = await async_http_request(http, 'POST', url, data=data, files=files, timeout=TELEGRAM_UPLOAD_TIMEOUT)
+                if response.status_code != 200:
+                    print(f"Lỗi Telegram ({method}): {response.status_code} - {response.text}")
+                    break
+                sent += 1
+                if on_progress is not None:
+                    on_progress(sent)
+            else:
+                print("Đã gửi album slide thành công!")
+        except Exception as e:
+            print(f"Lỗi kết nối Telegram (album): {e}")
+    return sent, len(album_requests)
+
+async def async_send_telegram_notification(text_message, image_urls=None, client=None, slide_images=None,
+                                           album_start=0, on_album_progress=None):
+    """
+    Gửi thông báo (kèm link ảnh Drive, hoặc album slide khi TELEGRAM_DELIVERY_MODE=album). True nếu Telegram đã nhận
+    đủ (hoặc thông báo bị tắt), False nếu có request lỗi. album_start/on_album_progress: gửi tiếp album từ lần trước.
+    """
+    if not ENABLE_TELEGRAM_NOTIFICATIONS:
+        print("⚠️ Thông báo Telegram đã bị tắt (ENABLE_TELEGRAM_NOTIFICATIONS = False). Bỏ qua.")
+        return True
+
+    async with _async_client_scope(client) as http:
+        # Chế độ album: gửi thẳng ảnh slide kèm caption. Chưa gửi được gì thì quay về gửi link Drive như cũ;
+        # đã gửi một phần (caption, vài nhóm ảnh) thì gửi tiếp từ request lỗi, không gửi lại caption + link
+        if slide_images and TELEGRAM_DELIVERY_MODE == 'album':
+            sent, total = await async_send_telegram_album(text_message, slide_images, album_start, http, on_album_progress)
+            if album_start < sent < total:
+                print(f"  - Album mới gửi được {sent}/{total} phần. Gửi tiếp phần còn lại...")
+                sent, total = await async_send_telegram_album(text_message, slide_images, sent, http, on_album_progress)
+            if sent == total:
+                return True
+            if sent > 0:
+                print(f"❌ Album chỉ gửi được {sent}/{total} phần. Không gửi lại dạng link để tránh đăng trùng.")
+                return False
+
+        print("\n--- Đang gửi thông báo kết quả đến Telegram ---")
+        url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        payload, payload_img = _telegram_text_payloads(text_message, image_urls)
+        try:
+            response = await async_http_request(http, 'POST', url, data=payload)
+            if response.status_code != 200:
+                print(f"Lỗi Telegram (gửi tin nhắn): {response.status_code} - {response.text}")
+                return False
+            print("Đã gửi tin nhắn thông báo thành công!")
+            if payload_img:
+                # Gửi tin nhắn thứ hai chứa link ảnh
+                response = await async_http_request(http, 'POST', url, data=payload_img)
+                if response.status_code != 200:
+                    print(f"Lỗi Telegram (gửi link ảnh): {response.status_code} - {response.text}")
+                    return False
+            return True
+        except Exception as e:
+            print(f"Lỗi kết nối Telegram (notification): {e}")
+            return False
+
+async def async_load_app_modes_from_sheet(gsheet_id, client=None, cached=None):
+    """
+    Tải cấu hình từ Sheet; có `cached` (cấu hình lần trước) thì gửi request có điều kiện (ETag/Last-Modified).
+    Trả về {'modes', 'fetched_at', 'etag', 'last_modified'}, hoặc None nếu lỗi.
+    """
+    EXPORT_URL = f"{GSHEET_EXPORT_URL}/{gsheet_id}/export?format=csv&gid=0"
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    async with _async_client_scope(client) as http:
+        try:
+            print(f"Đang kiểm tra cấu hình ứng dụng từ Google Sheet ID: {gsheet_id}...")
+            response = await async_http_request(http, 'GET', EXPORT_URL, headers=headers)
+        except httpx.HTTPError as e:
+            print(f"❌ Lỗi kết nối khi tải Google Sheet: {e}")
+            return None
+
+    if response.status_code == 304 and cached:
+        print("✅ Cấu hình Sheet không thay đổi (304).")
+        return dict(cached, fetched_at=time.time())
+    if response.status_code != 200:
+        print(f"❌ Lỗi tải Sheet (Status {response.status_code}). Đảm bảo Sheet Public và ID chính xác.")
         return None
+    try:
+        modes = parse_app_modes_csv(response.content.decode('utf-8'))
     except Exception as e:
         print(f"❌ Lỗi xử lý dữ liệu từ Google Sheet: {e}")
         return None
+    if not modes:
+        return None
+    return {
+        'modes': modes,
+        'fetched_at': time.time(),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
 
 # ==========================================================
 # --- HÀM CHÍNH (MAIN) - ĐÃ THÊM TỰ ĐỘNG HÓA VÀ VÒNG LẶP ---
 # ==========================================================
 
+# ==========================================================
+# --- KHỐI DỰNG CẤU HÌNH VÀ CHẠY MỘT JOB (DÙNG CHUNG CHO VÒNG LẶP TƯƠNG TÁC VÀ DAEMON) ---
+# ==========================================================
+APP_FUNCTION_MAP = {
+    1: run_story_app,
+    2: run_phong_thuy,
+    3: run_la_so_tu_vi,
+    4: run_tarot,
+    5: run_cung_hoang_dao,
+    6: run_fairy_tale_app,
+    7: run_joke_app
+}
+
+def build_app_modes(dynamic_app_modes_raw):
+    """Gắn hàm thực thi vào cấu hình từ Sheet và thêm các app không cần Sheet (Cổ Tích, Truyện Cười)."""
+    APP_MODES = {}
+
+    # 1. TẠO APP_MODES TỪ SHEET (cho các app cũ)
+    for app_id, config in dynamic_app_modes_raw.items():
+        if app_id in APP_FUNCTION_MAP:
+            config["function"] = APP_FUNCTION_MAP[app_id]
+            APP_MODES[app_id] = config
+        else:
+            print(f"Cảnh báo: Không tìm thấy hàm thực thi cho ID ứng dụng {app_id}. Bỏ qua.")
+
+    # 2. THÊM CÁC APP KHÔNG CẦN SHEET VÀO APP_MODES (Cho các app mới)
+    # Thêm Truyện Cổ Tích
+    if 6 not in APP_MODES:
+        APP_MODES[6] = {
+            "name": "Truyện Cổ Tích (AI)",
+            "domains": ["AI_GENERATED_FAIRY_TALE"], # Dùng một chủ đề giả để logic check không bị lỗi
+            "function": APP_FUNCTION_MAP[6],
+            "mode": "auto" # Thiết lập mặc định
+        }
+
+    # Thêm Truyện Cười
+    if 7 not in APP_MODES:
+        APP_MODES[7] = {
+            "name": "Truyện Cười (AI)",
+            "domains": ["AI_GENERATED_JOKE"], # Dùng một chủ đề giả để logic check không bị lỗi
+            "function": APP_FUNCTION_MAP[7],
+            "mode": "auto" # Thiết lập mặc định
+        }
+    return APP_MODES
+
+def choose_app_domain(app_id, chosen_app):
+    """Chọn chủ đề cho lần chạy theo quy tắc của từng app. None nếu app không có chủ đề."""
+    app_name = chosen_app["name"]
+    app_domains = chosen_app["domains"]
+    if not app_domains:
+        return None
+    if app_id == 1: # CAUCHUYEN
+        # Rule 1: Chọn ngẫu nhiên từ domains
+        print("Lựa chọn: Ngẫu nhiên (CAUCHUYEN)")
+        return random.choice(app_domains)
+    if app_id in [6, 7]: # FAIRYTALE hoặc JOKE
+        # Rule 3: KHÔNG CẦN DOMAIN TỪ SHEET, AI TỰ TẠO
+        print(f"Lựa chọn: Chủ đề tự động tạo bởi AI ({app_name})")
+        return f"AI_Generated_{app_name}"
+    # Rule 2: Chọn chủ đề ĐẦU TIÊN (Cho các app còn lại)
+    print("Lựa chọn: Chủ đề đầu tiên của cột (B->E)")
+    return app_domains[0]
+
+def run_app_job(drive_service, app_id, chosen_app, chosen_domain, job=None, checkpoint_key=None):
+    """
+    Chạy một app với chủ đề đã chọn; lỗi được báo qua Telegram thay vì làm dừng vòng lặp. False nếu app ném lỗi.
+    Tiến độ được ghi vào checkpoint theo idempotency_key của job hàng đợi (hoặc checkpoint_key / một key 'local:' mới).
+    Checkpoint chỉ bị xoá khi app chạy xong, nên lần chạy lại (worker thử lại, khởi động lại) tiếp tục từ đó.
+    """
+    app_name = chosen_app["name"]
+    checkpoint = None
+    if JOB_CHECKPOINT_ENABLED:
+        key = job['idempotency_key'] if job else (checkpoint_key or f"local:{uuid.uuid4().hex}")
+        checkpoint = JobCheckpoint(key, app_id=app_id, app_name=app_name, domain=chosen_domain)
+        if checkpoint.resumed:
+            print(f"♻️ Chạy tiếp job '{key}' từ checkpoint (lần thứ {checkpoint.get('resumes') + 1}).")
+    _job_context.job = job
+    _job_context.checkpoint = checkpoint
+    try:
+        print(f"\n--- BẮT ĐẦU THỰC THI: {app_name.upper()} ---")
+        if checkpoint is not None and checkpoint.get('notified'):
+            print("  - Bài của job đã được đăng ở lần chạy trước. Chỉ dọn checkpoint.")
+            ok = True
+        else:
+            with track_stage('job'):
+                ok = chosen_app["function"](drive_service, chosen_domain)
+        if not ok:
+            # Giữ checkpoint để lần thử lại chạy tiếp từ bước dở dang; nội dung chưa đăng không bị tính là đã làm
+            release_reserved_content()
+            count_metric('jobs_total', app=str(app_id), outcome='failure')
+            print(f"\n--- THẤT BẠI: {app_name.upper()} ---\n")
+            return False
+        count_metric('jobs_total', app=str(app_id), outcome='success')
+        print(f"\n--- KẾT THÚC THỰC THI: {app_name.upper()} ---\n")
+        if checkpoint is not None:
+            checkpoint.discard()
+        return True
+    except Exception as e:
+        # GỬI THÔNG BÁO LỖI CHẠY ỨNG DỤNG
+        release_reserved_content()
+        count_metric('jobs_total', app=str(app_id), outcome='failure')
+        error_msg_run_app = f"❌ Lỗi nghiêm trọng trong quá trình chạy ứng dụng {app_name}: {e}"
+        print(error_msg_run_app)
+        send_telegram_notification(f"LỖI CHẠY APP: {error_msg_run_app}")
+        return False
+    finally:
+        _job_context.job = None
+        _job_context.checkpoint = None
+        _job_context.content_id = None
+
+# ==========================================================
+# --- KHỐI LẬP LỊCH CHẠY NỀN (RUN_MODE=daemon) ---
+# ==========================================================
+# Thay cho vòng lặp hỏi y/n: không cần TTY, chạy được dưới systemd.
+# - App có tần suất (SCHEDULER_APP_RATES, bài/giờ) hoặc khung giờ cron (SCHEDULER_CRON) chạy đúng lịch.
+# - App không có lịch là app "lấp chỗ trống": mỗi khi còn slot, chọn ngẫu nhiên theo trọng số SCHEDULER_APP_WEIGHTS.
+# - Tối đa SCHEDULER_MAX_CONCURRENT_JOBS job chạy cùng lúc. SIGTERM/SIGINT: ngừng nhận job mới, chờ job đang chạy xong.
+# - App lấp chỗ bắt đầu cách nhau ít nhất SCHEDULER_FILL_MIN_INTERVAL giây; app có job thất bại bị tạm dừng
+#   (SCHEDULER_FAILURE_BACKOFF, tăng gấp đôi mỗi lần lỗi liên tiếp) để cấu hình hỏng không thành vòng lặp lỗi liên tục.
+# Tên app dùng tên cột như APP_COLUMN_MAPPING, ví dụ: SCHEDULER_APP_RATES="CAUCHUYEN=6,JOKE=2".
+def parse_app_key_map(value, cast=float, separator=','):
+    """'CAUCHUYEN=6,JOKE=2' -> {1: 6.0, 7: 2.0}. Tên app không hợp lệ bị bỏ qua (có cảnh báo)."""
+    result = {}
+    for item in (value or '').split(separator):
+        if not item.strip():
+            continue
+        key, _, raw = item.partition('=')
+        app_id = APP_COLUMN_MAPPING.get(key.strip().upper().replace(' ', ''))
+        if app_id is None:
+            print(f"Cảnh báo: Không nhận ra tên ứng dụng '{key.strip()}' trong cấu hình lịch chạy. Bỏ qua.")
+            continue
+        result[app_id] = cast(raw.strip())
+    return result
+
+def _cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(x) for x in part.split('-'))
+        else:
+            start = int(part)
+            end = high if step else start # "5/15" = từ 5, mỗi 15
+        values.update(range(start, end + 1, int(step or 1)))
+    return values
+
+def parse_cron(expr):
+    """Biểu thức cron 5 trường (phút giờ ngày tháng thứ; thứ 0/7 = Chủ nhật). Hỗ trợ *, a-b, a,b và /n."""
+    minute, hour, day, month, weekday = expr.split()
+    weekdays = _cron_field(weekday, 0, 7)
+    if 7 in weekdays:
+        weekdays.add(0)
+    return (_cron_field(minute, 0, 59), _cron_field(hour, 0, 23), _cron_field(day, 1, 31), _cron_field(month, 1, 12), weekdays)
+
+def cron_matches(cron, dt):
+    # Đơn giản hoá so với cron chuẩn: mọi trường phải khớp (kể cả khi giới hạn cả ngày lẫn thứ)
+    minutes, hours, days, months, weekdays = cron
+    return (dt.minute in minutes and dt.hour in hours and dt.day in days
+            and dt.month in months and (dt.weekday() + 1) % 7 in weekdays)
+
+def run_scheduler(drive_service, enqueue_only=False):
+    """
+    Bộ lập lịch. enqueue_only=True (RUN_MODE=scheduler): không tự chạy job mà xếp vào hàng đợi SQLite cho các
+    worker; khi đó "slot trống" là số job đang chờ/đang chạy trong hàng đợi dưới JOB_QUEUE_MAX_PENDING.
+    """
+    rates = parse_app_key_map(SCHEDULER_APP_RATES)
+    crons = parse_app_key_map(SCHEDULER_CRON, cast=parse_cron, separator=';')
+    weights = parse_app_key_map(SCHEDULER_APP_WEIGHTS)
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        if not stop_event.is_set():
+            print(f"\n🛑 Nhận tín hiệu {signal.Signals(signum).name}: ngừng nhận job mới, chờ các job đang chạy hoàn tất...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    if enqueue_only:
+        print(f"🗓️ Chế độ scheduler: xếp job vào {JOB_QUEUE_DB} (tối đa {JOB_QUEUE_MAX_PENDING} job chờ/đang chạy).")
+    else:
+        print(f"🗓️ Chế độ daemon: tối đa {SCHEDULER_MAX_CONCURRENT_JOBS} job song song.")
+    last_rate_slot = {} # app_id -> slot đã xếp gần nhất (app theo tần suất)
+    last_cron_minute = {} # app_id -> phút đã chạy gần nhất (app theo cron, tránh chạy 2 lần trong cùng phút)
+    due_queue = [] # (app_id, idempotency key)
+    in_flight = {} # future -> (app_id, tên app)
+    enqueued = {} # job_id -> app_id (job do scheduler này xếp, chờ kết quả)
+    failure_backoff = {} # app_id -> (số lần lỗi liên tiếp, tạm dừng tới thời điểm)
+    last_start = 0.0
+    last_fill_start = 0.0
+
+    def record_result(app_id, ok):
+        if ok:
+            failure_backoff.pop(app_id, None)
+            return
+        failures = failure_backoff.get(app_id, (0, 0))[0] + 1
+        delay = min(SCHEDULER_FAILURE_BACKOFF_MAX, SCHEDULER_FAILURE_BACKOFF * 2 ** (failures - 1))
+        failure_backoff[app_id] = (failures, time.time() + delay)
+        print(f"⏸️ Ứng dụng {app_id} thất bại {failures} lần liên tiếp: tạm dừng {delay:.0f}s.")
+
+    def backing_off(app_id):
+        return failure_backoff.get(app_id, (0, 0))[1] > time.time()
+
+    last_app_modes_raw = None # Cấu hình tốt gần nhất, dùng tiếp khi tải cấu hình lỗi
+    with ThreadPoolExecutor(max_workers=SCHEDULER_MAX_CONCURRENT_JOBS, thread_name_prefix='job') as job_pool:
+        while not stop_event.is_set():
+            try:
+                dynamic_app_modes_raw = get_app_modes(GSHEET_ID)
+            except Exception as e:
+                print(f"❌ Lỗi khi tải cấu hình ứng dụng: {e}. Tiếp tục dùng cấu hình tốt gần nhất.")
+                dynamic_app_modes_raw = last_app_modes_raw
+            if dynamic_app_modes_raw is None:
+                print("\n❌ KHÔNG THỂ TẢI CẤU HÌNH. Thử lại sau.")
+                stop_event.wait(SCHEDULER_TICK_SECONDS * 5)
+                continue
+            last_app_modes_raw = dynamic_app_modes_raw
+            APP_MODES = build_app_modes(dynamic_app_modes_raw)
+            if SCRIPT_BUFFER_ENABLED:
+                start_script_producer(script_targets_for_app_modes(APP_MODES))
+
+            # 1. App đến lịch (tần suất hoặc cron) được đưa vào hàng đợi
+            now = time.time()
+            current_minute = datetime.datetime.now().replace(second=0, microsecond=0)
+            for app_id in APP_MODES:
+                if app_id in rates and rates[app_id] > 0:
+                    # Slot theo lưới giờ cố định (không phụ thuộc tiến trình): mọi scheduler tính ra cùng slot -> cùng key.
+                    # Mỗi app lệch pha cố định trong chu kỳ để các app không cùng đến lượt một lúc.
+                    interval = 3600 / rates[app_id]
+                    phase = (app_id * 0.6180339887) % 1 * interval
+                    slot = math.floor((now - phase) / interval)
+                    # Lần đầu: daemon chờ slot kế tiếp; scheduler xếp luôn slot hiện tại (đã xếp rồi thì key trùng, bị bỏ qua)
+                    last_slot = last_rate_slot.setdefault(app_id, slot - 1 if enqueue_only else slot)
+                    if slot > last_slot:
+                        last_rate_slot[app_id] = slot
+                        due_queue.append((app_id, f"{app_id}:rate:{rates[app_id]:g}:{slot}"))
+                elif app_id in crons:
+                    if cron_matches(crons[app_id], current_minute) and last_cron_minute.get(app_id) != current_minute:
+                        last_cron_minute[app_id] = current_minute
+                        # Cùng khung giờ cron -> cùng key: nhiều scheduler cũng chỉ xếp một job
+                        due_queue.append((app_id, f"{app_id}:cron:{current_minute:%Y%m%dT%H%M}"))
+            fill_apps = [app_id for app_id in APP_MODES if app_id not in rates and app_id not in crons]
+
+            # 2. Ghi nhận kết quả job đã xong (tạm dừng app lỗi), rồi lấp các slot trống:
+            #    ưu tiên app đến lịch, còn lại chọn app lấp chỗ theo trọng số
+            for future, (app_id, _) in list(in_flight.items()):
+                if future.done():
+                    del in_flight[future]
+                    record_result(app_id, future.exception() is None and future.result() is True)
+            if enqueued:
+                for job_id, status in finished_jobs(list(enqueued)).items():
+                    record_result(enqueued.pop(job_id), status == 'done')
+
+            def has_capacity():
+                if enqueue_only:
+                    return pending_job_count() < JOB_QUEUE_MAX_PENDING
+                return len(in_flight) < SCHEDULER_MAX_CONCURRENT_JOBS
+
+            while not stop_event.is_set():
+                if time.time() - last_start < SCHEDULER_MIN_START_INTERVAL:
+                    break
+                # Job đến lịch của app đang tạm dừng được giữ lại trong hàng chờ tới khi hết thời gian tạm dừng
+                due_index = next((i for i, (a, _) in enumerate(due_queue) if not backing_off(a)), None)
+                ready_fill_apps = [a for a in fill_apps if not backing_off(a)]
+                if due_index is not None and (enqueue_only or has_capacity()):
+                    # Khi xếp hàng đợi, job đến lịch luôn được xếp (key chống trùng); chỉ app lấp chỗ bị giới hạn
+                    app_id, job_key = due_queue.pop(due_index)
+                    if app_id not in APP_MODES:
+                        continue
+                elif ready_fill_apps and has_capacity() and time.time() - last_fill_start >= SCHEDULER_FILL_MIN_INTERVAL:
+                    app_id, job_key = random.choices(ready_fill_apps, weights=[weights.get(a, 1.0) for a in ready_fill_apps])[0], None
+                    last_fill_start = time.time()
+                else:
+                    break
+                chosen_app = APP_MODES[app_id]
+                chosen_domain = choose_app_domain(app_id, chosen_app)
+                if not chosen_domain:
+                    print(f"❌ Lỗi: Ứng dụng '{chosen_app['name']}' không có danh sách lĩnh vực/chủ đề được định nghĩa. Bỏ qua.")
+                    continue
+                print(f"✅ Đã chọn Ứng dụng {app_id}: {chosen_app['name']} | Chủ đề: **{chosen_domain}**")
+                if enqueue_only:
+                    job_id = enqueue_job(app_id, chosen_app['name'], chosen_domain, job_key)
+                    print(f"  - Đã xếp job #{job_id}." if job_id else f"  - Job '{job_key}' đã được xếp trước đó. Bỏ qua.")
+                    if job_id:
+                        enqueued[job_id] = app_id
+                else:
+                    future = job_pool.submit(run_app_job, drive_service, app_id, chosen_app, chosen_domain)
+                    in_flight[future] = (app_id, chosen_app['name'])
+                last_start = time.time()
+
+            # 3. Chờ tới nhịp sau, hoặc sớm hơn nếu có job xong
+            if in_flight:
+                wait(list(in_flight), timeout=SCHEDULER_TICK_SECONDS, return_when=FIRST_COMPLETED)
+            else:
+                stop_event.wait(SCHEDULER_TICK_SECONDS)
+
+        if in_flight:
+            print(f"⏳ Đang chờ {len(in_flight)} job hoàn tất: {', '.join(name for _, name in in_flight.values())}")
+    print("Daemon đã dừng. Tạm biệt!")
+
+# ==========================================================
+# --- HÀNG ĐỢI JOB BỀN VỮNG (SQLITE): NHIỀU WORKER / NHIỀU TIẾN TRÌNH DÙNG CHUNG ---
+# ==========================================================
+# RUN_MODE=scheduler chỉ xếp job (app, chủ đề) vào JOB_QUEUE_DB; RUN_MODE=worker nhận job và chạy bằng APP_FUNCTION_MAP.
+# Nhận job (claim) là một giao dịch BEGIN IMMEDIATE nên hai worker không bao giờ nhận cùng một job.
+# Worker giữ lease và gia hạn định kỳ khi đang chạy; lease hết hạn (worker chết) thì job được trả về hàng đợi.
+# Mỗi job có idempotency_key duy nhất: xếp trùng key bị bỏ qua, và thư mục Drive của job được ghi nhớ (kèm
+# property trên chính thư mục) nên chạy lại job không bao giờ tạo thư mục thứ hai.
+# Lưu ý: SQLite chỉ an toàn khi các tiến trình cùng truy cập file trên đĩa cục bộ (không dùng qua NFS/SMB).
+JOB_FOLDER_PROPERTY = 'tktk_job'
+_job_db_local = threading.local()
+_job_context = threading.local() # Job và checkpoint mà thread hiện tại đang chạy (xem run_app_job)
+
+def _job_db():
+    """Kết nối SQLite riêng cho từng thread."""
+    conn = getattr(_job_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                app_id INTEGER NOT NULL,
+                app_name TEXT,
+                domain TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                folder_id TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        # Bộ đệm kịch bản tạo sẵn và lịch sử nội dung (chống trùng) dùng chung giữa các tiến trình
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS script_buffer (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                buffer_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                script TEXT NOT NULL,
+                signature TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS script_buffer_key ON script_buffer (buffer_key, id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS content_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                title TEXT,
+                created_at REAL NOT NULL,
+                signature TEXT NOT NULL,
+                job_key TEXT
+            )
+        """)
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(content_history)")}
+        if 'job_key' not in columns:
+            try:
+                conn.execute("ALTER TABLE content_history ADD COLUMN job_key TEXT") # DB tạo trước khi có cột job_key
+            except sqlite3.OperationalError:
+                pass # Tiến trình khác vừa thêm cột
+        conn.execute("CREATE INDEX IF NOT EXISTS content_history_kind ON content_history (kind, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS content_history_job ON content_history (job_key)")
+        conn.execute("CREATE TABLE IF NOT EXISTS content_bands (band_key TEXT NOT NULL, kind TEXT NOT NULL, history_id INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS content_bands_key ON content_bands (kind, band_key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS content_bands_history ON content_bands (history_id)")
+        # Batch job Gemini producer đã gửi, chờ lấy kết quả (name NULL: đang gửi)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS script_batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                kind TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        _job_db_local.conn = conn
+    return conn
+
+def enqueue_job(app_id, app_name, domain, idempotency_key=None):
+    """Xếp một job. Trả về id job, hoặc None nếu key đã tồn tại (job đã được xếp trước đó)."""
+    now = time.time()
+    key = idempotency_key or f"{app_id}:{uuid.uuid4().hex}"
+    cursor = _job_db().execute(
+        "INSERT OR IGNORE INTO jobs (idempotency_key, app_id, app_name, domain, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (key, app_id, app_name, domain, now, now)
+    )
+    return cursor.lastrowid if cursor.rowcount else None
+
+def pending_job_count():
+    return _job_db().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'leased')").fetchone()[0]
+
+def finished_jobs(job_ids):
+    """{job_id: 'done' | 'failed'} của các job trong job_ids đã kết thúc (hết lượt thử lại với 'failed')."""
+    rows = _job_db().execute(
+        f"SELECT id, status FROM jobs WHERE status IN ('done', 'failed') AND id IN ({','.join('?' * len(job_ids))})",
+        job_ids
+    ).fetchall()
+    return {row['id']: row['status'] for row in rows}
+
+def claim_job(worker_id):
+    """Trả các lease hết hạn về hàng đợi rồi nhận job cũ nhất đang chờ (nguyên tử). None nếu không có job."""
+    conn = _job_db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "lease_owner = NULL, last_error = 'lease hết hạn', updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ?",
+            (JOB_MAX_ATTEMPTS, now, now)
+        )
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at, id LIMIT 1").fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (worker_id, now + JOB_LEASE_SECONDS, now, row['id'])
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return dict(row) if row is not None else None
+
+def renew_lease(job_id, worker_id):
+    """Gia hạn lease. False nếu job không còn thuộc worker này (đã bị trả về hàng đợi)."""
+    cursor = _job_db().execute(
+        "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+        (time.time() + JOB_LEASE_SECONDS, time.time(), job_id, worker_id)
+    )
+    return cursor.rowcount == 1
+
+def ack_job(job_id, worker_id):
+    _job_db().execute(
+        "UPDATE jobs SET status = 'done', lease_owner = NULL, updated_at = ? WHERE id = ? AND lease_owner = ?",
+        (time.time(), job_id, worker_id)
+    )
+
+def fail_job(job_id, worker_id, error):
+    """Job lỗi: trả về hàng đợi để thử lại, hoặc đánh dấu 'failed' khi đã hết JOB_MAX_ATTEMPTS lần."""
+    _job_db().execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+        "lease_owner = NULL, last_error = ?, updated_at = ? WHERE id = ? AND lease_owner = ?",
+        (JOB_MAX_ATTEMPTS, str(error)[:500], time.time(), job_id, worker_id)
+    )
+
+def set_job_folder(job_id, folder_id):
+    _job_db().execute("UPDATE jobs SET folder_id = ?, updated_at = ? WHERE id = ?", (folder_id, time.time(), job_id))
+
+def current_job():
+    return getattr(_job_context, 'job', None)
+
+def current_checkpoint():
+    return getattr(_job_context, 'checkpoint', None)
+
+def find_job_folder(drive_service, parent_folder_id, job_key):
+    """Thư mục Drive đã tạo cho job ở lần chạy trước (tìm theo property), phòng khi worker chết trước khi ghi vào DB."""
+    query = (
+        f"'{parent_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false "
+        f"and properties has {{ key='{JOB_FOLDER_PROPERTY}' and value='{job_key}' and visibility='PRIVATE' }}"
+    )
+    folders = drive_call_with_retry(
+        lambda: drive_service.ListFile({'q': query, 'fields': 'items(id)', 'maxResults': 1}).GetList(),
+        "tìm thư mục của job"
+    )
+    return folders[0]['id'] if folders else None
+
+# ==========================================================
+# --- CHECKPOINT TỪNG JOB: CHẠY TIẾP SAU CRASH / KHỞI ĐỘNG LẠI ---
+# ==========================================================
+# Mỗi job có một thư mục JOB_CHECKPOINT_DIR/<hash key>/ gồm state.json (kịch bản, thư mục Drive, hash JPEG và
+# file đã upload của từng slide) cùng ảnh nền đã chọn: nguồn trong cache ảnh nền (provider, photo_id), hoặc bản sao
+# bg_<i>.jpg khi ảnh không có trong cache. Cờ 'notified' ghi lại bài đã được gửi lên Telegram. state.json được ghi lại
+# (tmp + os.replace) ngay sau mỗi tầng nên lần chạy lại bắt đầu từ slide đầu tiên chưa xong.
+# Job hàng đợi dùng idempotency_key (worker thử lại là tiếp tục); job cục bộ (interactive/daemon) dùng key 'local:'
+# và được chạy tiếp khi tiến trình khởi động lại (resume_local_jobs).
+class JobCheckpoint:
+    def __init__(self, key, **info):
+        self.key = key
+        self.dir = os.path.join(JOB_CHECKPOINT_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest()[:24])
+        self._lock = threading.Lock()
+        state = _read_checkpoint_state(self.dir)
+        self.resumed = bool(state) and state.get('key') == key
+        if self.resumed:
+            self.state = state
+            self.state['resumes'] = self.state.get('resumes', 0) + 1
+            self.state.setdefault('slides', {})
+            with self._lock:
+                self._save_locked() # Ghi ngay số lần chạy tiếp để job lỗi mãi không được chạy lại vô hạn
+        else:
+            self.state = {'key': key, 'created_at': time.time(), 'resumes': 0, 'slides': {}, **info}
+
+    def _save_locked(self):
+        self.state['updated_at'] = time.time()
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, 'state.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def get(self, name):
+        with self._lock:
+            return self.state.get(name)
+
+    def set(self, name, value):
+        with self._lock:
+            self.state[name] = value
+            self._save_locked()
+
+    def slide(self, slide_index):
+        """Tiến độ của slide (chỉ số từ 0): background, sha256, file_id, link."""
+        with self._lock:
+            return dict(self.state['slides'].get(str(slide_index), {}))
+
+    def _update_slide(self, slide_index, **fields):
+        with self._lock:
+            self.state['slides'].setdefault(str(slide_index), {}).update(fields)
+            self._save_locked()
+
+    def save_background(self, slide_index, img):
+        """
+        Ghi nhớ ảnh nền của slide. Ảnh đang nằm trong cache ảnh nền chỉ được ghi nguồn (provider, photo_id) vào
+        state.json; chỉ khi không có trong cache mới lưu bản sao JPEG vào thư mục checkpoint.
+        """
+        source = img.info.get('bg_cache')
+        if source:
+            self._update_slide(slide_index, background_cache=list(source))
+            return
+        name = f"bg_{slide_index}.jpg"
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, name)
+        img.save(path + '.tmp', format='JPEG', quality=92)
+        os.replace(path + '.tmp', path)
+        self._update_slide(slide_index, background=name)
+
+    def load_background(self, slide_index):
+        """Ảnh nền đã chọn cho slide ở lần chạy trước, None nếu chưa có (hoặc file hỏng / đã bị loại khỏi cache)."""
+        saved = self.slide(slide_index)
+        if saved.get('background_cache'):
+            img = bg_cache_load(*saved['background_cache'])
+            if img is None:
+                print(f"  - Cảnh báo: Ảnh nền của slide {slide_index + 1} đã bị loại khỏi cache. Tải nền mới.")
+            return img
+        name = saved.get('background')
+        if not name:
+            return None
+        try:
+            img = Image.open(os.path.join(self.dir, name))
+            img.load()
+            return img.convert('RGB')
+        except (OSError, ValueError) as e:
+            print(f"  - Cảnh báo: Ảnh nền trong checkpoint hỏng ({name}): {e}. Tải nền mới.")
+            return None
+
+    def record_render(self, slide_index, jpeg_bytes):
+        digest = hashlib.sha256(jpeg_bytes).hexdigest()
+        previous = self.slide(slide_index).get('sha256')
+        if previous and previous != digest:
+            print(f"  - Cảnh báo: Slide {slide_index + 1} vẽ lại khác với lần chạy trước (hash thay đổi).")
+        self._update_slide(slide_index, sha256=digest)
+
+    def record_upload(self, slide_index, file_id, link):
+        self._update_slide(slide_index, file_id=file_id, link=link)
+
+    def discard(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def _read_checkpoint_state(directory):
+    try:
+        with open(os.path.join(directory, 'state.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _checkpoint_dirs():
+    """(thư mục, state hoặc None) của mọi checkpoint trên đĩa."""
+    try:
+        names = os.listdir(JOB_CHECKPOINT_DIR)
+    except FileNotFoundError:
+        return []
+    directories = [os.path.join(JOB_CHECKPOINT_DIR, name) for name in names]
+    return [(directory, _read_checkpoint_state(directory)) for directory in directories if os.path.isdir(directory)]
+
+def prune_checkpoints():
+    """Xoá checkpoint không được cập nhật quá JOB_CHECKPOINT_MAX_AGE_HOURS (job đã bị bỏ hẳn)."""
+    cutoff = time.time() - JOB_CHECKPOINT_MAX_AGE_HOURS * 3600
+    for directory, state in _checkpoint_dirs():
+        try:
+            updated_at = state.get('updated_at', 0) if state else os.path.getmtime(directory)
+        except OSError:
+            continue
+        if updated_at < cutoff:
+            shutil.rmtree(directory, ignore_errors=True)
+
+def resume_local_jobs(drive_service):
+    """
+    Khi khởi động (interactive/daemon): chạy tiếp các job cục bộ còn dở từ lần chạy trước.
+    Job của hàng đợi SQLite không chạy ở đây mà được worker chạy lại (cùng idempotency_key nên dùng lại checkpoint).
+    """
+    if not JOB_CHECKPOINT_ENABLED:
+        return
+    prune_checkpoints()
+    for directory, state in _checkpoint_dirs():
+        if not state or not state.get('key', '').startswith('local:'):
+            continue
+        app_func = APP_FUNCTION_MAP.get(state.get('app_id'))
+        if app_func is None or state.get('resumes', 0) >= JOB_MAX_ATTEMPTS:
+            print(f"⚠️ Bỏ checkpoint của job '{state.get('app_name')} | {state.get('domain')}' (đã thử lại {state.get('resumes', 0)} lần).")
+            shutil.rmtree(directory, ignore_errors=True)
+            continue
+        print(f"♻️ Tìm thấy job dở dang: {state.get('app_name')} | {state.get('domain')}")
+        run_app_job(drive_service, state['app_id'], {'name': state['app_name'], 'function': app_func}, state['domain'], checkpoint_key=state['key'])
+
+def run_worker(drive_service, worker_id=None):
+    """Vòng lặp worker: nhận job, chạy, gia hạn lease trong lúc chạy, ack/fail. Dừng êm khi nhận SIGTERM/SIGINT."""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        if not stop_event.is_set():
+            print(f"\n🛑 Nhận tín hiệu {signal.Signals(signum).name}: worker sẽ dừng sau các job đang chạy.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    if JOB_CHECKPOINT_ENABLED:
+        prune_checkpoints()
+
+    def worker_thread(thread_index):
+        thread_worker_id = f"{worker_id}:{thread_index}"
+        while not stop_event.is_set():
+            job = claim_job(thread_worker_id)
+            if job is None:
+                stop_event.wait(JOB_POLL_SECONDS)
+                continue
+            print(f"📥 [{thread_worker_id}] Nhận job #{job['id']} ({job['app_name']} | {job['domain']}), lần {job['attempts']}.")
+            app_func = APP_FUNCTION_MAP.get(job['app_id'])
+            if app_func is None:
+                fail_job(job['id'], thread_worker_id, f"Không có hàm cho app {job['app_id']}")
+                continue
+
+            # Gia hạn lease định kỳ trong lúc job chạy
+            job_done = threading.Event()
+            def heartbeat():
+                while not job_done.wait(JOB_LEASE_SECONDS / 3):
+                    if not renew_lease(job['id'], thread_worker_id):
+                        print(f"  - Cảnh báo: Mất lease của job #{job['id']}.")
+                        return
+            threading.Thread(target=heartbeat, daemon=True).start()
+
+            try:
+                ok = run_app_job(drive_service, job['app_id'], {'name': job['app_name'], 'function': app_func}, job['domain'], job=job)
+            finally:
+                job_done.set()
+            if ok:
+                ack_job(job['id'], thread_worker_id)
+            else:
+                fail_job(job['id'], thread_worker_id, "Ứng dụng gặp lỗi (xem thông báo Telegram)")
+
+    print(f"👷 Worker {worker_id}: {JOB_WORKER_THREADS} luồng, hàng đợi {JOB_QUEUE_DB}.")
+    threads = [threading.Thread(target=worker_thread, args=(i,), name=f"worker_{i}") for i in range(JOB_WORKER_THREADS)]
+    for thread in threads:
+        thread.start()
+    # Chờ bằng vòng lặp ngắn để tín hiệu được xử lý ở thread chính
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=0.5)
+    print("Worker đã dừng. Tạm biệt!")
+
 if __name__ == "__main__":
     # 1. KIỂM TRA CẤU HÌNH VÀ BẮT ĐẦU XÁC THỰC DRIVE
     if not os.path.exists(FONT_PATH):
@@ -1028,6 +4369,9 @@ if __name__ == "__main__":
         send_telegram_notification(f"LỖI KHỞI ĐỘNG: {error_msg}")
         exit()
 
+    # Số liệu từng tầng: endpoint Prometheus + tóm tắt JSON định kỳ
+    start_metrics()
+
     # 2. XÁC THỰC GOOGLE DRIVE
     print("Đang xác thực Google Drive...")
     gauth = GoogleAuth()
@@ -1080,6 +4424,22 @@ if __name__ == "__main__":
     drive_service = GoogleDrive(gauth)
     print("✅ Đã kết nối Google Drive thành công.")
 
+    # Job cục bộ bị dừng giữa chừng ở lần chạy trước (crash, tắt máy) được chạy tiếp trước tiên
+    if RUN_MODE in ('interactive', 'daemon'):
+        resume_local_jobs(drive_service)
+
+    # Chế độ daemon: bộ lập lịch không tương tác thay cho vòng lặp bên dưới
+    if RUN_MODE == 'daemon':
+        run_scheduler(drive_service)
+        sys.exit(0)
+    # Nhiều tiến trình/máy dùng chung hàng đợi SQLite: một scheduler xếp job, các worker nhận và chạy
+    if RUN_MODE == 'scheduler':
+        run_scheduler(drive_service, enqueue_only=True)
+        sys.exit(0)
+    if RUN_MODE == 'worker':
+        run_worker(drive_service)
+        sys.exit(0)
+
     # ==========================================================
     # --- 4. VÒNG LẶP TỰ ĐỘNG HÓA CHÍNH (ĐÃ SỬA THEO YÊU CẦU) ---
     # ==========================================================
@@ -1090,11 +4450,12 @@ if __name__ == "__main__":
 
         # --- TẢI CẤU HÌNH ---
         try:
-            dynamic_app_modes_raw = load_app_modes_from_sheet(GSHEET_ID)
+            dynamic_app_modes_raw = get_app_modes(GSHEET_ID)
         except Exception as e:
             error_msg_load_sheet = f"❌ Lỗi nghiêm trọng khi tải cấu hình từ Google Sheet: {e}"
             print(error_msg_load_sheet)
             send_telegram_notification(f"LỖI SHEET NGHIÊM TRỌNG: {error_msg_load_sheet}")
+            dynamic_app_modes_raw = None
             # Không exit() ở đây mà chỉ time.sleep(TIMEOUT_SECONDS) và continue như logic cũ
 
         if dynamic_app_modes_raw is None:
@@ -1102,43 +4463,7 @@ if __name__ == "__main__":
             time.sleep(TIMEOUT_SECONDS)
             continue
 
-        APP_MODES = {}
-        APP_FUNCTION_MAP = {
-            1: run_story_app,
-            2: run_phong_thuy,
-            3: run_la_so_tu_vi,
-            4: run_tarot,
-            5: run_cung_hoang_dao,
-            6: run_fairy_tale_app,
-            7: run_joke_app
-        }
-
-        # 1. TẠO APP_MODES TỪ SHEET (cho các app cũ)
-        for app_id, config in dynamic_app_modes_raw.items():
-            if app_id in APP_FUNCTION_MAP:
-                config["function"] = APP_FUNCTION_MAP[app_id]
-                APP_MODES[app_id] = config
-            else:
-                print(f"Cảnh báo: Không tìm thấy hàm thực thi cho ID ứng dụng {app_id}. Bỏ qua.")
-
-        # 2. THÊM CÁC APP KHÔNG CẦN SHEET VÀO APP_MODES (Cho các app mới)
-        # Thêm Truyện Cổ Tích
-        if 6 not in APP_MODES:
-            APP_MODES[6] = {
-                "name": "Truyện Cổ Tích (AI)",
-                "domains": ["AI_GENERATED_FAIRY_TALE"], # Dùng một chủ đề giả để logic check không bị lỗi
-                "function": run_fairy_tale_app,
-                "mode": "auto" # Thiết lập mặc định
-            }
-
-        # Thêm Truyện Cười
-        if 7 not in APP_MODES:
-            APP_MODES[7] = {
-                "name": "Truyện Cười (AI)",
-                "domains": ["AI_GENERATED_JOKE"], # Dùng một chủ đề giả để logic check không bị lỗi
-                "function": run_joke_app,
-                "mode": "auto" # Thiết lập mặc định
-            }
+        APP_MODES = build_app_modes(dynamic_app_modes_raw)
 
         if not APP_MODES:
             print("\n❌ Lỗi: Không có ứng dụng nào được cấu hình hợp lệ sau khi tải Sheet. Chương trình sẽ thử lại sau 5 giây.")
@@ -1146,6 +4471,10 @@ if __name__ == "__main__":
             continue
 
         print(f"✅ Đã tải và cấu hình thành công {len(APP_MODES)} ứng dụng.")
+
+        # Producer nạp sẵn kịch bản cho đúng các app/chủ đề đang được cấu hình
+        if SCRIPT_BUFFER_ENABLED:
+            start_script_producer(script_targets_for_app_modes(APP_MODES))
         # --- KẾT THÚC LOGIC TẢI CẤU HÌNH ---
 
         # A. Tự động ngẫu nhiên chọn Ứng dụng
@@ -1161,7 +4490,6 @@ if __name__ == "__main__":
 
         chosen_app = APP_MODES[app_id]
         app_name = chosen_app["name"]
-        app_func = chosen_app["function"]
         app_domains = chosen_app["domains"]
 
         print(f"🤖 Đang chọn ứng dụng...")
@@ -1169,33 +4497,11 @@ if __name__ == "__main__":
 
         # B. Kiểm tra chủ đề và THỰC THI
         if app_domains:
-            # --- LOGIC CHỌN DOMAIN DỰA TRÊN APP_ID ---
-            chosen_domain = None
-            if app_id == 1: # CAUCHUYEN
-                # Rule 1: Chọn ngẫu nhiên từ domains
-                chosen_domain = random.choice(app_domains)
-                print("Lựa chọn: Ngẫu nhiên (CAUCHUYEN)")
-            elif app_id in [6, 7]: # FAIRYTALE hoặc JOKE
-                # Rule 3: KHÔNG CẦN DOMAIN TỪ SHEET, AI TỰ TẠO
-                chosen_domain = f"AI_Generated_{app_name}"
-                print(f"Lựa chọn: Chủ đề tự động tạo bởi AI ({app_name})")
-            elif app_domains:
-                # Rule 2: Chọn chủ đề ĐẦU TIÊN (Cho các app còn lại)
-                chosen_domain = app_domains[0]
-                print("Lựa chọn: Chủ đề đầu tiên của cột (B->E)")
+            chosen_domain = choose_app_domain(app_id, chosen_app)
 
             if chosen_domain:
                 print(f"✅ Đã chọn Chủ đề: **{chosen_domain}**")
-
-                try:
-                    print(f"\n--- BẮT ĐẦU THỰC THI: {app_name.upper()} ---")
-                    app_func(drive_service, chosen_domain)
-                    print(f"\n--- KẾT THÚC THỰC THI: {app_name.upper()} ---\n")
-                except Exception as e:
-                    # GỬI THÔNG BÁO LỖI CHẠY ỨNG DỤNG
-                    error_msg_run_app = f"❌ Lỗi nghiêm trọng trong quá trình chạy ứng dụng {app_name}: {e}"
-                    print(error_msg_run_app)
-                    send_telegram_notification(f"LỖI CHẠY APP: {error_msg_run_app}")
+                run_app_job(drive_service, app_id, chosen_app, chosen_domain)
 
             # D. Tùy chọn tiếp tục hoặc dừng hẳn (CHỈ HỎI KHI CHẠY THÀNH CÔNG/GẶP LỖI SAU KHI CHỌN DOMAIN)
             while True:
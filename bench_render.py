@@ -0,0 +1,289 @@
+"""
+Benchmark OFFLINE cho phần CPU của việc tạo slide: không gọi mạng, chỉ dùng font.ttf đi kèm và ảnh nền tổng hợp.
+
+Đo riêng từng bước của render_slide_timed() (ngắt dòng, giải mã + cắt ảnh nền, phủ lớp tối, vẽ chữ, mã hoá JPEG)
+và cả slide hoàn chỉnh, với ảnh nền 1-24 MP và các đoạn chữ ngắn / dài / tiếng Việt nhiều dấu.
+Kết quả (slides/giây, p50/p95, RSS tăng thêm của từng case) được ghi ra JSON để so sánh trước/sau khi sửa code.
+
+    python bench_render.py                              # chạy đầy đủ, ghi bench_results.json
+    python bench_render.py --quick                      # ít lần lặp, bỏ ảnh 24 MP
+    python bench_render.py --filter slide/              # chỉ chạy các case có chứa chuỗi này
+    python bench_render.py --compare bench_baseline.json --threshold 0.15
+                                                        # exit 1 nếu case nào chậm hơn baseline quá 15% (p50)
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import functools
+from io import BytesIO
+
+try:
+    import resource # Không có trên Windows: khi đó không đo RSS đỉnh
+except ImportError:
+    resource = None
+
+# app.py tạo client Gemini ngay khi import (không gọi mạng); benchmark không cần key thật
+os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+
+import PIL
+from PIL import Image
+
+import app
+
+# --- DỮ LIỆU ĐẦU VÀO ---
+BENCH_TEXTS = {
+    'short': "Keep going. Small steps still move you forward.",
+    'long': (
+        "Every morning the old fisherman walked down to the harbour before sunrise, checked his nets one knot "
+        "at a time and talked quietly to the sea as if it were an old friend. The younger men laughed at him, "
+        "but when the storm season came his boat was the only one that never needed repairs, because he had "
+        "spent years fixing the small things before they turned into big ones."
+    ),
+    'vietnamese': (
+        "Ngày xửa ngày xưa, ở một ngôi làng nhỏ ven sông, có một người thợ rèn nghèo nhưng rất hiếu thảo. "
+        "Mỗi sáng sớm, ông dậy nhóm lửa, rèn những chiếc lưỡi cày sắc bén để đổi lấy gạo nuôi mẹ già. "
+        "Dẫu trời rét buốt hay nắng cháy, ông chưa từng than thở, chỉ lặng lẽ mỉm cười và tin rằng "
+        "những điều tốt đẹp rồi sẽ đến với người chăm chỉ, thật thà."
+    ),
+}
+BENCH_SIZES_MP = [1, 2, 6, 12, 24]
+BENCH_ASPECT = (3, 2) # Ảnh ngang: trường hợp cắt cover tốn nhất cho khung dọc 1080x1920
+
+def synthetic_background(megapixels, seed=0):
+    """Ảnh JPEG tổng hợp (gradient + nhiễu, tất định theo seed) có khoảng `megapixels` MP. Trả về bytes."""
+    ratio_w, ratio_h = BENCH_ASPECT
+    unit = (megapixels * 1_000_000 / (ratio_w * ratio_h)) ** 0.5
+    width, height = int(unit * ratio_w), int(unit * ratio_h)
+    random.seed(seed)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge('RGB', (gradient, noise, Image.blend(gradient, noise, random.random())))
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue(), (width, height)
+
+@functools.lru_cache(maxsize=1)
+def background_fixture(megapixels):
+    """(bytes JPEG, ảnh đã giải mã đủ) cho một kích thước. Chỉ giữ kích thước đang đo để RSS không cộng dồn."""
+    jpeg_bytes, _ = synthetic_background(megapixels, seed=megapixels)
+    return jpeg_bytes, Image.open(BytesIO(jpeg_bytes)).convert('RGB')
+
+# --- ĐO ĐẠC ---
+def percentile(sorted_samples, q):
+    """Phân vị q (0..1) có nội suy tuyến tính trên danh sách đã sắp xếp."""
+    if not sorted_samples:
+        return None
+    position = (len(sorted_samples) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(sorted_samples) - 1)
+    return sorted_samples[low] + (sorted_samples[high] - sorted_samples[low]) * (position - low)
+
+def _proc_status_kb(field):
+    """Giá trị (KB) của một dòng trong /proc/self/status (Linux), None nếu không đọc được."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """Đặt lại RSS đỉnh về RSS hiện tại (Linux: ghi '5' vào /proc/self/clear_refs). False nếu không hỗ trợ."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_kb():
+    """RSS đỉnh (KB) kể từ lần reset_peak_rss() gần nhất (hoặc từ khi khởi động), None nếu hệ điều hành không hỗ trợ."""
+    peak = _proc_status_kb('VmHWM')
+    if peak is not None or resource is None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak # macOS trả về byte, Linux trả về KB
+
+_process_peak_rss_kb = 0 # reset_peak_rss() xoá mốc đỉnh của hệ điều hành: tự giữ đỉnh của cả lần chạy
+
+def run_case(setup, action, iterations, warmup):
+    """
+    Chạy action(setup()) iterations lần (sau warmup lần chạy nháp); chỉ thời gian của action được tính.
+    Trả về thống kê theo mili giây và RSS đỉnh tăng thêm trong lúc chạy case (rss_growth_kb). Khi không đặt lại
+    được RSS đỉnh (không phải Linux), rss_growth_kb chỉ tính phần vượt đỉnh của các case trước.
+    """
+    global _process_peak_rss_kb
+    per_case = reset_peak_rss()
+    rss_before = _proc_status_kb('VmRSS') if per_case else peak_rss_kb()
+    samples = []
+    for index in range(warmup + iterations):
+        state = setup()
+        start = time.perf_counter()
+        action(state)
+        elapsed = time.perf_counter() - start
+        if index >= warmup:
+            samples.append(elapsed)
+    rss_peak = peak_rss_kb()
+    if rss_peak is not None:
+        _process_peak_rss_kb = max(_process_peak_rss_kb, rss_peak)
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    return {
+        'iterations': len(samples),
+        'mean_ms': round(mean * 1000, 3),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'min_ms': round(samples[0] * 1000, 3),
+        'ops_per_sec': round(1 / mean, 2) if mean > 0 else None,
+        'rss_growth_kb': max(0, rss_peak - rss_before) if rss_peak is not None and rss_before is not None else None,
+    }
+
+# --- CÁC CASE ---
+def build_cases(sizes_mp):
+    """
+    Danh sách (tên case, setup, action, là slide hoàn chỉnh hay không, prepare). prepare (nếu có) tạo ảnh nền của
+    case trước khi đo; ảnh chỉ được tạo khi có case cần đến (sau --filter).
+    """
+    font = app.get_font(app.FONT_SIZE)
+    layouts = {name: app.compute_text_layout(text) for name, text in BENCH_TEXTS.items()}
+    canvas = app.prepare_canvas(Image.effect_noise((app.CANVAS_WIDTH, app.CANVAS_HEIGHT), 40).convert('RGB'))
+    cases = []
+
+    def cold_cache():
+        app._text_measure_cache.clear()
+
+    for name, text in BENCH_TEXTS.items():
+        # Ngắt dòng: cache đo từ trống (slide đầu tiên) và cache đã nóng (chạy lâu dài)
+        cases.append((f"text_wrap/{name}/cold", cold_cache, lambda _, t=text: app.text_wrap(t, font, app.TEXT_BOX_WIDTH), False, None))
+        cases.append((f"text_wrap/{name}/warm", lambda: None, lambda _, t=text: app.text_wrap(t, font, app.TEXT_BOX_WIDTH), False, None))
+        cases.append((f"text_layout/{name}/cold", cold_cache, lambda _, t=text: app.compute_text_layout(t), False, None))
+        cases.append((f"text_draw/{name}", canvas.copy, lambda img, l=layouts[name]: app.draw_text_layout(img, l), False, None))
+
+    cases.append(("overlay", canvas.copy, app.apply_dark_overlay, False, None))
+    rendered = canvas.copy()
+    app.apply_dark_overlay(rendered)
+    app.draw_text_layout(rendered, layouts['vietnamese'])
+    cases.append(("jpeg_encode", lambda: rendered, app.encode_jpeg, False, None))
+
+    for megapixels in sizes_mp:
+        label = f"{megapixels}mp"
+        prepare = functools.partial(background_fixture, megapixels)
+        # Đường giải mã thật (draft của libjpeg + cắt cover) và riêng bước cắt/thu nhỏ trên ảnh đã giải mã đủ
+        cases.append((f"decode_resize/{label}", prepare, lambda fixture: app.decode_background(fixture[0]), False, prepare))
+        cases.append((f"resize_crop/{label}", prepare, lambda fixture: app.fit_cover(fixture[1]), False, prepare))
+        for name, text in BENCH_TEXTS.items():
+            # Slide hoàn chỉnh từ bytes ảnh nền tải về: giải mã + cắt + phủ tối + dàn trang + vẽ chữ + JPEG
+            cases.append((
+                f"slide/{label}/{name}",
+                prepare,
+                lambda fixture, t=text: app.render_slide_timed(t, app.decode_background(fixture[0])),
+                True,
+                prepare
+            ))
+    return cases
+
+def run_benchmark(args):
+    sizes_mp = [float(size) if '.' in size else int(size) for size in args.sizes.split(',') if size.strip()]
+    print(f"🔧 Benchmark vẽ slide: ảnh nền {sizes_mp} MP, {args.iterations} lần lặp/case (+{args.warmup} lần nháp).")
+    results = {}
+    for name, setup, action, is_slide, prepare in build_cases(sizes_mp):
+        if args.filter and args.filter not in name:
+            continue
+        if prepare is not None:
+            prepare() # Tạo ảnh nền ngoài phần đo RSS của case
+        iterations = args.slide_iterations if is_slide else args.iterations
+        stats = run_case(setup, action, iterations, args.warmup)
+        if is_slide:
+            stats['slides_per_sec'] = stats['ops_per_sec']
+        results[name] = stats
+        rss_growth = f"+{stats['rss_growth_kb']} KB" if stats['rss_growth_kb'] is not None else "-"
+        print(f"  {name:<34} p50 {stats['p50_ms']:>9.2f} ms   p95 {stats['p95_ms']:>9.2f} ms   {stats['ops_per_sec']:>9.2f}/s   RSS {rss_growth}")
+    return results
+
+def environment_info(args):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=app.FILE_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'font': os.path.basename(app.FONT_PATH),
+        'font_auto_fit': app.FONT_AUTO_FIT,
+        'iterations': args.iterations,
+        'slide_iterations': args.slide_iterations,
+        'warmup': args.warmup,
+    }
+
+def compare_results(results, baseline_path, threshold):
+    """In chênh lệch p50 so với baseline. Trả về danh sách case chậm hơn quá ngưỡng."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f).get('results', {})
+    regressions = []
+    print(f"\n📈 So sánh với {baseline_path} (ngưỡng +{threshold:.0%} theo p50):")
+    for name, stats in results.items():
+        old = baseline.get(name)
+        if not old or not old.get('p50_ms'):
+            continue
+        change = stats['p50_ms'] / old['p50_ms'] - 1
+        marker = '❌' if change > threshold else ('✅' if change < -threshold else '  ')
+        print(f"  {marker} {name:<34} {old['p50_ms']:>9.2f} -> {stats['p50_ms']:>9.2f} ms ({change:+.1%})")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline cho phần vẽ slide (CPU).")
+    parser.add_argument('--iterations', type=int, default=30, help="Số lần đo cho mỗi case từng bước")
+    parser.add_argument('--slide-iterations', type=int, default=10, help="Số lần đo cho mỗi case slide hoàn chỉnh")
+    parser.add_argument('--warmup', type=int, default=2, help="Số lần chạy nháp không tính")
+    parser.add_argument('--sizes', help="Kích thước ảnh nền (MP), phân tách bằng dấu phẩy (mặc định: 1,2,6,12,24)")
+    parser.add_argument('--filter', default='', help="Chỉ chạy các case có tên chứa chuỗi này")
+    parser.add_argument('--quick', action='store_true', help="Chạy nhanh: ít lần lặp, bỏ ảnh 24 MP (trừ khi có --sizes)")
+    parser.add_argument('--output', default='bench_results.json', help="File JSON kết quả")
+    parser.add_argument('--compare', help="File JSON kết quả cũ để so sánh")
+    parser.add_argument('--threshold', type=float, default=0.15, help="Tỉ lệ chậm hơn (p50) bị coi là hồi quy")
+    args = parser.parse_args()
+    if args.quick:
+        args.iterations, args.slide_iterations, args.warmup = 5, 3, 1
+    if args.sizes is None:
+        args.sizes = ','.join(str(size) for size in BENCH_SIZES_MP if not (args.quick and size >= 24))
+
+    if not os.path.exists(app.FONT_PATH):
+        print(f"⚠️ LỖI: Không tìm thấy file font '{app.FONT_PATH}'.")
+        sys.exit(2)
+
+    started = time.perf_counter()
+    results = run_benchmark(args)
+    report = {
+        'environment': environment_info(args),
+        'duration_seconds': round(time.perf_counter() - started, 2),
+        'peak_rss_kb': max(_process_peak_rss_kb, peak_rss_kb() or 0) or None,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ Đã ghi kết quả vào {args.output} (RSS đỉnh: {report['peak_rss_kb']} KB, {report['duration_seconds']}s).")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} case chậm hơn baseline quá {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("✅ Không có hồi quy hiệu năng.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,596 @@
+"""
+Load test end-to-end KHÔNG cần mạng: chạy các app run_* thật (Gemini -> ảnh nền -> vẽ -> Drive -> Telegram)
+với server giả lập cục bộ cho Pexels, Unsplash, Telegram, Google Sheet (CSV), Google Drive và Gemini.
+
+Mỗi server giả lập có độ trễ, tỉ lệ lỗi và kích thước dữ liệu cấu hình được. Harness đo số bài/phút,
+thời gian từng tầng (lấy từ số liệu của app.py) và bộ nhớ theo thời gian (để phát hiện rò rỉ khi chạy lâu).
+
+    python loadtest.py --duration 120 --concurrency 4
+    python loadtest.py --duration 3600 --concurrency 8 --latency gemini=1500,drive=300 --error-rate drive=0.02
+    python loadtest.py --jobs 20 --apps 6,7 --image-mp 12 --output soak.json
+
+Các biến môi trường khác của app.py (PIPELINE_*, DRIVE_UPLOAD_WORKERS, SCRIPT_BUFFER_ENABLED...) vẫn dùng được
+để so sánh cấu hình; khoá API, địa chỉ API và các file trạng thái luôn bị trỏ về server giả lập / thư mục tạm.
+"""
+import os
+import sys
+import abc
+import csv
+import email
+import json
+import time
+import uuid
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import threading
+import importlib
+import multiprocessing
+from io import BytesIO, StringIO
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image
+
+# Độ trễ trung bình mặc định (ms) của từng dịch vụ giả lập, gần với thực tế
+DEFAULT_LATENCY_MS = {'gemini': 1200, 'pexels': 120, 'unsplash': 150, 'telegram': 80, 'sheets': 200, 'drive': 250}
+FAKE_WORDS = (
+    "trăng sao biển gió núi rừng mưa nắng hoa lá sông suối làng quê mẹ cha con cháu bạn bè thầy trò ngày đêm "
+    "sáng tối xuân hạ thu đông niềm vui nỗi buồn hy vọng ước mơ bình yên hạnh phúc yêu thương nhớ nhung "
+    "chờ đợi lặng lẽ rực rỡ dịu dàng mạnh mẽ kiên nhẫn chăm chỉ thật thà hiếu thảo tốt bụng may mắn "
+    "con đường ngôi nhà khu vườn cánh đồng chiếc lá giọt sương ánh đèn bếp lửa tiếng chuông lời hứa"
+).split()
+FAKE_QUERY_WORDS = "rain snow forest mountain sea sunset sunrise books plant river sky night".split()
+FAKE_SHEET_DOMAINS = {
+    'CAUCHUYEN': ["Gia đình", "Tình bạn", "Tuổi trẻ", "Công việc"],
+    'PHONGTHUY': ["Phong thủy phòng ngủ", "Cây hợp mệnh"],
+    'TUVI': ["Tử vi tuổi Tý", "Tử vi tuổi Ngọ"],
+    'TAROT': ["Tarot tình yêu", "Tarot sự nghiệp"],
+    'CUNGHOANGDAO': ["Bạch Dương", "Song Ngư"],
+}
+
+def fake_words(count):
+    return ' '.join(random.choice(FAKE_WORDS) for _ in range(count)).capitalize() + '.'
+
+def fake_jpeg(megapixels, seed):
+    """Ảnh JPEG tổng hợp dọc 2:3 khoảng `megapixels` MP (nhiễu để kích thước file giống ảnh thật)."""
+    unit = (megapixels * 1_000_000 / 6) ** 0.5
+    size = (int(unit * 2), int(unit * 3))
+    random.seed(seed)
+    img = Image.merge('RGB', [Image.effect_noise(size, random.randint(20, 60)) for _ in range(3)])
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=88)
+    return buffer.getvalue(), size
+
+# ==========================================================
+# --- SERVER GIẢ LẬP ---
+# ==========================================================
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Giữ kết nối (keep-alive) như API thật
+
+    def do_GET(self):
+        self.server.fake.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.fake.handle(self, 'POST')
+
+    def do_PUT(self):
+        self.server.fake.handle(self, 'PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeService(abc.ABC):
+    """
+    Server HTTP giả lập trên một cổng ngẫu nhiên của 127.0.0.1. Mỗi request: chờ độ trễ ngẫu nhiên quanh
+    latency_ms (± jitter), trả về error_status với xác suất error_rate, còn lại gọi route() của lớp con.
+    """
+    def __init__(self, name, latency_ms=0, jitter=0.3, error_rate=0.0, error_status=503):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stats = {'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), FakeRequestHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, name=f"fake_{self.name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _count(self, **amounts):
+        with self._lock:
+            for key, amount in amounts.items():
+                self.stats[key] = self.stats.get(key, 0) + amount
+
+    def handle(self, handler, method):
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        self._count(requests=1, bytes_in=len(body))
+        if self.latency_ms > 0:
+            time.sleep(max(0.0, self.latency_ms * random.uniform(1 - self.jitter, 1 + self.jitter)) / 1000)
+
+        if random.random() < self.error_rate:
+            self._count(errors=1)
+            status, headers, payload = self.error_response()
+        else:
+            parts = urlsplit(handler.path)
+            query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+            status, headers, payload = self.route(method, parts.path, query, body, handler.headers)
+
+        self._count(bytes_out=len(payload))
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def error_response(self):
+        return self.json_response({'error': 'injected'}, self.error_status)
+
+    @abc.abstractmethod
+    def route(self, method, path, query, body, headers):
+        """(status, headers, payload) cho một request không bị tiêm lỗi."""
+
+    @staticmethod
+    def json_response(data, status=200, headers=None):
+        return status, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+class FakeImageHost(FakeService):
+    """Phần dùng chung cho Pexels/Unsplash/Drive: phục vụ một số ảnh JPEG tổng hợp dựng sẵn."""
+    def __init__(self, name, image_mp=2.0, photo_pool=200, variants=4, **kwargs):
+        super().__init__(name, **kwargs)
+        self.photo_pool = photo_pool
+        self.images = [fake_jpeg(image_mp, seed) for seed in range(variants)]
+
+    def image_response(self, photo_id):
+        jpeg_bytes, _ = self.images[hash(photo_id) % len(self.images)]
+        return 200, {'Content-Type': 'image/jpeg'}, jpeg_bytes
+
+    def random_photo_id(self):
+        return str(random.randrange(self.photo_pool))
+
+class FakePexels(FakeImageHost):
+    def __init__(self, per_page=40, **kwargs):
+        super().__init__('pexels', **kwargs)
+        self.per_page = per_page
+
+    def route(self, method, path, query, body, headers):
+        if path.startswith('/cdn/'):
+            return self.image_response(path.rsplit('/', 1)[-1])
+        if path.endswith('/search'):
+            width, height = self.images[0][1]
+            photos = []
+            for _ in range(min(self.per_page, int(query.get('per_page', self.per_page)))):
+                photo_id = self.random_photo_id()
+                original = f"{self.url}/cdn/{photo_id}"
+                photos.append({
+                    'id': int(photo_id), 'width': width, 'height': height,
+                    'src': {'original': original, 'large2x': f"{original}?large2x", 'large': f"{original}?large"}
+                })
+            return self.json_response({'page': int(query.get('page', 1)), 'per_page': len(photos), 'total_results': self.photo_pool, 'photos': photos})
+        return self.json_response({'error': 'not found'}, 404)
+
+class FakeUnsplash(FakeImageHost):
+    def __init__(self, **kwargs):
+        super().__init__('unsplash', **kwargs)
+
+    def route(self, method, path, query, body, headers):
+        if path.startswith('/cdn/'):
+            return self.image_response(path.rsplit('/', 1)[-1])
+        if path == '/photos/random':
+            width, height = self.images[0][1]
+            photo_id = self.random_photo_id()
+            base = f"{self.url}/cdn/{photo_id}"
+            photo = {'id': photo_id, 'width': width, 'height': height, 'urls': {'raw': base, 'full': base, 'regular': base}}
+            return self.json_response([photo] * int(query.get('count', 1)))
+        return self.json_response({'errors': ['not found']}, 404)
+
+class FakeTelegram(FakeService):
+    """
+    Bot API tối thiểu. Ngoài số request theo method, đếm số bài thật sự được đăng (posts): album bắt đầu từ
+    slide 1 (sendMediaGroup/sendPhoto) hoặc tin nhắn chứa link Drive của các slide; thông báo lỗi không được tính.
+    """
+    def __init__(self, **kwargs):
+        super().__init__('telegram', **kwargs)
+
+    def route(self, method, path, query, body, headers):
+        api_method = path.rsplit('/', 1)[-1]
+        self._count(**{f"method_{api_method}": 1})
+        if api_method in ('sendMediaGroup', 'sendPhoto'):
+            self._count(slides_posted=body.count(b'filename="slide_'), posts=int(b'filename="slide_1.jpg"' in body))
+        elif api_method == 'sendMessage':
+            links = parse_qs(body.decode('utf-8', 'replace')).get('text', [''])[-1].count('/file/d/')
+            if links:
+                self._count(slides_posted=links, posts=1)
+        return self.json_response({'ok': True, 'result': {'message_id': random.randrange(10**9)}})
+
+class FakeSheets(FakeService):
+    """CSV xuất từ Sheet theo cột (tiêu đề APP_COLUMN_MAPPING), hỗ trợ ETag / 304 như Google."""
+    def __init__(self, **kwargs):
+        super().__init__('sheets', **kwargs)
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        columns = list(FAKE_SHEET_DOMAINS)
+        writer.writerow(columns)
+        for row in range(max(len(domains) for domains in FAKE_SHEET_DOMAINS.values())):
+            writer.writerow([FAKE_SHEET_DOMAINS[column][row] if row < len(FAKE_SHEET_DOMAINS[column]) else '' for column in columns])
+        self.csv_bytes = buffer.getvalue().encode('utf-8')
+        self.etag = '"' + hashlib.md5(self.csv_bytes).hexdigest() + '"'
+
+    def route(self, method, path, query, body, headers):
+        if headers.get('If-None-Match') == self.etag:
+            return 304, {'ETag': self.etag}, b''
+        return 200, {'Content-Type': 'text/csv; charset=utf-8', 'ETag': self.etag}, self.csv_bytes
+
+class FakeDrive(FakeImageHost):
+    """
+    Google Drive API v2 tối thiểu cho pydrive2: cấp id trước (generateIds), tạo thư mục, upload multipart/resumable,
+    đọc metadata theo id, liệt kê thư mục ảnh nền, tải nội dung file. Dữ liệu upload chỉ được đếm byte rồi bỏ đi.
+    """
+    def __init__(self, background_files=50, **kwargs):
+        super().__init__('drive', **kwargs)
+        self.background_files = background_files
+        self._resumable = {} # upload_id -> metadata
+        self._files = {} # id -> metadata của file/thư mục đã tạo
+
+    def _created(self, metadata=None):
+        metadata = metadata or {}
+        file_id = metadata.get('id') or uuid.uuid4().hex
+        if file_id in self._files:
+            return self.json_response({'error': {'code': 409, 'message': 'id already exists'}}, 409)
+        self._count(files_created=1)
+        self._files[file_id] = {
+            'id': file_id, 'title': metadata.get('title'),
+            'alternateLink': f"{self.url}/file/d/{file_id}/view"
+        }
+        return self.json_response(self._files[file_id])
+
+    def error_response(self):
+        # Lỗi theo định dạng của Google API (pydrive2 đọc error.code / errors[].reason)
+        return self.json_response({'error': {
+            'code': self.error_status, 'message': 'injected',
+            'errors': [{'domain': 'global', 'reason': 'backendError', 'message': 'injected'}]
+        }}, self.error_status)
+
+    def route(self, method, path, query, body, headers):
+        if path == '/drive/v2/files/generateIds':
+            count = int(query.get('maxResults') or 10)
+            return self.json_response({'kind': 'drive#generatedIds', 'space': 'drive', 'ids': [uuid.uuid4().hex for _ in range(count)]})
+        if path == '/upload/drive/v2/files':
+            upload_type = query.get('uploadType')
+            if method == 'POST' and upload_type == 'resumable':
+                upload_id = uuid.uuid4().hex
+                self._resumable[upload_id] = json.loads(body or b'{}')
+                return 200, {'Location': f"{self.url}/upload/drive/v2/files?uploadType=resumable&upload_id={upload_id}"}, b''
+            if method == 'PUT' and 'upload_id' in query:
+                content_range = headers.get('Content-Range', '')
+                try:
+                    end, total = content_range.split(' ', 1)[1].split('-', 1)[1].split('/')
+                    if int(end) + 1 < int(total):
+                        return 308, {'Range': f"bytes=0-{end}"}, b''
+                except (IndexError, ValueError):
+                    pass
+                response = self._created(self._resumable.pop(query['upload_id'], None))
+                if response[0] == 200:
+                    self._count(slides_uploaded=1)
+                return response
+            # multipart/related: phần đầu là metadata JSON (có id cấp trước), phần sau là nội dung file
+            message = email.message_from_bytes(b'Content-Type: ' + headers.get('Content-Type', '').encode() + b'\r\n\r\n' + body)
+            parts = message.get_payload() if message.is_multipart() else []
+            response = self._created(json.loads(parts[0].get_payload(decode=True) or b'{}') if parts else None)
+            if response[0] == 200:
+                self._count(slides_uploaded=1)
+            return response
+        if path == '/drive/v2/files':
+            if method == 'POST':
+                return self._created(json.loads(body or b'{}'))
+            # Chỉ thư mục ảnh nền có file; truy vấn tìm thư mục của job (theo property) luôn rỗng
+            if 'properties has' in query.get('q', ''):
+                return self.json_response({'items': []})
+            size = len(self.images[0][0])
+            items = [
+                {'id': f"bg{i}", 'title': f"bg{i}.jpg", 'fileSize': str(size), 'md5Checksum': f"{i:032x}", 'mimeType': 'image/jpeg'}
+                for i in range(self.background_files)
+            ]
+            return self.json_response({'items': items})
+        if path.startswith('/drive/v2/files/') and query.get('alt') == 'media':
+            return self.image_response(path.rsplit('/', 1)[-1])
+        if path.startswith('/drive/v2/files/') and method == 'GET' and path.rsplit('/', 1)[-1] in self._files:
+            return self.json_response(self._files[path.rsplit('/', 1)[-1]])
+        return self.json_response({'error': {'code': 404, 'message': 'not found'}}, 404)
+
+class FakeGemini(FakeService):
+    """
+    generateContent giả lập: nếu request có responseSchema thì sinh JSON đúng schema (số phần tử mảng nằm trong
+    min/max_items, mỗi chuỗi `words` từ ngẫu nhiên để không bị lọc trùng nội dung), ngược lại trả về một câu ngắn.
+    """
+    def __init__(self, words=20, **kwargs):
+        super().__init__('gemini', **kwargs)
+        self.words = words
+
+    def sample(self, schema, name=None):
+        kind = str(schema.get('type', 'STRING')).upper()
+        if kind == 'OBJECT':
+            return {key: self.sample(sub, key) for key, sub in schema.get('properties', {}).items()}
+        if kind == 'ARRAY':
+            low = int(schema.get('min_items', schema.get('minItems', 1)))
+            high = int(schema.get('max_items', schema.get('maxItems', low)))
+            return [self.sample(schema.get('items', {}), name) for _ in range(random.randint(low, max(low, high)))]
+        if kind in ('INTEGER', 'NUMBER'):
+            return random.randint(1, 10)
+        if kind == 'BOOLEAN':
+            return True
+        if name == 'image_query':
+            return ' '.join(random.sample(FAKE_QUERY_WORDS, 2))
+        if name in ('theme', 'title'):
+            return fake_words(4)
+        return fake_words(self.words)
+
+    def route(self, method, path, query, body, headers):
+        if not path.endswith(':generateContent'):
+            return self.json_response({'error': {'code': 404, 'message': 'not found'}}, 404)
+        request = json.loads(body or b'{}')
+        schema = (request.get('generationConfig') or {}).get('responseSchema')
+        text = json.dumps(self.sample(schema), ensure_ascii=False) if schema else fake_words(6)
+        return self.json_response({
+            'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP'}],
+            'usageMetadata': {'promptTokenCount': len(body) // 4, 'candidatesTokenCount': len(text) // 4}
+        })
+
+# ==========================================================
+# --- HARNESS ---
+# ==========================================================
+def parse_service_map(value, cast=float):
+    """'gemini=800,drive=200' -> {'gemini': 800.0, 'drive': 200.0}"""
+    result = {}
+    for item in value.split(','):
+        if '=' in item:
+            key, number = item.split('=', 1)
+            result[key.strip()] = cast(number)
+    return result
+
+def start_fake_services(args):
+    latency = {**DEFAULT_LATENCY_MS, **parse_service_map(args.latency)}
+    error_rate = parse_service_map(args.error_rate)
+    common = lambda name: {'latency_ms': latency.get(name, 0), 'jitter': args.jitter, 'error_rate': error_rate.get(name, 0.0)}
+    images = {'image_mp': args.image_mp, 'photo_pool': args.photo_pool}
+    fakes = {
+        'gemini': FakeGemini(words=args.gemini_words, **common('gemini')),
+        'pexels': FakePexels(per_page=args.pexels_per_page, **images, **common('pexels')),
+        'unsplash': FakeUnsplash(**images, **common('unsplash')),
+        'telegram': FakeTelegram(**common('telegram')),
+        'sheets': FakeSheets(**common('sheets')),
+        'drive': FakeDrive(**images, **common('drive')),
+    }
+    for fake in fakes.values():
+        fake.start()
+    return fakes
+
+def configure_environment(fakes, workdir):
+    """Trỏ app.py về server giả lập và thư mục tạm. PHẢI gọi trước khi import app."""
+    os.environ.update({
+        'GEMINI_API_KEY': 'loadtest', 'GEMINI_BASE_URL': fakes['gemini'].url,
+        'PEXELS_API_KEY': 'loadtest', 'PEXELS_API_URL': f"{fakes['pexels'].url}/v1",
+        'UNSPLASH_ACCESS_KEY': 'loadtest', 'UNSPLASH_API_URL': fakes['unsplash'].url,
+        'TELEGRAM_BOT_TOKEN': 'loadtest', 'TELEGRAM_CHAT_ID': '1', 'TELEGRAM_API_URL': fakes['telegram'].url,
+        'ENABLE_TELEGRAM_NOTIFICATIONS': 'True',
+        'GSHEET_ID': 'loadtest-sheet', 'GSHEET_EXPORT_URL': fakes['sheets'].url, 'APP_CONFIG_LOCAL_FILE': '',
+        'BACKGROUND_IMAGES_FOLDER_ID': 'loadtest-backgrounds',
+        'BG_CACHE_DIR': os.path.join(workdir, 'bg_cache'),
+        'DRIVE_BG_INDEX_FILE': os.path.join(workdir, 'drive_bg_index.json'),
+        'APP_CONFIG_CACHE_FILE': os.path.join(workdir, 'app_config_cache.json'),
+        'JOB_CHECKPOINT_DIR': os.path.join(workdir, 'checkpoints'),
+        'JOB_QUEUE_DB': os.path.join(workdir, 'jobs.db'),
+        'METRICS_SUMMARY_FILE': os.path.join(workdir, 'metrics_summary.json'),
+    })
+    for name in ('STORY', 'PHONG_THUY', 'TU_VI', 'TAROT', 'CUNG_HOANG_DAO', 'FAIRY_TALE', 'JOKE'):
+        os.environ[f"{name}_DRIVE_FOLDER_ID"] = f"loadtest-{name.lower()}"
+    os.environ.setdefault('METRICS_SUMMARY_SECONDS', '0') # Harness tự ghi báo cáo
+
+def build_fake_drive(drive_url):
+    """GoogleDrive của pydrive2 thật, chỉ khác là service được dựng từ discovery document trỏ về server giả lập."""
+    import httplib2
+    from googleapiclient import discovery_cache
+    from googleapiclient.discovery import build_from_document
+    from oauth2client.client import AccessTokenCredentials
+    from pydrive2.auth import GoogleAuth
+    from pydrive2.drive import GoogleDrive
+
+    document = json.loads(discovery_cache.get_static_doc('drive', 'v2'))
+    document['rootUrl'] = f"{drive_url}/"
+    document['baseUrl'] = f"{drive_url}/{document['servicePath']}"
+    gauth = GoogleAuth()
+    gauth.credentials = AccessTokenCredentials('loadtest', 'tktk-loadtest')
+    gauth.http = gauth.credentials.authorize(httplib2.Http())
+    gauth.service = build_from_document(document, http=gauth.http)
+    return GoogleDrive(gauth)
+
+def rss_kb(pid='self'):
+    """RSS hiện tại (KB) đọc từ /proc; None nếu không có (không phải Linux)."""
+    try:
+        with open(f"/proc/{pid}/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+def children_rss_kb():
+    """Tổng RSS của các process con (process pool vẽ slide)."""
+    sizes = [rss_kb(child.pid) for child in multiprocessing.active_children()]
+    sizes = [size for size in sizes if size is not None]
+    return sum(sizes) if sizes else 0
+
+def run_load(app, drive_service, app_modes, args):
+    """Chạy job liên tục trên args.concurrency luồng tới khi hết thời gian / đủ số job. Trả về (kết quả, dòng thời gian)."""
+    app_ids = sorted(app_modes)
+    counts = {'ok': 0, 'failed': 0, 'started': 0}
+    lock = threading.Lock()
+    stop_event = threading.Event()
+    started = time.time()
+    deadline = started + args.duration if args.duration > 0 else None
+    pacing = {'next_start': started, 'interval': 60.0 / args.rate if args.rate > 0 else 0.0}
+
+    def wait_for_slot():
+        # Giới hạn tốc độ bắt đầu job chung cho mọi luồng (--rate job/phút)
+        if not pacing['interval']:
+            return True
+        with lock:
+            now = time.time()
+            start_at = max(now, pacing['next_start'])
+            pacing['next_start'] = start_at + pacing['interval']
+        return not stop_event.wait(start_at - now)
+
+    def job_loop():
+        while not stop_event.is_set():
+            if not wait_for_slot():
+                return
+            if deadline and time.time() >= deadline:
+                stop_event.set()
+                return
+            with lock:
+                # Giữ chỗ trước khi chạy: --jobs N chạy đúng N job dù nhiều luồng cùng rảnh
+                if args.jobs and counts['started'] >= args.jobs:
+                    stop_event.set()
+                    return
+                counts['started'] += 1
+            app_id = random.choice(app_ids)
+            chosen_app = app_modes[app_id]
+            chosen_domain = app.choose_app_domain(app_id, chosen_app)
+            ok = app.run_app_job(drive_service, app_id, chosen_app, chosen_domain)
+            with lock:
+                counts['ok' if ok else 'failed'] += 1
+
+    timeline = []
+    def sample():
+        with lock:
+            done = dict(counts)
+        timeline.append({
+            'elapsed': round(time.time() - started, 1), 'jobs_ok': done['ok'], 'jobs_failed': done['failed'],
+            'rss_kb': rss_kb(), 'children_rss_kb': children_rss_kb(),
+        })
+        if not args.verbose:
+            print(f"  [{timeline[-1]['elapsed']:>7.1f}s] job OK {done['ok']}, lỗi {done['failed']}, RSS {timeline[-1]['rss_kb']} KB", file=sys.stderr)
+
+    threads = [threading.Thread(target=job_loop, name=f"load_{i}", daemon=True) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    sample()
+    while any(thread.is_alive() for thread in threads):
+        if stop_event.wait(args.sample_seconds):
+            break
+        sample()
+    # Chờ các job đang chạy dở xong hẳn (không tính job mới)
+    for thread in threads:
+        thread.join()
+    sample()
+    return counts, timeline, time.time() - started
+
+def build_report(app, args, fakes, counts, timeline, elapsed):
+    minutes = elapsed / 60 if elapsed > 0 else 1
+    rss_values = [point['rss_kb'] for point in timeline if point['rss_kb'] is not None]
+    drive_stats = fakes['drive'].stats
+    # Bài/phút tính theo bài Telegram thật sự nhận được (có slide), không theo giá trị trả về của run_app_job
+    posts = fakes['telegram'].stats.get('posts', 0)
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output',)},
+        'elapsed_seconds': round(elapsed, 1),
+        'jobs_ok': counts['ok'],
+        'jobs_failed': counts['failed'],
+        'posts': posts,
+        'posts_per_minute': round(posts / minutes, 2),
+        'slides_uploaded_per_minute': round(drive_stats.get('slides_uploaded', 0) / minutes, 2),
+        'memory': {
+            'rss_start_kb': rss_values[0] if rss_values else None,
+            'rss_end_kb': rss_values[-1] if rss_values else None,
+            'rss_peak_kb': max(rss_values) if rss_values else None,
+            'rss_growth_kb': rss_values[-1] - rss_values[0] if rss_values else None,
+        },
+        'stages': app.metrics_summary()['stages'],
+        'counters': app.metrics_summary()['counters'],
+        'fake_services': {name: dict(fake.stats) for name, fake in fakes.items()},
+        'timeline': timeline,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test end-to-end các app với server giả lập cục bộ.")
+    parser.add_argument('--duration', type=float, default=60, help="Thời gian chạy (giây), 0 = chỉ dừng theo --jobs")
+    parser.add_argument('--jobs', type=int, default=0, help="Dừng sau số job này (0 = không giới hạn)")
+    parser.add_argument('--concurrency', type=int, default=2, help="Số job chạy song song")
+    parser.add_argument('--rate', type=float, default=0, help="Giới hạn số job bắt đầu mỗi phút (0 = nhanh nhất có thể)")
+    parser.add_argument('--apps', default='', help="Chỉ chạy các app id này, ví dụ '1,6,7' (mặc định: tất cả)")
+    parser.add_argument('--latency', default='', help="Độ trễ trung bình (ms) theo dịch vụ, ví dụ 'gemini=800,drive=200'")
+    parser.add_argument('--jitter', type=float, default=0.3, help="Độ dao động của độ trễ (0.3 = ±30%%)")
+    parser.add_argument('--error-rate', default='', help="Tỉ lệ lỗi 503 theo dịch vụ, ví dụ 'drive=0.02,pexels=0.05'")
+    parser.add_argument('--image-mp', type=float, default=2.0, help="Kích thước ảnh nền trả về (MP)")
+    parser.add_argument('--photo-pool', type=int, default=200, help="Số id ảnh khác nhau (ảnh lặp lại sẽ trúng cache)")
+    parser.add_argument('--pexels-per-page', type=int, default=40, help="Số ảnh mỗi trang kết quả Pexels")
+    parser.add_argument('--gemini-words', type=int, default=20, help="Số từ mỗi slide Gemini trả về")
+    parser.add_argument('--sample-seconds', type=float, default=10, help="Chu kỳ lấy mẫu bộ nhớ / tiến độ")
+    parser.add_argument('--output', default='loadtest_results.json', help="File JSON kết quả")
+    parser.add_argument('--keep-workdir', action='store_true', help="Giữ thư mục tạm (cache, checkpoint...) sau khi chạy")
+    parser.add_argument('--verbose', action='store_true', help="Giữ nguyên log của app")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tktk_loadtest_')
+    fakes = start_fake_services(args)
+    configure_environment(fakes, workdir)
+    app = importlib.import_module('app')
+    app_log = None if args.verbose else open(os.devnull, 'w')
+
+    def app_output():
+        # Log của app (print ra stdout) bị bỏ đi khi không có --verbose; tiến độ của load test ghi ra stderr
+        return contextlib.redirect_stdout(app_log) if app_log else contextlib.nullcontext()
+
+    print(f"🔧 Server giả lập: " + ', '.join(f"{name}={fake.url}" for name, fake in fakes.items()))
+    try:
+        drive_service = build_fake_drive(fakes['drive'].url)
+        with app_output():
+            app_modes = app.build_app_modes(app.get_app_modes(app.GSHEET_ID) or {})
+        if args.apps:
+            wanted = {int(app_id) for app_id in args.apps.split(',') if app_id.strip()}
+            app_modes = {app_id: config for app_id, config in app_modes.items() if app_id in wanted}
+        if not app_modes:
+            print("❌ Không có app nào để chạy.")
+            sys.exit(2)
+        print(f"🚀 Chạy {len(app_modes)} app, {args.concurrency} job song song, "
+              f"{'%ss' % args.duration if args.duration > 0 else ''}{' / %s job' % args.jobs if args.jobs else ''}.")
+
+        with app_output():
+            counts, timeline, elapsed = run_load(app, drive_service, app_modes, args)
+        report = build_report(app, args, fakes, counts, timeline, elapsed)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        print(f"\n✅ {report['jobs_ok']} job OK, {report['jobs_failed']} lỗi, {report['posts']} bài đã đăng trong {report['elapsed_seconds']}s: "
+              f"{report['posts_per_minute']} bài/phút, {report['slides_uploaded_per_minute']} slide/phút.")
+        print(f"   RSS: {report['memory']['rss_start_kb']} -> {report['memory']['rss_end_kb']} KB (đỉnh {report['memory']['rss_peak_kb']} KB)")
+        for stage, entry in report['stages'].items():
+            print(f"   {stage:<16} n={entry['count']:<6} p50={entry['p50']}s p95={entry['p95']}s")
+        print(f"   Kết quả chi tiết: {args.output}")
+    finally:
+        app._reset_render_pool()
+        for fake in fakes.values():
+            fake.stop()
+        if app_log is not None:
+            app_log.close()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()